@@ -42,6 +42,7 @@ sys.stdout.flush()
 from    koko.fab.image  import Image
 from    koko.fab.mesh   import Mesh
 from    koko.fab.asdf   import ASDF
+from    koko.fab.cache  import RenderCache, CACHE_DIR
 
 print '\r'+' '*80+'\r[|||||||||-]    reticulating splines',
 sys.stdout.flush()
@@ -59,6 +60,7 @@ class App(wx.App):
 
         koko.APP = weakref.proxy(self)
         koko.TASKS = TaskBot()
+        koko.CACHE = RenderCache(path=CACHE_DIR if koko.DISK_CACHE else None)
 
         self._mode = 'cad'
 
@@ -0,0 +1,406 @@
+""" Module for rendering .ko scripts without the wx user interface.
+
+    This module never imports wx or OpenGL, so it can be used on headless
+    machines (e.g. nightly render farms) either through
+    'kokopelli render' or by importing koko.batch directly.
+"""
+
+import  argparse
+import  multiprocessing
+import  os
+import  StringIO
+import  sys
+import  traceback
+from    datetime    import datetime
+
+from    koko.struct         import Struct
+from    koko.c.region       import Region
+from    koko.fab.fabvars    import FabVars
+from    koko.fab.image      import Image
+from    koko.fab.mesh       import Mesh
+from    koko.fab.path       import Path
+from    koko.fab.tree       import MathTree
+
+## @var FORMATS
+# Output formats supported by the batch renderer
+FORMATS = ['png', 'stl', 'svg', 'asdf']
+
+HEADER = '##    Geometry header    ##'
+
+################################################################################
+
+class HeaderPrim(object):
+    """ @class HeaderPrim
+        @brief Stand-in for a GUI primitive defined in a geometry header.
+        @details Each parameter is an expression that may refer to other
+        primitives by name; it is evaluated when accessed.
+    """
+    def __init__(self, namespace, parameters):
+        """ @brief Constructs a headless primitive
+            @param namespace Dictionary mapping names to HeaderPrims
+            @param parameters Dictionary mapping parameter names to expressions
+        """
+        self._namespace  = namespace
+        self._parameters = parameters
+
+    def __getattr__(self, name):
+        if name.startswith('_') or name not in self._parameters:
+            raise AttributeError(name)
+        expr = str(self._parameters[name])
+        if name == 'name':  return expr
+        result = eval(expr, {}, self._namespace)
+        try:                return float(result)
+        except (TypeError, ValueError): return result
+
+
+def split_script(text):
+    """ @brief Separates a script from its geometry header
+        @param text Full text of a .ko file
+        @returns (script, prims) tuple, where prims is a dictionary mapping
+        primitive names to HeaderPrim objects
+    """
+    prims = {}
+    lines = text.split('\n')
+    if lines[0] == HEADER:
+        class Module(object):
+            """ Resolves koko.prims.utils.Slider (etc) to its name """
+            def __init__(self, name):   self.name = name
+            def __getattr__(self, a):   return Module(self.name + '.' + a)
+        for cls, params in eval(lines[1], {'koko': Module('koko')}):
+            prims[params['name']] = HeaderPrim(prims, params)
+        text = '\n'.join(lines[3:])
+    return text, prims
+
+
+def run_script(text, filename='<string>'):
+    """ @brief Executes a design script
+        @param text Script text (optionally with a geometry header)
+        @param filename Filename used in error messages
+        @returns (cad, output) tuple, where cad is a FabVars structure
+        and output is the text printed by the script
+        @details Raises a RuntimeError containing the traceback on failure.
+    """
+    script, prims = split_script(text)
+
+    vars = dict(prims)
+    vars['cad'] = FabVars()
+
+    buffer = StringIO.StringIO()
+    sys.stdout = buffer
+    try:
+        exec(compile(script, filename, 'exec'), vars)
+    except:
+        sys.stdout = sys.__stdout__
+        raise RuntimeError(buffer.getvalue() + traceback.format_exc())
+    sys.stdout = sys.__stdout__
+
+    cad = vars['cad']
+    if not cad.shapes:
+        raise RuntimeError('No shape defined in %s' % filename)
+    for e in cad.shapes:
+        if not bool(e.ptr):
+            raise RuntimeError('Invalid math string in %s' % filename)
+    return cad, buffer.getvalue()
+
+################################################################################
+
+def image_region(cad, resolution):
+    """ @brief Finds the region used to render a design to a .png
+        @param cad FabVars structure
+        @param resolution Resolution (pixels/mm)
+    """
+    zmin = cad.zmin if cad.zmin else 0
+    zmax = cad.zmax if cad.zmax else 0
+    return Region(
+        (cad.xmin, cad.ymin, zmin),
+        (cad.xmax, cad.ymax, zmax),
+        resolution*cad.mm_per_unit
+    )
+
+
+def asdf_region(cad, expr, resolution, flat=False):
+    """ @brief Finds the region used to render a shape to an ASDF
+        @param cad FabVars structure
+        @param expr MathTree shape
+        @param resolution Resolution (voxels/mm)
+        @param flat Boolean determining if the region is flat on the z axis
+    """
+    if flat:
+        zmin = zmax = 0
+    else:
+        zmin = expr.zmin - cad.border*expr.dz
+        zmax = expr.zmax + cad.border*expr.dz
+    return Region(
+        (expr.xmin - cad.border*expr.dx,
+         expr.ymin - cad.border*expr.dy, zmin),
+        (expr.xmax + cad.border*expr.dx,
+         expr.ymax + cad.border*expr.dy, zmax),
+        resolution * cad.mm_per_unit
+    )
+
+
+def make_image(cad, expr, resolution, interrupt=None, threads=8):
+    """ @brief Renders a single expression into an Image
+        @param cad FabVars structure
+        @param expr MathTree shape
+        @param resolution Resolution (pixels/mm)
+        @param interrupt threading.Event that aborts rendering if set
+        @param threads Number of threads to use
+    """
+    img = expr.render(
+        image_region(cad, resolution), mm_per_unit=cad.mm_per_unit,
+        interrupt=interrupt, threads=threads
+    )
+    img.color = expr.color
+    return img
+
+
+def make_asdf(cad, expr, resolution, flat=False, interrupt=None):
+    """ @brief Renders a single expression into an ASDF
+        @param cad FabVars structure
+        @param expr MathTree shape
+        @param resolution Resolution (voxels/mm)
+        @param flat Boolean determining if the region is flat on the z axis
+        @param interrupt threading.Event that aborts rendering if set
+    """
+    return expr.asdf(
+        region=asdf_region(cad, expr, resolution, flat),
+        mm_per_unit=cad.mm_per_unit, interrupt=interrupt
+    )
+
+
+def make_images(cad, shapes, resolution, interrupt=None, threads=8):
+    """ @brief Renders a set of expressions into Images
+        @details Renders are spread across a pool of worker processes
+        (or run in threads if called from a worker process).
+        @param cad FabVars structure
+        @param shapes List of MathTree shapes
+        @param resolution Resolution (pixels/mm)
+        @param interrupt threading.Event that aborts rendering if set
+        @param threads Number of threads to use if worker processes are unavailable
+    """
+    region = image_region(cad, resolution)
+    imgs = MathTree.render_shapes(
+        shapes, [region]*len(shapes), mm_per_unit=cad.mm_per_unit,
+        interrupt=interrupt, threads=threads
+    )
+    for e, img in zip(shapes, imgs):
+        img.color = e.color
+    return imgs
+
+
+def make_meshes(cad, shapes, resolution, use_cms=False, interrupt=None):
+    """ @brief Triangulates a set of expressions (via ASDFs)
+        @details Shapes are spread across a pool of worker processes
+        (or run in threads if called from a worker process).
+        @param cad FabVars structure
+        @param shapes List of MathTree shapes
+        @param resolution Resolution (voxels/mm)
+        @param use_cms Boolean determining whether to use watertight meshing
+        @param interrupt threading.Event that aborts rendering if set
+        @returns List of Meshes (with None for aborted shapes)
+    """
+    return MathTree.triangulate_shapes(
+        shapes, [asdf_region(cad, e, resolution) for e in shapes],
+        mm_per_unit=cad.mm_per_unit, use_cms=use_cms, interrupt=interrupt
+    )
+
+################################################################################
+
+def check_bounds(cad, format):
+    """ @brief Checks that a design is bounded enough to export
+        @returns An error string, or None if the design can be exported
+    """
+    if format in ['png', 'svg'] and any(
+            getattr(cad, b) is None for b in ['xmin','xmax','ymin','ymax']):
+        return ('Design needs to be bounded along X and Y axes ' +
+                'to export .%s' % format)
+    elif format in ['stl', 'asdf'] and not cad.bounded:
+        return 'Design needs to be bounded on all axes to export .%s' % format
+    elif format == 'svg' and cad.zmin is not None:
+        return 'Design must be flat (without z bounds) to export .svg'
+    return None
+
+
+def export_png(cad, filename, resolution, make_heightmap=False, threads=8):
+    """ @brief Saves a design as a .png image
+        @param make_heightmap If true, saves a single 16-bit heightmap;
+        otherwise, saves a colored image with one layer per shape.
+    """
+    if make_heightmap:
+        out = make_images(cad, [cad.shape], resolution, threads=threads)[0]
+    else:
+        out = Image.merge(make_images(cad, cad.shapes, resolution,
+                                      threads=threads))
+    out.save(filename)
+
+
+def export_svg(cad, filename, resolution):
+    """ @brief Saves a flat design as an .svg file with per-shape colors
+    """
+    xmin = cad.xmin*cad.mm_per_unit
+    dx = (cad.xmax - cad.xmin)*cad.mm_per_unit
+    ymax = cad.ymax*cad.mm_per_unit
+    dy = (cad.ymax - cad.ymin)*cad.mm_per_unit
+    stroke = max(dx, dy)/100.
+
+    Path.write_svg_header(filename, dx, dy)
+    for expr in cad.shapes:
+        asdf = make_asdf(cad, expr, resolution, flat=True)
+        for c in asdf.contour():
+            c.write_svg_contour(
+                filename, xmin, ymax, stroke=stroke,
+                color=expr.color if expr.color else (0,0,0)
+            )
+    Path.write_svg_footer(filename)
+
+
+def export_stl(cad, filename, resolution, use_cms=False):
+    """ @brief Saves a design as an .stl mesh (via ASDFs)
+        @param use_cms Boolean determining whether to use watertight meshing
+    """
+    meshes = make_meshes(cad, cad.shapes, resolution, use_cms)
+    Mesh.merge(meshes).save_stl(filename)
+
+
+def export_asdf(cad, filename, resolution):
+    """ @brief Saves a design as an .asdf distance field
+    """
+    make_asdf(cad, cad.shape, resolution).save(filename)
+
+################################################################################
+
+def render_file(filename, outdir=None, formats=('png',), resolution=10,
+                make_heightmap=False, use_cms=False, threads=8):
+    """ @brief Renders a single .ko file to one or more output formats
+        @param filename Source .ko file
+        @param outdir Output directory (if None, the source directory)
+        @param formats List of output formats (from FORMATS)
+        @param resolution Resolution (pixels/mm or voxels/mm)
+        @param make_heightmap Save .png files as 16-bit heightmaps
+        @param use_cms Use watertight meshing for .stl files
+        @param threads Number of threads used for each render
+        @returns A Struct with filename, outputs, errors, output and time fields
+    """
+    start = datetime.now()
+    result = Struct(filename=filename, outputs=[], errors=[], output='')
+
+    if outdir is None:  outdir = os.path.dirname(os.path.abspath(filename))
+    base = os.path.splitext(os.path.basename(filename))[0]
+
+    try:
+        with open(filename, 'r') as f:
+            cad, result.output = run_script(f.read(), filename)
+    except Exception as e:
+        result.errors.append(str(e))
+    else:
+        for format in formats:
+            error = check_bounds(cad, format)
+            if error:
+                result.errors.append(error)
+                continue
+
+            target = os.path.join(outdir, '%s.%s' % (base, format))
+            try:
+                if format == 'png':
+                    export_png(cad, target, resolution,
+                               make_heightmap, threads)
+                elif format == 'svg':
+                    export_svg(cad, target, resolution)
+                elif format == 'stl':
+                    export_stl(cad, target, resolution, use_cms)
+                elif format == 'asdf':
+                    export_asdf(cad, target, resolution)
+            except Exception:
+                result.errors.append(traceback.format_exc())
+            else:
+                result.outputs.append(target)
+
+    result.time = (datetime.now() - start).total_seconds()
+    return result
+
+
+def _render_file(kwargs):
+    """ @brief Helper function to unpack keyword arguments in a worker process
+    """
+    return render_file(**kwargs)
+
+
+def render_files(filenames, workers=None, **kwargs):
+    """ @brief Renders many .ko files, using a pool of worker processes
+        @param filenames List of .ko files
+        @param workers Number of worker processes (default: one per core)
+        @param kwargs Additional arguments passed to render_file
+        @returns A generator yielding render_file results as they complete
+    """
+    if workers is None:     workers = multiprocessing.cpu_count()
+    workers = max(1, min(workers, len(filenames)))
+
+    jobs = [dict(kwargs, filename=f) for f in filenames]
+
+    if workers == 1:
+        for j in jobs:  yield _render_file(j)
+    else:
+        pool = multiprocessing.Pool(workers)
+        try:
+            for r in pool.imap_unordered(_render_file, jobs):
+                yield r
+        finally:
+            pool.close()
+            pool.join()
+
+################################################################################
+
+def main(argv):
+    """ @brief Command-line entry point for 'kokopelli render'
+        @param argv List of arguments (not including 'render')
+        @returns Exit status (0 if every file rendered successfully)
+    """
+    parser = argparse.ArgumentParser(
+        prog='kokopelli render',
+        description='Renders .ko files without opening the user interface.')
+    parser.add_argument('files', metavar='FILENAME', nargs='+',
+                        help='Design file(s) to render')
+    parser.add_argument('-f', '--format', default='png',
+                        help='Comma-separated output formats (%s)' %
+                             ', '.join(FORMATS))
+    parser.add_argument('-o', '--outdir', default=None,
+                        help='Output directory (default: next to each file)')
+    parser.add_argument('-r', '--resolution', type=float, default=10,
+                        help='Resolution in pixels or voxels per mm')
+    parser.add_argument('-j', '--workers', type=int, default=None,
+                        help='Number of worker processes (default: all cores)')
+    parser.add_argument('-t', '--threads', type=int, default=None,
+                        help='Render threads per worker process')
+    parser.add_argument('--heightmap', action='store_true',
+                        help='Save .png files as 16-bit heightmaps')
+    parser.add_argument('--watertight', action='store_true',
+                        help='Use watertight meshing for .stl files')
+    args = parser.parse_args(argv)
+
+    formats = [f.strip().lstrip('.') for f in args.format.split(',')]
+    for f in formats:
+        if f not in FORMATS:
+            parser.error('Unknown format %s' % f)
+
+    if args.outdir and not os.path.isdir(args.outdir):
+        os.makedirs(args.outdir)
+
+    workers = args.workers or multiprocessing.cpu_count()
+    threads = args.threads or max(
+        1, multiprocessing.cpu_count() / min(workers, len(args.files)))
+
+    failed = 0
+    for r in render_files(args.files, workers, outdir=args.outdir,
+                          formats=formats, resolution=args.resolution,
+                          make_heightmap=args.heightmap,
+                          use_cms=args.watertight, threads=threads):
+        if r.errors:
+            failed += 1
+            print '%s: failed (%g s)' % (r.filename, r.time)
+            for e in r.errors:  print '    ' + e.replace('\n', '\n    ')
+        else:
+            print '%s: %s (%g s)' % (r.filename, ', '.join(r.outputs), r.time)
+        sys.stdout.flush()
+
+    return 1 if failed else 0
@@ -12,3 +12,18 @@ ASDF._fields_ = [('state', ctypes.c_int),
                  ('branches', ctypes.POINTER(ASDF)*8),
                  ('d', ctypes.c_float*8),
                  ('data', ctypes.c_void_p)]
+
+class CompactASDF(ctypes.Structure):
+    """ @class CompactASDF
+        @brief C data structure describing an ASDF stored as a linear octree.
+    """
+    _fields_ = [('X', Interval), ('Y', Interval), ('Z', Interval),
+                ('ni', ctypes.c_int32), ('nj', ctypes.c_int32),
+                ('nk', ctypes.c_int32),
+                ('scale', ctypes.c_float),
+                ('cells', ctypes.c_uint32),
+                ('terminals', ctypes.c_uint32),
+                ('state', ctypes.POINTER(ctypes.c_uint8)),
+                ('branching', ctypes.POINTER(ctypes.c_uint8)),
+                ('index', ctypes.POINTER(ctypes.c_uint32)),
+                ('d', ctypes.POINTER(ctypes.c_int16*8))]
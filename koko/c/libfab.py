@@ -64,6 +64,8 @@ libfab.project.restype  =  Vec3f
 
 class MathTreeP(ctypes.c_void_p):   pass
 class PackedTreeP(ctypes.c_void_p): pass
+class BuilderP(ctypes.c_void_p):    pass
+class NodeP(ctypes.c_void_p):       pass
 
 # tree/solver.h
 libfab.render8.argtypes  = [
@@ -72,6 +74,25 @@ libfab.render8.argtypes  = [
 libfab.render16.argtypes = [
     PackedTreeP, Region, pp(ctypes.c_uint16), p(ctypes.c_int)
 ]
+libfab.render16_parallel.argtypes = [
+    p(PackedTreeP), ctypes.c_uint, Region, pp(ctypes.c_uint16),
+    p(ctypes.c_int), p(ctypes.c_double)
+]
+libfab.renderf_parallel.argtypes = [
+    p(PackedTreeP), ctypes.c_uint, Region, ctypes.c_double, pp(ctypes.c_float),
+    p(ctypes.c_int), p(ctypes.c_double)
+]
+
+# tree/trace.h
+libfab.trace_shaded.argtypes = [
+    PackedTreeP, Region, ctypes.c_float*4, pp(ctypes.c_uint16),
+    pp(ctypes.c_uint16), pp(ctypes.c_uint8*3), p(ctypes.c_int)
+]
+libfab.trace_shaded_parallel.argtypes = [
+    p(PackedTreeP), ctypes.c_uint, Region, ctypes.c_float*4,
+    pp(ctypes.c_uint16), pp(ctypes.c_uint16), pp(ctypes.c_uint8*3),
+    p(ctypes.c_int), p(ctypes.c_double)
+]
 
 # tree/tree.h
 
@@ -94,18 +115,57 @@ libfab.dot_tree.argtypes = [MathTreeP, p(ctypes.c_char)]
 libfab.make_packed.argtypes = [MathTreeP]
 libfab.make_packed.restype  =  PackedTreeP
 
+libfab.fork_packed.argtypes = [PackedTreeP]
+libfab.fork_packed.restype  =  PackedTreeP
+
 libfab.free_packed.argtypes = [PackedTreeP]
 
+libfab.set_block_size.argtypes = [PackedTreeP, ctypes.c_uint]
+
+libfab.set_affine.argtypes = [PackedTreeP, ctypes.c_bool]
+
+# tree/stats.h
+from stats import Stats
+libfab.set_stats.argtypes = [PackedTreeP, p(Stats)]
+
 # tree/eval.h
 from interval import Interval
 
 libfab.eval_i.argtypes = [PackedTreeP, Interval, Interval, Interval]
 libfab.eval_i.restype  =  Interval
 
+libfab.eval_points.argtypes = (
+    [PackedTreeP] + [p(ctypes.c_float)]*4 + [ctypes.c_uint32, p(ctypes.c_int)]
+)
+libfab.eval_gradients.argtypes = (
+    [PackedTreeP] + [p(ctypes.c_float)]*3 +
+    [p(ctypes.c_float*4), ctypes.c_uint32, p(ctypes.c_int)]
+)
+libfab.eval_intervals.argtypes = [
+    PackedTreeP, p(Interval*3), p(Interval), ctypes.c_uint32, p(ctypes.c_int)
+]
+
 # tree/parser.h
 libfab.parse.argtypes = [p(ctypes.c_char)]
 libfab.parse.restype  =  MathTreeP
 
+libfab.parse_tree.argtypes = [p(ctypes.c_char), ctypes.c_bool]
+libfab.parse_tree.restype  =  MathTreeP
+
+libfab.make_builder.argtypes = [ctypes.c_bool]
+libfab.make_builder.restype  =  BuilderP
+
+libfab.builder_parse.argtypes = [BuilderP, p(ctypes.c_char)] + [NodeP]*3
+libfab.builder_parse.restype  =  NodeP
+
+libfab.builder_op.argtypes = [BuilderP, ctypes.c_char, NodeP, NodeP]
+libfab.builder_op.restype  =  NodeP
+
+libfab.builder_finish.argtypes = [BuilderP, NodeP]
+libfab.builder_finish.restype  =  MathTreeP
+
+libfab.free_builder.argtypes = [BuilderP]
+
 ################################################################################
 
 # asdf/asdf.h
@@ -116,6 +176,12 @@ libfab.build_asdf.argtypes = [
 ]
 libfab.build_asdf.restype  =  p(ASDF)
 
+libfab.build_asdf_parallel.argtypes = [
+    p(PackedTreeP), ctypes.c_uint, Region, ctypes.c_bool, p(ctypes.c_int),
+    p(ctypes.c_double)
+]
+libfab.build_asdf_parallel.restype  =  p(ASDF)
+
 libfab.free_asdf.argtypes = [p(ASDF)]
 
 libfab.asdf_root.argtypes = [PackedTreeP, Region]
@@ -193,9 +259,48 @@ libfab.draw_asdf_distance.argtypes = [
 # asdf/file_io.h
 libfab.asdf_write.argtypes = [p(ASDF), p(ctypes.c_char)]
 
+libfab.asdf_write_parallel.argtypes = [
+    p(ASDF), p(ctypes.c_char), ctypes.c_int, ctypes.c_int, ctypes.c_uint
+]
+libfab.asdf_write_parallel.restype = ctypes.c_bool
+
 libfab.asdf_read.argtypes = [p(ctypes.c_char)]
 libfab.asdf_read.restype  =  p(ASDF)
 
+libfab.asdf_read_partial.argtypes = [
+    p(ctypes.c_char), Interval, Interval, Interval,
+    ctypes.c_int, ctypes.c_uint
+]
+libfab.asdf_read_partial.restype  =  p(ASDF)
+
+
+# asdf/compact.h
+from koko.c.asdf import CompactASDF
+
+libfab.compact_asdf.argtypes = [p(ASDF)]
+libfab.compact_asdf.restype  =  p(CompactASDF)
+
+libfab.expand_compact.argtypes = [p(CompactASDF)]
+libfab.expand_compact.restype  =  p(ASDF)
+
+libfab.expand_compact_branch.argtypes = [p(CompactASDF), ctypes.c_uint8]
+libfab.expand_compact_branch.restype  =  p(ASDF)
+
+libfab.free_compact.argtypes = [p(CompactASDF)]
+
+libfab.compact_bytes.argtypes = [p(CompactASDF)]
+libfab.compact_bytes.restype  = ctypes.c_size_t
+
+libfab.compact_scale.argtypes = [p(CompactASDF), ctypes.c_float]
+
+libfab.render_compact_shaded.argtypes = [
+    p(CompactASDF), Region, ctypes.c_float*4,
+    pp(ctypes.c_uint16), pp(ctypes.c_uint16), pp(ctypes.c_uint8*3)
+]
+
+libfab.compact_slice.argtypes = [p(CompactASDF), ctypes.c_float]
+libfab.compact_slice.restype  =  p(ASDF)
+
 
 # asdf/triangulate.h
 from koko.c.mesh import Mesh
@@ -259,6 +364,10 @@ libfab.save_png16L.argtypes = [p(ctypes.c_char), ctypes.c_int,
                                 ctypes.c_int, ctypes.c_float*6,
                                 pp(ctypes.c_uint16)]
 
+libfab.save_png8RGB.argtypes = [p(ctypes.c_char), ctypes.c_int,
+                                 ctypes.c_int, ctypes.c_float*6,
+                                 pp(ctypes.c_uint8*3)]
+
 libfab.count_by_color.argtypes = [p(ctypes.c_char), ctypes.c_int,
                                    ctypes.c_int, ctypes.c_uint32,
                                    p(ctypes.c_uint32)]
@@ -312,5 +421,9 @@ libfab.finish_cut.argtypes = (
     [ctypes.c_int]*2+[pp(ctypes.c_uint16)]+[ctypes.c_float]*4+
     [ctypes.c_int, p(pp(Path))]
 )
+libfab.finish_cut_f.argtypes = (
+    [ctypes.c_int]*2+[pp(ctypes.c_float)]+[ctypes.c_float]*4+
+    [ctypes.c_int, p(pp(Path))]
+)
 
 del p, pp
@@ -0,0 +1,181 @@
+""" Module for running libfab tasks in a pool of worker processes. """
+
+import  ctypes
+import  multiprocessing
+import  os
+import  tempfile
+import  threading
+
+import  numpy as np
+
+## @var SHARED_DIR
+# Directory in which shared memory files are created
+if os.path.isdir('/dev/shm'):   SHARED_DIR = '/dev/shm'
+else:                           SHARED_DIR = tempfile.gettempdir()
+
+
+class SharedBuffer(object):
+    """ @class SharedBuffer
+        @brief A NumPy array backed by a memory-mapped file.
+        @details When pickled, only the filename is sent, so worker processes
+        map the same memory instead of copying the array.
+    """
+
+    def __init__(self, shape, dtype, filename=None):
+        """ @brief Constructs a shared buffer
+            @param shape Array shape
+            @param dtype Array data type
+            @param filename Existing buffer to map (if None, a new file is created)
+        """
+
+        ## @var shape
+        # Array shape (tuple)
+        self.shape = tuple(shape)
+
+        ## @var dtype
+        # Array data type
+        self.dtype = np.dtype(dtype)
+
+        ## @var owner
+        # Boolean indicating whether the backing file is deleted with this object
+        self.owner = filename is None
+
+        if filename is None:
+            fd, filename = tempfile.mkstemp(prefix='koko-', dir=SHARED_DIR)
+            size = int(np.prod(self.shape))*self.dtype.itemsize
+            os.ftruncate(fd, max(size, 1))
+            os.close(fd)
+
+        ## @var filename
+        # Name of the memory-mapped file
+        self.filename = filename
+
+        ## @var array
+        # NumPy array that looks into the memory-mapped file
+        self.array = np.memmap(filename, dtype=self.dtype, mode='r+',
+                               shape=self.shape)
+
+    def __reduce__(self):
+        return (self.__class__, (self.shape, self.dtype.str, self.filename))
+
+    def __del__(self):
+        """ @brief Removes the backing file if this object created it
+            @details Existing mappings (e.g. arrays taken from this buffer)
+            remain valid after the file is removed.
+        """
+        if self.owner and os is not None:
+            try:                os.remove(self.filename)
+            except OSError:     pass
+
+
+class SharedFlag(SharedBuffer):
+    """ @class SharedFlag
+        @brief Integer flag in shared memory, used to halt libfab functions
+        running in worker processes.
+    """
+
+    def __init__(self, filename=None):
+        SharedBuffer.__init__(self, (1,), ctypes.c_int, filename)
+
+        ## @var c_int
+        # ctypes.c_int aliasing the shared flag (passed to libfab functions)
+        self.c_int = ctypes.c_int.from_address(self.array.ctypes.data)
+
+    def __reduce__(self):
+        return (self.__class__, (self.filename,))
+
+    @property
+    def value(self):    return self.c_int.value
+    @value.setter
+    def value(self, v): self.c_int.value = v
+
+################################################################################
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def available():
+    """ @brief Checks whether worker processes can be used
+        @details Daemonic processes (e.g. workers in another pool) aren't
+        allowed to have children, so they should fall back to threads.
+    """
+    return not multiprocessing.current_process().daemon
+
+
+def pool():
+    """ @brief Returns the shared process pool, creating it if necessary
+        @details The pool has one worker process per core and persists for
+        the lifetime of the program.  Workers are forked, so the GUI
+        creates the pool at startup (before importing wx) rather than
+        from a running wx application.
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = multiprocessing.Pool(multiprocessing.cpu_count())
+    return _pool
+
+
+def __monitor(interrupt, halt, finished):
+    """ @brief Waits for interrupt, then sets halt to 1 (unless the tasks
+        have already finished)
+        @param interrupt threading.Event on which we wait
+        @param halt SharedFlag used as a flag elsewhere
+        @param finished threading.Event set once every task has returned
+    """
+    interrupt.wait()
+    if not finished.is_set():   halt.value = 1
+
+
+def multiprocess(target, args, interrupt=None, halt=None):
+    """ @brief Runs a process in a pool of worker processes.
+        @details Must be called with both interrupt and halt or neither.  Interrupt is cleared before returning; halt is left set if the tasks were interrupted.
+        @param target Callable function (must be defined at module level so that it can be pickled)
+        @param args List of argument tuples (one tuple per task)
+        @param interrupt threading.Event to halt tasks or None
+        @param halt SharedFlag used as an interrupt flag by target
+        @returns List of results (in the same order as args)
+    """
+
+    if (halt is None) ^ (interrupt is None):
+        raise ValueError('multiprocess must be invoked with both halt and interrupt (or neither)')
+
+    if interrupt:
+        if interrupt.is_set():  halt.value = 1
+        finished = threading.Event()
+        m = threading.Thread(target=__monitor,
+                             args=(interrupt, halt, finished))
+        m.daemon = True
+        m.start()
+
+    try:
+        results = [pool().apply_async(target, a) for a in args]
+        results = [r.get() for r in results]
+    finally:
+        if interrupt:
+            finished.set()
+            interrupt.set()
+            m.join()
+            interrupt.clear()
+
+    return results
+
+
+def watch(halt, interrupt):
+    """ @brief Sets interrupt when halt is raised (by another process)
+        @details Used in worker processes to pass a SharedFlag to functions
+        that take a threading.Event.
+        @param halt SharedFlag to watch
+        @param interrupt threading.Event to set
+        @returns threading.Event that stops the watcher when set
+    """
+    stop = threading.Event()
+    def run():
+        while not stop.wait(0.05):
+            if halt.value:
+                interrupt.set()
+                return
+    t = threading.Thread(target=run)
+    t.daemon = True
+    t.start()
+    return stop
@@ -1,47 +1,188 @@
+import collections
+import multiprocessing
+import os
+import Queue
+import sys
 import threading
 from thread import LockType
 
-def __monitor(interrupt, halt):
-    """ @brief Waits for interrupt, then sets halt to 1
-        @param interrupt threading.Event on which we wait
-        @param halt ctypes.c_int used as a flag elsewhere
+class WorkerPool(object):
+    """ @class WorkerPool
+        @brief A set of long-lived worker threads that run submitted jobs.
+
+        @details
+        Threads are started the first time they're needed and then wait
+        on a shared queue, so running a batch of short C calls doesn't pay
+        for thread start-up and teardown each time.
+
+        The pool also holds scratch objects (e.g. large buffers) that
+        callers can borrow and give back between jobs, up to a total
+        size in bytes.
     """
-    interrupt.wait()
-    halt.value = 1
+
+    def __init__(self, size=None, scratch=64*2**20):
+        """ @brief WorkerPool constructor
+            @param size Number of worker threads (if None, one per core)
+            @param scratch Maximum number of bytes of idle scratch objects kept
+        """
+
+        ## @var size
+        # Number of worker threads
+        self.size = size if size else multiprocessing.cpu_count()
+
+        ## @var scratch
+        # Maximum number of bytes of idle scratch objects kept
+        self.scratch = scratch
+
+        self._queue   = Queue.Queue()
+        self._workers = []
+        self._idle    = collections.OrderedDict()
+        self._idle_bytes = 0
+        self._lock    = threading.Lock()
+        self._local   = threading.local()
+        self._pid     = os.getpid()
+
+    def run(self, target, args, interrupt=None, halt=None):
+        """ @brief Runs a function on the worker threads, blocking until done.
+            @details Must be called with both interrupt and halt or neither.  Interrupt is cleared before returning; halt is left set if the jobs were interrupted.  If called from one of the pool's own threads, jobs are run in the calling thread (so that nested calls can't deadlock), checking interrupt between jobs.
+            @param target Callable function
+            @param args List of argument tuples (one tuple per job)
+            @param interrupt threading.Event to halt jobs or None
+            @param halt ctypes.c_int used as an interrupt flag by target
+            @returns List of results (one per argument tuple)
+        """
+        if (halt is None) ^ (interrupt is None):
+            raise ValueError('Pool must be invoked with both halt and interrupt (or neither)')
+
+        args = list(args)
+        if getattr(self._local, 'worker', False):
+            # Check for an interrupt before each job (each job still runs,
+            # but returns early once halt is set)
+            results = []
+            for a in args:
+                if interrupt is not None and interrupt.is_set():
+                    halt.value = 1
+                results.append(target(*a))
+            if interrupt is not None:   interrupt.clear()
+            return results
+
+        self._start()
+        if interrupt is not None and interrupt.is_set():    halt.value = 1
+
+        # The last job to finish sets done, which wakes this thread.
+        # If we were given an interrupt event, then it's used as done (so
+        # that the caller can wake us early); it's cleared on return.
+        done = interrupt if interrupt is not None else threading.Event()
+        job = {'target': target, 'results': [None]*len(args),
+               'error': None, 'remaining': len(args), 'done': done}
+
+        if args:
+            for i, a in enumerate(args):   self._queue.put((job, i, a))
+            done.wait()
+
+        if interrupt is not None:
+            # If we were woken early, raise the halt flag and wait for any
+            # jobs still running to notice it
+            with self._lock:
+                finished = job['remaining'] == 0
+                if not finished:    job['done'] = threading.Event()
+            if not finished:
+                halt.value = 1
+                job['done'].wait()
+            interrupt.clear()
+
+        if job['error'] is not None:
+            raise job['error'][0], job['error'][1], job['error'][2]
+        return job['results']
+
+    def borrow(self, key, make):
+        """ @brief Takes an idle scratch object, or makes a new one
+            @param key Hashable description of the object (e.g. its size)
+            @param make Function that makes a new object
+            @returns An object, which should be handed back with give_back
+        """
+        with self._lock:
+            idle = self._idle.get(key)
+            if idle:
+                obj, size = idle.pop()
+                if not idle:    del self._idle[key]
+                self._idle_bytes -= size
+                return obj
+        return make()
+
+    def give_back(self, key, obj, size):
+        """ @brief Stores a scratch object for reuse, discarding the least
+            recently stored objects if idle objects take up more than
+            self.scratch bytes (so an object larger than that isn't kept).
+            @param key Hashable description of the object
+            @param obj Object from borrow
+            @param size Size of the object (in bytes)
+        """
+        with self._lock:
+            self._idle[key] = self._idle.pop(key, []) + [(obj, size)]
+            self._idle_bytes += size
+            while self._idle_bytes > self.scratch:
+                k = next(iter(self._idle))
+                obj, size = self._idle[k].pop(0)
+                if not self._idle[k]:   del self._idle[k]
+                self._idle_bytes -= size
+
+    ############################################################################
+
+    def _start(self):
+        """ @brief Starts the worker threads (if they aren't running)
+            @details A forked process inherits the pool without its threads
+            (and possibly with the lock held or jobs queued), so the pool's
+            state is rebuilt the first time it's used in a new process.
+        """
+        if self._pid != os.getpid():
+            self._pid     = os.getpid()
+            self._queue   = Queue.Queue()
+            self._workers = []
+            self._lock    = threading.Lock()
+
+        with self._lock:
+            while len(self._workers) < self.size:
+                t = threading.Thread(target=self._work)
+                t.daemon = True
+                t.start()
+                self._workers.append(t)
+
+    def _work(self):
+        """ @brief Runs jobs from the queue forever
+        """
+        self._local.worker = True
+        while True:
+            job, i, args = self._queue.get()
+            try:
+                job['results'][i] = job['target'](*args)
+            except Exception:
+                job['error'] = sys.exc_info()
+            with self._lock:
+                job['remaining'] -= 1
+                if job['remaining'] == 0:   job['done'].set()
+
+## @var POOL
+# Worker pool shared by multithread and monothread
+POOL = WorkerPool()
 
 
 def multithread(target, args, interrupt=None, halt=None):
     """ @brief Runs a process on multiple threads.
-        @details Must be called with both interrupt and halt or neither.  Interrupt is cleared before returning.
+        @details Must be called with both interrupt and halt or neither.  Interrupt is cleared before returning; halt is left set if the jobs were interrupted.  Jobs run on the shared worker pool (POOL).
         @param target Callable function
         @param args List of argument tuples (one tuple per thread)
         @param interrupt threading.Event to halt thread or None
         @param halt ctypes.c_int used as an interrupt flag by target
     """
-
     if (halt is None) ^ (interrupt is None):
         raise ValueError('multithread must be invoked with both halt and interrupt (or neither)')
-
-    threads = [threading.Thread(target=target, args=a) for a in args]
-
-    if interrupt:
-        m = threading.Thread(target=__monitor, args=(interrupt, halt))
-        m.daemon = True
-        m.start()
-
-    for t in threads:   t.daemon = True
-    for t in threads:   t.start()
-    for t in threads:   t.join()
-
-    if interrupt:
-        interrupt.set()
-        m.join()
-        interrupt.clear()
+    POOL.run(target, args, interrupt, halt)
 
 
 def monothread(target, args, interrupt=None, halt=None):
     """ @brief Runs a process on a single thread
-        @details Must be called with both interrupt and halt or neither.  Interrupt is cleared before returning.
+        @details Must be called with both interrupt and halt or neither.  Interrupt is cleared before returning; halt is left set if the job was interrupted.
         @param target Callable function
         @param args Argument tuples
         @param interrupt threading.Event to halt thread or None
@@ -49,20 +190,7 @@ def monothread(target, args, interrupt=None, halt=None):
     """
     if (halt is None) ^ (interrupt is None):
         raise ValueError('monothread must be invoked with both halt and interrupt (or neither)')
-
-    if interrupt:
-        m = threading.Thread(target=__monitor, args=(interrupt, halt))
-        m.daemon = True
-        m.start()
-
-    result = target(*args)
-
-    if interrupt:
-        interrupt.set()
-        m.join()
-        interrupt.clear()
-
-    return result
+    return POOL.run(target, [args], interrupt, halt)[0]
 
 def threadsafe(f):
     ''' A decorator that locks the arguments to a function,
@@ -84,6 +84,10 @@ class Region(ctypes.Structure):
                                  xmin, ymin, zmin,
                                  xmax, ymax, zmax)
             self.free_arrays = True
+
+            ## @var bounds
+            # Constructor arguments (used to rebuild the region when pickled)
+            self.bounds = ((xmin, ymin, zmin), (xmax, ymax, zmax), scale)
         else:
             self.free_arrays = False
 
@@ -94,6 +98,16 @@ class Region(ctypes.Structure):
         if hasattr(self, 'free_arrays') and self.free_arrays and libfab is not None:
             libfab.free_arrays(self)
 
+    def __reduce__(self):
+        """ @brief Pickles a region by its bounds and scale
+            @details Only regions that allocated their own arrays can be
+            pickled (subregions from split and octsect point into their
+            parent's arrays).
+        """
+        if not getattr(self, 'bounds', None):
+            raise TypeError('Only top-level regions can be pickled')
+        return (Region, self.bounds)
+
     def __repr__(self):
         return ('[(%g, %g), (%g, %g), (%g, %g)]' %
             (self.imin, self.imin + self.ni,
@@ -0,0 +1,76 @@
+import ctypes
+
+## @var OPCODES
+# Opcode names, in the order of libfab's Opcode enum
+OPCODES = ['add', 'sub', 'mul', 'div', 'min', 'max', 'pow',
+           'abs', 'square', 'sqrt', 'sin', 'cos', 'tan',
+           'asin', 'acos', 'atan', 'neg', 'X', 'Y', 'Z', 'const']
+
+class Stats(ctypes.Structure):
+    """ @class Stats
+        @brief Profiling counters recorded by a packed tree
+        @details Replicates C Stats struct.
+    """
+    _fields_ = [('interval', ctypes.c_uint64),
+                ('affine', ctypes.c_uint64),
+                ('point', ctypes.c_uint64),
+                ('gradient', ctypes.c_uint64),
+                ('array', ctypes.c_uint64),
+                ('voxels', ctypes.c_uint64),
+                ('prunes', ctypes.c_uint64),
+                ('disabled', ctypes.c_uint64),
+                ('regions', ctypes.c_uint64),
+                ('culled', ctypes.c_uint64),
+                ('filled', ctypes.c_uint64),
+                ('empty', ctypes.c_uint64),
+                ('blocks', ctypes.c_uint64),
+                ('cells', ctypes.c_uint64),
+                ('cached', ctypes.c_uint64),
+                ('opcodes', ctypes.c_uint64*len(OPCODES))]
+
+    @staticmethod
+    def combine(stats):
+        """ @brief Sums a list of Stats structures
+            @param stats List of Stats structures (one per thread)
+            @returns Dictionary of counters, with an 'opcodes' dictionary
+            mapping opcode names to (nonzero) clause evaluation counts
+        """
+        out = dict((f, sum(getattr(s, f) for s in stats))
+                   for f, _ in Stats._fields_ if f != 'opcodes')
+        opcodes = [sum(s.opcodes[i] for s in stats)
+                   for i in range(len(OPCODES))]
+        out['opcodes'] = dict((op, n) for op, n in zip(OPCODES, opcodes) if n)
+        return out
+
+    @staticmethod
+    def merge(stats):
+        """ @brief Sums a list of dictionaries from Stats.combine
+            @param stats List of dictionaries (entries that are None are skipped)
+            @returns Dictionary of counters, or None if the list had none
+        """
+        stats = [s for s in stats if s is not None]
+        if not stats:   return None
+        out = dict((f, sum(s[f] for s in stats))
+                   for f in stats[0] if f != 'opcodes')
+        out['opcodes'] = {}
+        for s in stats:
+            for op, n in s['opcodes'].items():
+                out['opcodes'][op] = out['opcodes'].get(op, 0) + n
+        return out
+
+    @staticmethod
+    def format(stats):
+        """ @brief Formats a dictionary from Stats.combine as a short string
+        """
+        s = ('%(interval)i interval / %(affine)i affine / %(point)i point / '
+             '%(gradient)i gradient / %(array)i array (%(voxels)i voxels) '
+             'evaluations\n'
+             '%(regions)i regions: %(filled)i filled, %(empty)i empty, '
+             '%(culled)i culled, %(blocks)i blocks\n'
+             '%(prunes)i prunes (%(disabled)i clauses disabled)' % stats)
+        if stats['cells']:
+            s += ', %(cells)i cells (%(cached)i cached samples)' % stats
+        ops = sorted(stats['opcodes'].items(), key=lambda o: -o[1])
+        if ops:
+            s += '\nclauses: ' + ', '.join('%s %i' % o for o in ops[:6])
+        return s
@@ -131,8 +131,11 @@ class CadImgPanel(FabPanel):
                           zmax+border*dz),
                           values['res']*cad.mm_per_unit)
 
+        # 3D models are rendered as floating-point heightmaps, so that
+        # path planning works with true heights
         self.img = expr.render(region=region,
-                               mm_per_unit=cad.mm_per_unit)
+                               mm_per_unit=cad.mm_per_unit,
+                               depth='f' if dz else 16)
         koko.FRAME.status = ''
 
         return {'img': self.img}
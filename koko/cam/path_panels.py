@@ -31,6 +31,11 @@ class ContourPanel(FabPanel):
         values = self.get_values()
         if not values:  return False
 
+        # Floating-point heightmaps are flattened to their filled pixels
+        if img.depth == 'f':
+            img = img.copy()
+            img.array = np.array(~np.isnan(img.array), dtype=np.uint8)
+
         koko.FRAME.status = 'Finding distance transform'
         distance = img.distance()
 
@@ -266,6 +271,11 @@ class PathPanel(FabPanel):
         else:
             values['overlap'] = 0
 
+        # Floating-point heightmaps are flattened to their filled pixels
+        if img.depth == 'f':
+            img = img.copy()
+            img.array = np.array(~np.isnan(img.array), dtype=np.uint8)
+
         koko.FRAME.status = 'Finding distance transform'
         distance = img.distance()
 
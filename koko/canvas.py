@@ -6,6 +6,7 @@ import  numpy as np
 import  koko
 from    koko.prims.menu import show_menu
 from    koko.struct     import Struct
+from    koko.fab.tiles  import TilePyramid
 
 class Canvas(wx.Panel):
     """ @class Canvas
@@ -54,6 +55,15 @@ class Canvas(wx.Panel):
         # Merged image to draw, or None
         self.image = None
 
+        ## @var tiles
+        # TilePyramid storing rendered image tiles (used by RenderTask)
+        self.tiles = TilePyramid()
+
+        ## @var _scaled
+        # (image, scale, crop, bitmap) tuple caching the most recently
+        # drawn bitmap, so that repaints don't rescale the image again
+        self._scaled = None
+
         ## @var drag_target
         # Target for left-click and drag operations
         self.drag_target = None
@@ -383,7 +393,12 @@ class Canvas(wx.Panel):
 
             # If the image is at the correct scale, then we're fine
             # to simply render it at its set position
-            bitmap = wx.BitmapFromImage(self.image.wximg)
+            if self._scaled and self._scaled[0] is self.image and \
+                    self._scaled[1:3] == (None, None):
+                bitmap = self._scaled[3]
+            else:
+                bitmap = wx.BitmapFromImage(self.image.wximg)
+                self._scaled = (self.image, None, None, bitmap)
             xmin = self.image.xmin
             ymax = self.image.ymax
         else:
@@ -397,13 +412,20 @@ class Canvas(wx.Panel):
 
             scale = self.scale / (self.mm_per_unit * self.image.pixels_per_mm)
 
-            img = self.image.wximg.Copy().GetSubImage(crop)
-            if int(img.Width*scale) == 0 or int(img.Height*scale) == 0:
-                return
+            # Reuse the last rescaled bitmap if nothing has changed
+            # (e.g. when repainting to draw primitives)
+            if self._scaled and self._scaled[0] is self.image and \
+                    self._scaled[1:3] == (scale, crop.Get()):
+                bitmap = self._scaled[3]
+            else:
+                img = self.image.wximg.Copy().GetSubImage(crop)
+                if int(img.Width*scale) == 0 or int(img.Height*scale) == 0:
+                    return
 
-            img.Rescale(img.Width  * scale,
-                        img.Height * scale)
-            bitmap = wx.BitmapFromImage(img)
+                img.Rescale(img.Width  * scale,
+                            img.Height * scale)
+                bitmap = wx.BitmapFromImage(img)
+                self._scaled = (self.image, scale, crop.Get(), bitmap)
 
             xmin = (
                 self.image.xmin +
@@ -631,6 +653,7 @@ class Canvas(wx.Panel):
         """
         self.images = imgs
         self.image = merged
+        self._scaled = None
 
         if self.snap:
             self.snap_bounds()
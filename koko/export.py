@@ -10,10 +10,11 @@ import os
 import wx
 
 import  koko
+import  koko.batch   as batch
 import  koko.dialogs as dialogs
-from    koko.c.region     import Region
 
 from    koko.fab.asdf     import ASDF
+from    koko.fab.cache    import RenderCache
 from    koko.fab.path     import Path
 from    koko.fab.image    import Image
 from    koko.fab.mesh     import Mesh
@@ -80,19 +81,12 @@ class ExportTaskCad(object):
         '''
 
         if self.make_heightmap:
-            out = self.make_image(self.cad.shape)
+            imgs = self.make_images([self.cad.shape])
         else:
-            i = 0
-            imgs = []
-            for e in self.cad.shapes:
-                if self.event.is_set(): return
-                img = self.make_image(e)
-                if img is not None: imgs.append(img)
-                i += 1
-                self.window.progress = i*90/len(self.cad.shapes)
-            out = Image.merge(imgs)
+            imgs = self.make_images(self.cad.shapes)
 
         if self.event.is_set(): return
+        out = imgs[0] if self.make_heightmap else Image.merge(imgs)
 
         self.window.progress = 90
         out.save(self.filename)
@@ -100,24 +94,26 @@ class ExportTaskCad(object):
 
 
 
-    def make_image(self, expr):
-        ''' Renders a single expression, returning the image
+    def make_images(self, shapes):
+        ''' Renders a set of expressions (in parallel), returning the images
+            (shapes that haven't changed since the last render are
+             loaded from the render cache)
         '''
-        zmin = self.cad.zmin if self.cad.zmin else 0
-        zmax = self.cad.zmax if self.cad.zmax else 0
-
-        region = Region(
-            (self.cad.xmin, self.cad.ymin, zmin),
-            (self.cad.xmax, self.cad.ymax, zmax),
-            self.resolution*self.cad.mm_per_unit
-        )
-
-        img = expr.render(
-            region, mm_per_unit=self.cad.mm_per_unit, interrupt=self.c_event
-        )
+        region = batch.image_region(self.cad, self.resolution)
+        keys = [RenderCache.key('image', e, region, self.cad.mm_per_unit)
+                for e in shapes]
+
+        def render(indices):
+            imgs = batch.make_images(
+                self.cad, [shapes[i] for i in indices], self.resolution,
+                interrupt=self.c_event
+            )
+            return None if self.event.is_set() else imgs
+        imgs = koko.CACHE.lookup(keys, render) or []
 
-        img.color = expr.color
-        return img
+        for e, img in zip(shapes, imgs):
+            img.color = e.color
+        return imgs
 
 
     def export_asdf(self):
@@ -169,52 +165,38 @@ class ExportTaskCad(object):
     def export_stl(self):
         ''' Exports an stl, using an asdf as intermediary.
         '''
-        i = 0
-        meshes = []
-        for expr in self.cad.shapes:
-
-            if self.event.is_set(): return
-            asdf = self.make_asdf(expr)
-            i += 1
-            self.window.progress = i*33/len(self.cad.shapes)
-
-            if self.event.is_set(): return
-            mesh = self.make_mesh(asdf)
-            i += 2
-            self.window.progress = i*33/len(self.cad.shapes)
-
-            if mesh is not None:    meshes.append(mesh)
+        shapes = self.cad.shapes
+        keys = [RenderCache.key(
+                    'mesh', e, batch.asdf_region(self.cad, e, self.resolution),
+                    self.cad.mm_per_unit, use_cms=self.use_cms)
+                for e in shapes]
+
+        def triangulate(indices):
+            meshes = batch.make_meshes(
+                self.cad, [shapes[i] for i in indices], self.resolution,
+                use_cms=self.use_cms, interrupt=self.c_event
+            )
+            return None if self.event.is_set() else meshes
+        meshes = koko.CACHE.lookup(keys, triangulate) or []
+        self.window.progress = 90
 
         if self.event.is_set(): return
-        total = Mesh.merge(meshes)
+        total = Mesh.merge([m for m in meshes if m is not None])
         total.save_stl(self.filename)
 
     def make_asdf(self, expr, flat=False):
-        ''' Renders an expression to an ASDF '''
-        if flat:
-            region = Region(
-                (expr.xmin - self.cad.border*expr.dx,
-                 expr.ymin - self.cad.border*expr.dy,
-                 0),
-                (expr.xmax + self.cad.border*expr.dx,
-                 expr.ymax + self.cad.border*expr.dy,
-                 0),
-                 self.resolution * self.cad.mm_per_unit
+        ''' Renders an expression to an ASDF (or loads it from the cache) '''
+        region = batch.asdf_region(self.cad, expr, self.resolution, flat)
+        key = RenderCache.key('asdf', expr, region, self.cad.mm_per_unit)
+
+        asdf = koko.CACHE.get(key)
+        if asdf is None:
+            asdf = batch.make_asdf(
+                self.cad, expr, self.resolution, flat=flat,
+                interrupt=self.c_event
             )
-        else:
-            region = Region(
-                (expr.xmin - self.cad.border*expr.dx,
-                 expr.ymin - self.cad.border*expr.dy,
-                 expr.zmin - self.cad.border*expr.dz),
-                (expr.xmax + self.cad.border*expr.dx,
-                 expr.ymax + self.cad.border*expr.dy,
-                 expr.zmax + self.cad.border*expr.dz),
-                 self.resolution * self.cad.mm_per_unit
-            )
-        asdf = expr.asdf(
-            region=region, mm_per_unit=self.cad.mm_per_unit,
-            interrupt=self.c_event
-        )
+            if asdf is not None and not self.event.is_set():
+                koko.CACHE.put(key, asdf)
         return asdf
 
 
@@ -223,14 +205,6 @@ class ExportTaskCad(object):
         return contour
 
 
-    def make_mesh(self, asdf):
-        ''' Renders an ASDF to a mesh '''
-        if self.use_cms:
-            return asdf.triangulate_cms()
-        else:
-            return asdf.triangulate(interrupt=self.c_event)
-
-
     def export_dot(self):
         ''' Saves a math tree as a .dot file. '''
 
@@ -5,6 +5,7 @@ from datetime       import datetime
 import threading
 from math           import sin, cos, radians, log, ceil
 import os
+import multiprocessing
 import Queue
 
 from koko.c.multithread    import multithread, monothread, threadsafe
@@ -14,14 +15,180 @@ from koko.c.libfab  import libfab
 from koko.c.asdf    import ASDF as _ASDF
 from koko.c.path    import Path as _Path
 from koko.c.region  import Region
+from koko.c.interval import Interval
 from koko.c.vec3f   import Vec3f
 
 ################################################################################
 
-class ASDF(object):
+class ASDFBase(object):
+    ''' Accessors and rendering shared by ASDF and CompactASDF.
+
+        These only depend on the root cell's bounds (self.ptr.contents.X,
+        Y, and Z) and on the libfab function used to render shaded
+        images (_render_shaded), which subclasses set.'''
+
+    @property
+    def X(self):
+        """ @returns X bounds as an Interval """
+        return self.ptr.contents.X
+    @property
+    def Y(self):
+        """ @returns Y bounds as an Interval """
+        return self.ptr.contents.Y
+    @property
+    def Z(self):
+        """ @returns Z bounds as Interval """
+        return self.ptr.contents.Z
+
+    @property
+    def xmin(self):
+        """ @returns Minimum x bound (in mm) """
+        return self.ptr.contents.X.lower
+    @property
+    def xmax(self):
+        """ @returns Maximum x bound (in mm) """
+        return self.ptr.contents.X.upper
+    @property
+    def dx(self):
+        """ @returns X size (in mm) """
+        return self.xmax - self.xmin
+
+    @property
+    def ymin(self):
+        """ @returns Minimum y bound (in mm) """
+        return self.ptr.contents.Y.lower
+    @property
+    def ymax(self):
+        """ @returns Maximum y bound (in mm) """
+        return self.ptr.contents.Y.upper
+    @property
+    def dy(self):
+        """ @returns Y size (in mm) """
+        return self.ymax - self.ymin
+
+    @property
+    def zmin(self):
+        """ @returns Minimum z bound (in mm) """
+        return self.ptr.contents.Z.lower
+    @property
+    def zmax(self):
+        """ @returns Maximum y bound (in mm) """
+        return self.ptr.contents.Z.upper
+    @property
+    def dz(self):
+        """ @returns Z size (in mm) """
+        return self.zmax - self.zmin
+    @property
+    def mm_per_unit(self):  return 1
+
+
+    def bounds(self, alpha=0, beta=0):
+        ''' Find the minimum possible bounding box for this ASDF
+            rotated with angles alpha and beta. '''
+
+        # Create an array of the eight cube corners
+        corners = [Vec3f(self.X.upper if (i & 4) else self.X.lower,
+                         self.Y.upper if (i & 2) else self.Y.lower,
+                         self.Z.upper if (i & 1) else self.Z.lower)
+                   for i in range(8)]
+
+        # Project the corners around
+        M = (ctypes.c_float*4)(cos(radians(alpha)), sin(radians(alpha)),
+                               cos(radians(beta)),  sin(radians(beta)))
+        corners = [libfab.project(c, M) for c in corners]
+
+        # Find and return the bounds
+        return Struct(
+            xmin=min(c.x for c in corners),
+            xmax=max(c.x for c in corners),
+            ymin=min(c.y for c in corners),
+            ymax=max(c.y for c in corners),
+            zmin=min(c.z for c in corners),
+            zmax=max(c.z for c in corners)
+        )
+
+
+    def bounding_region(self, resolution, alpha=0, beta=0):
+        """ @brief Finds a bounding region with the given rotation
+            @param resolution Region resolution (voxels/unit)
+            @param alpha Rotation about Z axis
+            @param beta Rotation about X axis
+        """
+        b = self.bounds(alpha, beta)
+        return Region(
+            (b.xmin, b.ymin, b.zmin),
+            (b.xmax, b.ymax, b.zmax),
+            resolution
+        )
+
+
+    #
+    #   Render to image
+    #
+    def render(self, region=None, threads=8, alpha=0, beta=0, resolution=10):
+        """ @brief Renders to an image
+            @param region Render region (default bounding box)
+            @param threads Threads to use (default 8)
+            @param alpha Rotation about Z axis (default 0)
+            @param beta Rotation about X axis (default 0)
+            @param resolution Resolution in voxels per mm
+            @returns A height-map Image
+        """
+        return self.render_multi(region, threads, alpha, beta, resolution)[0]
+
+
+    def render_multi(self, region=None, threads=8,
+                     alpha=0, beta=0, resolution=10):
+        """ @brief Renders to an image
+            @param region Render region (default bounding box)
+            @param threads Threads to use (default 8)
+            @param alpha Rotation about Z axis (default 0)
+            @param beta Rotation about X axis (default 0)
+            @resolution Resolution in voxels per mm
+            @returns A tuple with a height-map, shaded image, and image with colored normals
+        """
+        if region is None:
+            region = self.bounding_region(resolution, alpha, beta)
+
+        depth   = Image(
+            region.ni, region.nj, channels=1, depth=16,
+        )
+        shaded  = Image(
+            region.ni, region.nj, channels=1, depth=16,
+        )
+        normals = Image(
+            region.ni, region.nj, channels=3, depth=8,
+        )
+
+        subregions = region.split_xy(threads)
+
+        M = (ctypes.c_float*4)(cos(radians(alpha)), sin(radians(alpha)),
+                               cos(radians(beta)), sin(radians(beta)))
+        args = [
+            (self.ptr, s, M, depth.pixels, shaded.pixels, normals.pixels)
+            for s in subregions
+        ]
+        multithread(self._render_shaded, args)
+
+        for image in [depth, shaded, normals]:
+            image.xmin = region.X[0]
+            image.xmax = region.X[region.ni]
+            image.ymin = region.Y[0]
+            image.ymax = region.Y[region.nj]
+            image.zmin = region.Z[0]
+            image.zmax = region.Z[region.nk]
+        return depth, shaded, normals
+
+################################################################################
+
+class ASDF(ASDFBase):
     ''' Wrapper class that contains an ASDF pointer and
         automatically frees it upon destruction.'''
 
+    ## @var _render_shaded
+    # libfab function used by render_multi
+    _render_shaded = libfab.render_asdf_shaded
+
     def __init__(self, ptr, free=True, color=None):
         """ @brief Creates an ASDF wrapping the given pointer
             @param ptr Target pointer
@@ -99,59 +266,6 @@ class ASDF(object):
     def d(self):
         """ @returns Array of eight distance samples """
         return [self.ptr.contents.d[i] for i in range(8)]
-    @property
-    def X(self):
-        """ @returns X bounds as an Interval """
-        return self.ptr.contents.X
-    @property
-    def Y(self):
-        """ @returns Y bounds as an Interval """
-        return self.ptr.contents.Y
-    @property
-    def Z(self):
-        """ @returns Z bounds as Interval """
-        return self.ptr.contents.Z
-
-    @property
-    def xmin(self):
-        """ @returns Minimum x bound (in mm) """
-        return self.ptr.contents.X.lower
-    @property
-    def xmax(self):
-        """ @returns Maximum x bound (in mm) """
-        return self.ptr.contents.X.upper
-    @property
-    def dx(self):
-        """ @returns X size (in mm) """
-        return self.xmax - self.xmin
-
-    @property
-    def ymin(self):
-        """ @returns Minimum y bound (in mm) """
-        return self.ptr.contents.Y.lower
-    @property
-    def ymax(self):
-        """ @returns Maximum y bound (in mm) """
-        return self.ptr.contents.Y.upper
-    @property
-    def dy(self):
-        """ @returns Y size (in mm) """
-        return self.ymax - self.ymin
-
-    @property
-    def zmin(self):
-        """ @returns Minimum z bound (in mm) """
-        return self.ptr.contents.Z.lower
-    @property
-    def zmax(self):
-        """ @returns Maximum y bound (in mm) """
-        return self.ptr.contents.Z.upper
-    @property
-    def dz(self):
-        """ @returns Z size (in mm) """
-        return self.zmax - self.zmin
-    @property
-    def mm_per_unit(self):  return 1
 
 
     def rescale(self, mult):
@@ -191,20 +305,51 @@ class ASDF(object):
         return self.cell_count * ctypes.sizeof(_ASDF)
 
 
-    def save(self, filename):
+    def compact(self):
+        """ @brief Packs this ASDF into a linear octree
+            @returns A CompactASDF
+        """
+        return CompactASDF(libfab.compact_asdf(self.ptr), color=self.color)
+
+
+    def save(self, filename, version=(3, 0), threads=None):
         """ @brief Saves the ASDF to file
+            @param filename Filename (string)
+            @param version File format version, as a (major, minor) tuple.  Use (2, 0) for files that older versions of kokopelli can read.
+            @param threads Number of threads used to compress blocks (if None, one per core)
         """
-        libfab.asdf_write(self.ptr, filename)
+        if threads is None: threads = multiprocessing.cpu_count()
+        major, minor = version
+        if not libfab.asdf_write_parallel(self.ptr, filename,
+                                          major, minor, threads):
+            raise IOError('Could not save ASDF to %s' % filename)
 
 
     @classmethod
-    def load(cls, filename):
+    def load(cls, filename, region=None, max_depth=None, threads=None):
         """ @brief Loads an ASDF file from disk
+            @details If region or max_depth is given, then only the parts
+            of a (version 3) file that are needed are decoded; the rest
+            of the ASDF is made of coarse leaf cells.
             @param cls Class (automatic argument)
             @param filename Filename (string)
+            @param region Bounds of interest, as a pair of (x, y, z) tuples
+            (or None to load everything)
+            @param max_depth Maximum cell depth (or None for no limit)
+            @param threads Number of threads used to decode blocks (if None, one per core)
             @returns An ASDF loaded from the file
         """
-        asdf = cls(libfab.asdf_read(filename))
+        if threads is None: threads = multiprocessing.cpu_count()
+        if region is None:
+            X = Y = Z = Interval(float('-inf'), float('inf'))
+        else:
+            (xmin, ymin, zmin), (xmax, ymax, zmax) = region
+            X, Y, Z = (Interval(xmin, xmax), Interval(ymin, ymax),
+                       Interval(zmin, zmax))
+        ptr = libfab.asdf_read_partial(
+            filename, X, Y, Z, -1 if max_depth is None else max_depth, threads
+        )
+        asdf = cls(ptr)
         asdf.filename = filename
         return asdf
 
@@ -254,104 +399,6 @@ class ASDF(object):
         return ASDF(libfab.asdf_slice(self.ptr, z), color=self.color)
 
 
-    def bounds(self, alpha=0, beta=0):
-        ''' Find the minimum possible bounding box for this ASDF
-            rotated with angles alpha and beta. '''
-
-        # Create an array of the eight cube corners
-        corners = [Vec3f(self.X.upper if (i & 4) else self.X.lower,
-                         self.Y.upper if (i & 2) else self.Y.lower,
-                         self.Z.upper if (i & 1) else self.Z.lower)
-                   for i in range(8)]
-
-        # Project the corners around
-        M = (ctypes.c_float*4)(cos(radians(alpha)), sin(radians(alpha)),
-                               cos(radians(beta)),  sin(radians(beta)))
-        corners = [libfab.project(c, M) for c in corners]
-
-        # Find and return the bounds
-        return Struct(
-            xmin=min(c.x for c in corners),
-            xmax=max(c.x for c in corners),
-            ymin=min(c.y for c in corners),
-            ymax=max(c.y for c in corners),
-            zmin=min(c.z for c in corners),
-            zmax=max(c.z for c in corners)
-        )
-
-
-    def bounding_region(self, resolution, alpha=0, beta=0):
-        """ @brief Finds a bounding region with the given rotation
-            @param resolution Region resolution (voxels/unit)
-            @param alpha Rotation about Z axis
-            @param beta Rotation about X axis
-        """
-        b = self.bounds(alpha, beta)
-        return Region(
-            (b.xmin, b.ymin, b.zmin),
-            (b.xmax, b.ymax, b.zmax),
-            resolution
-        )
-
-
-    #
-    #   Render to image
-    #
-    def render(self, region=None, threads=8, alpha=0, beta=0, resolution=10):
-        """ @brief Renders to an image
-            @param region Render region (default bounding box)
-            @param threads Threads to use (default 8)
-            @param alpha Rotation about Z axis (default 0)
-            @param beta Rotation about X axis (default 0)
-            @param resolution Resolution in voxels per mm
-            @returns A height-map Image
-        """
-        return self.render_multi(region, threads, alpha, beta, resolution)[0]
-
-
-    def render_multi(self, region=None, threads=8,
-                     alpha=0, beta=0, resolution=10):
-        """ @brief Renders to an image
-            @param region Render region (default bounding box)
-            @param threads Threads to use (default 8)
-            @param alpha Rotation about Z axis (default 0)
-            @param beta Rotation about X axis (default 0)
-            @resolution Resolution in voxels per mm
-            @returns A tuple with a height-map, shaded image, and image with colored normals
-        """
-        if region is None:
-            region = self.bounding_region(resolution, alpha, beta)
-
-        depth   = Image(
-            region.ni, region.nj, channels=1, depth=16,
-        )
-        shaded  = Image(
-            region.ni, region.nj, channels=1, depth=16,
-        )
-        normals = Image(
-            region.ni, region.nj, channels=3, depth=8,
-        )
-
-        subregions = region.split_xy(threads)
-
-        M = (ctypes.c_float*4)(cos(radians(alpha)), sin(radians(alpha)),
-                               cos(radians(beta)), sin(radians(beta)))
-        args = [
-            (self.ptr, s, M, depth.pixels, shaded.pixels, normals.pixels)
-            for s in subregions
-        ]
-        multithread(libfab.render_asdf_shaded, args)
-
-        for image in [depth, shaded, normals]:
-            image.xmin = region.X[0]
-            image.xmax = region.X[region.ni]
-            image.ymin = region.Y[0]
-            image.ymax = region.Y[region.nj]
-            image.zmin = region.Z[0]
-            image.zmax = region.Z[region.nk]
-        return depth, shaded, normals
-
-
     def render_distance(self, resolution=10):
         """ @brief Draws the ASDF as a distance field (used for debugging)
             @param resolution Image resolution
@@ -471,6 +518,152 @@ class ASDF(object):
 
 ################################################################################
 
+class CompactASDF(ASDFBase):
+    ''' Wrapper class that contains a CompactASDF pointer and
+        automatically frees it upon destruction.
+
+        A CompactASDF stores cells as a linear octree in flat arrays
+        (with corner values quantized to 16 bits), so it takes a fraction
+        of the memory of a pointer-based ASDF.  Cells are unpacked one at
+        a time when rendering or slicing.  Triangulation expands, meshes,
+        and frees one of the root's branches at a time; contouring (of a
+        2D ASDF) expands the whole tree first.'''
+
+    ## @var _render_shaded
+    # libfab function used by render_multi
+    _render_shaded = libfab.render_compact_shaded
+
+    def __init__(self, ptr, free=True, color=None):
+        """ @brief Creates a CompactASDF wrapping the given pointer
+            @param ptr Target pointer
+            @param free Boolean determining if the pointer is freed upon destruction
+            @param color ASDF's color (or None)
+        """
+
+        ## @var ptr
+        # Pointer to a C CompactASDF structure
+        self.ptr        = ptr
+
+        ## @var free
+        # Boolean determining whether the pointer is freed
+        self.free       = free
+
+        ## @var color
+        # Tuple representing RGB color (or None)
+        self.color      = color
+
+        ## @var lock
+        # Lock for safe multithreaded operations
+        self.lock = threading.Lock()
+
+    @threadsafe
+    def __del__(self):
+        """ @brief Destructor which frees the CompactASDF if necessary
+        """
+        if self.free and libfab is not None:
+            libfab.free_compact(self.ptr)
+
+    @property
+    def state(self):
+        """ @returns A string describing the root cell's state """
+        return ['FILLED','EMPTY','BRANCH','LEAF'][self.ptr.contents.state[0]]
+
+    @property
+    def dimensions(self):
+        """ @returns ni, nj, nk tuple of lattice dimensions
+        """
+        c = self.ptr.contents
+        return c.ni, c.nj, c.nk
+
+    @property
+    def cell_count(self):
+        """ @returns Number of cells in this ASDF
+        """
+        return self.ptr.contents.cells
+
+    @property
+    def ram(self):
+        """ @returns Number of bytes in RAM this ASDF occupies
+        """
+        return libfab.compact_bytes(self.ptr)
+
+
+    def rescale(self, mult):
+        """ @brief Rescales the ASDF by the given scale factor
+            @param mult Scale factor (1 is no change)
+            @returns None
+        """
+        libfab.compact_scale(self.ptr, mult)
+
+
+    def expand(self):
+        """ @brief Unpacks this ASDF into a pointer-based ASDF
+            @returns An ASDF
+        """
+        return ASDF(libfab.expand_compact(self.ptr), color=self.color)
+
+
+    def slice(self, z):
+        """ @brief Finds a 2D ASDF at a given z height
+            @param z Z height at which to slice the ASDF
+            @returns 2D slice of original ASDF (as a pointer-based ASDF)
+        """
+        return ASDF(libfab.compact_slice(self.ptr, z), color=self.color)
+
+
+    @threadsafe
+    def triangulate(self, threads=True, interrupt=None):
+        """ @brief Triangulates an ASDF, returning a mesh
+            @details Each of the root's branches is expanded, triangulated,
+            and freed in turn, so the full pointer-based ASDF never exists.
+            @param threads Boolean determining multithreading
+            @param interrupt threading.Event used to abort
+            @returns A Mesh containing the triangulated ASDF
+        """
+        # Create an event to interrupt the evaluation
+        if interrupt is None:   interrupt = threading.Event()
+
+        # Shared flag to interrupt rendering
+        halt = ctypes.c_int(0)
+
+        branching = self.ptr.contents.branching[0]
+        if branching:
+            q = Queue.Queue()
+            args = [(self.ptr, i, halt, q)
+                    for i in range(8) if branching & (1 << i)]
+
+            if threads:
+                multithread(CompactASDF._triangulate, args, interrupt, halt)
+            else:
+                for a in args:  CompactASDF._triangulate(*a)
+
+            results = []
+            while True:
+                try:                results.append(q.get_nowait())
+                except Queue.Empty: break
+        else:
+            results = [self.expand()._triangulate(halt)]
+        m = Mesh.merge(results)
+        m.color = self.color
+        return m
+
+
+    @staticmethod
+    def _triangulate(ptr, branch, halt, queue):
+        ''' Expands and triangulates one of the root's branches,
+            pushing the resulting mesh to the queue.'''
+        queue.put(ASDF(libfab.expand_compact_branch(ptr, branch))._triangulate(halt))
+
+
+    def contour(self, interrupt=None):
+        """ @brief Contours a 2D ASDF
+            @returns A set of Path objects
+            @param interrupt threading.Event used to abort run
+        """
+        return self.expand().contour(interrupt)
+
+################################################################################
+
 from koko.fab.image import Image
 from koko.fab.mesh  import Mesh
 from koko.fab.path  import Path
@@ -0,0 +1,280 @@
+""" Module defining a content-addressed cache of rendered results. """
+
+import  collections
+import  cPickle as pickle
+import  hashlib
+import  os
+import  tempfile
+import  threading
+
+from    koko.fab.asdf   import ASDF
+from    koko.fab.image  import Image
+from    koko.fab.mesh   import Mesh
+
+## @var CACHE_DIR
+# Default directory for the on-disk cache tier (shared across sessions)
+CACHE_DIR = os.path.join(os.path.expanduser('~'), '.kokopelli', 'cache')
+
+## @var EXTENSIONS
+# File extensions used to store each type of result on disk
+EXTENSIONS = {Image: '.img', Mesh: '.mesh', ASDF: '.asdf'}
+
+
+class RenderCache(object):
+    """ @class RenderCache
+        @brief Stores Images, Meshes, and ASDFs keyed by what produced them.
+
+        @details
+        Keys are hashes of a shape's expression digest, the render region,
+        mm_per_unit, the settings that change the result, and the kind of
+        result, so an unchanged shape finds its old result even if the
+        rest of the design has changed.
+
+        Results are kept in an in-memory LRU with a byte budget and
+        (optionally) written to a directory on disk.  Images and meshes are
+        copied going in and out, so callers may modify what they get back;
+        ASDFs are shared and should be treated as read-only.
+    """
+
+    def __init__(self, budget=256*2**20, path=None, disk_budget=256*2**20):
+        """ @brief RenderCache constructor
+            @param budget Memory budget (in bytes)
+            @param path Directory for the on-disk tier (or None to keep results in memory only)
+            @param disk_budget Disk budget (in bytes)
+        """
+
+        ## @var budget
+        # Maximum number of bytes held in memory
+        self.budget = budget
+
+        ## @var path
+        # Directory for the on-disk tier (or None)
+        self.path = path
+
+        ## @var disk_budget
+        # Maximum number of bytes stored on disk
+        self.disk_budget = disk_budget
+
+        ## @var hits
+        # Number of successful lookups
+        self.hits = 0
+
+        ## @var misses
+        # Number of failed lookups
+        self.misses = 0
+
+        self._entries = collections.OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+        # Bytes stored on disk (counted by _prune, then kept up to date
+        # by _save, so the directory is only scanned when it's over budget)
+        self._disk_bytes = None
+
+        if path is not None and not os.path.isdir(path):
+            try:                os.makedirs(path)
+            except OSError:     self.path = None
+
+    ############################################################################
+
+    @staticmethod
+    def key(kind, expr, region, mm_per_unit, merge_leafs=True, affine=False,
+            use_cms=False):
+        """ @brief Makes a cache key
+            @details The tree's block size is part of the key if it has
+            been set; otherwise, ASDFs are built with MathTree.default_block
+            (which only depends on the tree) and images don't depend on it.
+            @param kind Result type (e.g. 'image', 'mesh', 'asdf')
+            @param expr MathTree being rendered
+            @param region Top-level Region
+            @param mm_per_unit Real-world scale
+            @param merge_leafs Boolean determining whether ASDF leaf cells are combined
+            @param affine Boolean determining whether bounds are found with affine arithmetic
+            @param use_cms Boolean determining whether meshes are watertight
+            @returns A hex digest string
+        """
+        h = hashlib.sha1(expr.digest)
+        h.update(repr((kind, region.bounds[:2],
+                       region.ni, region.nj, region.nk,
+                       mm_per_unit, expr.block,
+                       merge_leafs, affine, use_cms)))
+        return h.hexdigest()
+
+    @staticmethod
+    def size(value):
+        """ @brief Estimates the memory used by a result (in bytes)
+        """
+        if isinstance(value, Image):
+            return value.array.nbytes
+        elif isinstance(value, Mesh):
+            return value.vcount*6*4 + value.tcount*3*4 if value.ptr else 0
+        elif isinstance(value, ASDF):
+            return value.ram
+        return 0
+
+    @staticmethod
+    def copy(value):
+        """ @brief Copies a result (ASDFs are returned as-is)
+        """
+        if isinstance(value, Image):
+            return value.copy()
+        elif isinstance(value, Mesh):
+            return Mesh.merge([value])
+        return value
+
+    ############################################################################
+
+    def get(self, key):
+        """ @brief Looks up a result
+            @param key Key from RenderCache.key
+            @returns The cached result (a copy for Images and Meshes) or None
+        """
+        with self._lock:
+            value = self._entries.pop(key, None)
+            if value is not None:
+                self._entries[key] = value
+        if value is None:
+            value = self._load(key)
+            if value is not None:
+                self._store(key, value)
+
+        if value is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return self.copy(value)
+
+    def put(self, key, value):
+        """ @brief Stores a result in memory (and on disk, if enabled)
+            @param key Key from RenderCache.key
+            @param value Image, Mesh, or ASDF
+        """
+        if value is None or type(value) not in EXTENSIONS:  return
+        if isinstance(value, Mesh) and not value.ptr:       return
+
+        value = self.copy(value)
+        self._store(key, value)
+        self._save(key, value)
+
+    def lookup(self, keys, make):
+        """ @brief Finds a set of results, making the ones that are missing
+            @param keys List of keys (from RenderCache.key)
+            @param make Function taking a list of indices into keys and
+            returning a list of results (or None if it was interrupted)
+            @returns List of results, or None if make was interrupted
+        """
+        out = [self.get(k) for k in keys]
+        missing = [i for i, v in enumerate(out) if v is None]
+        if missing:
+            made = make(missing)
+            if made is None:    return None
+            for i, v in zip(missing, made):
+                self.put(keys[i], v)
+                out[i] = v
+        return out
+
+    def clear(self):
+        """ @brief Empties the in-memory tier
+        """
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    ############################################################################
+
+    def _store(self, key, value):
+        """ @brief Adds a result to the in-memory LRU, evicting old results
+        """
+        size = self.size(value)
+        if size > self.budget:  return
+
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:     self._bytes -= self.size(old)
+            self._entries[key] = value
+            self._bytes += size
+            while self._bytes > self.budget:
+                k, v = self._entries.popitem(last=False)
+                self._bytes -= self.size(v)
+
+    def _filename(self, key, cls):
+        return os.path.join(self.path, key + EXTENSIONS[cls])
+
+    def _save(self, key, value):
+        """ @brief Writes a result to the on-disk tier
+            @details Files are written under a temporary name then renamed,
+            so that other sessions never see a partial file.
+        """
+        if self.path is None:   return
+
+        target = self._filename(key, type(value))
+        if os.path.exists(target):  return
+
+        fd, tmp = tempfile.mkstemp(dir=self.path, prefix='.koko-')
+        os.close(fd)
+        try:
+            if isinstance(value, Image):
+                with open(tmp, 'wb') as f:
+                    pickle.dump(value, f, pickle.HIGHEST_PROTOCOL)
+            else:
+                value.save(tmp)
+            size = os.path.getsize(tmp)
+            os.rename(tmp, target)
+        except (IOError, OSError):
+            if os.path.exists(tmp):     os.remove(tmp)
+            return
+
+        with self._lock:
+            if self._disk_bytes is not None:    self._disk_bytes += size
+            full = self._disk_bytes is None or \
+                   self._disk_bytes > self.disk_budget
+        if full:    self._prune()
+
+    def _load(self, key):
+        """ @brief Reads a result from the on-disk tier
+            @returns The result or None
+        """
+        if self.path is None:   return None
+
+        for cls in EXTENSIONS:
+            filename = self._filename(key, cls)
+            if not os.path.exists(filename):    continue
+            try:
+                if cls is Image:
+                    with open(filename, 'rb') as f:
+                        value = pickle.load(f)
+                else:
+                    value = cls.load(filename)
+                os.utime(filename, None)
+                return value
+            except Exception:
+                # Remove corrupt or partial files, so that they're
+                # replaced by the next render
+                try:                os.remove(filename)
+                except OSError:     pass
+                return None
+        return None
+
+    def _prune(self):
+        """ @brief Deletes the least recently used files on disk
+            until the disk tier is within its budget
+            @details Called by _save on the first write and whenever the
+            running total of bytes on disk goes over budget (the directory
+            is rescanned, since other sessions may share it).
+        """
+        try:
+            files = [os.path.join(self.path, f) for f in os.listdir(self.path)
+                     if not f.startswith('.')]
+            stats = [(os.stat(f), f) for f in files]
+        except OSError:
+            return
+
+        total = sum(s.st_size for s, f in stats)
+        for s, f in sorted(stats, key=lambda sf: sf[0].st_mtime):
+            if total <= self.disk_budget:   break
+            try:                os.remove(f)
+            except OSError:     continue
+            total -= s.st_size
+
+        with self._lock:
+            self._disk_bytes = total
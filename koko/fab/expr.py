@@ -0,0 +1,166 @@
+""" Module defining the Expr class, a DAG representation of math expressions. """
+
+import  hashlib
+import  threading
+import  weakref
+
+from    koko.c.libfab   import libfab, MathTreeP
+
+class Expr(object):
+    """ @class Expr
+        @brief A node in a math expression graph.
+
+        @details
+        Each node stores an operation character (as used in math strings)
+        and references to its argument nodes, so combining expressions
+        doesn't copy their math strings.  Nodes are hash-consed:  making
+        the same operation on the same arguments returns the same object.
+
+        Leaf nodes (op '$') store a raw math string, which is handed to the
+        parser as-is.
+
+        Map nodes (op 'm') have four arguments:  the new X, Y, and Z
+        expressions (or None to leave an axis alone) and the mapped body.
+
+        Nodes are immutable, so each one's digest is memoised.
+    """
+
+    __slots__ = ('op', 'args', 'text', '_digest', '__weakref__')
+
+    _table = weakref.WeakValueDictionary()
+    _lock  = threading.Lock()
+
+    def __new__(cls, op, *args, **kwargs):
+        """ @brief Finds or creates an expression node
+            @param op Operation character
+            @param args Argument expressions
+            @param text Math string (for '$' leaf nodes)
+        """
+        text = kwargs.get('text')
+        key = (op, tuple(id(a) for a in args), text)
+        with cls._lock:
+            e = cls._table.get(key)
+            if e is None:
+                e = object.__new__(cls)
+                e.op, e.args, e.text = op, args, text
+                e._digest = None
+                cls._table[key] = e
+        return e
+
+    @classmethod
+    def raw(cls, text):
+        """ @brief Wraps a math string as a leaf expression
+        """
+        return cls('$', text=text)
+
+    @classmethod
+    def map(cls, body, X=None, Y=None, Z=None):
+        """ @brief Creates a map expression
+            @param body Expression to remap
+            @param X New X expression or None
+            @param Y New Y expression or None
+            @param Z New Z expression or None
+        """
+        return cls('m', X, Y, Z, body)
+
+    @property
+    def math(self):
+        """ @brief Serializes the expression to a math string
+            @details Shared subexpressions are written out once per use.
+        """
+        out = []
+        stack = [self]
+        while stack:
+            e = stack.pop()
+            if e is None:       out.append(' ')
+            elif e.op == '$':   out.append(e.text)
+            else:
+                out.append(e.op)
+                stack.extend(reversed(e.args))
+        return ''.join(out)
+
+    @property
+    def digest(self):
+        """ @brief Hex digest identifying the expression
+            @details Hashed from the graph's structure (each node's
+            operation and its arguments' digests) rather than from the
+            math string, so shared subexpressions are only hashed once and
+            the string is never built.
+        """
+        stack = [self]
+        while stack:
+            e = stack[-1]
+            if e._digest is not None:
+                stack.pop()
+                continue
+
+            pending = [a for a in e.args if a is not None and a._digest is None]
+            if pending:
+                stack += pending
+                continue
+
+            h = hashlib.sha1(e.op)
+            if e.text is not None:  h.update(e.text)
+            for a in e.args:
+                h.update('-'*40 if a is None else a._digest)
+            e._digest = h.hexdigest()
+            stack.pop()
+        return self._digest
+
+    def build(self, simplify=True):
+        """ @brief Constructs a C tree node-by-node (without a math string)
+            @param simplify If true, identity operations are removed
+            @returns A MathTreeP (which is NULL if construction failed)
+        """
+        builder = libfab.make_builder(simplify)
+
+        # Built nodes, keyed by expression id and the (X, Y, Z) nodes
+        # substituted into it (None for the builder's own variables)
+        nodes = {}
+        identity = (None, None, None)
+
+        # Each task is an (expression, environment, stage) tuple
+        tasks = [(self, identity, 0)]
+        while tasks:
+            e, env, stage = tasks.pop()
+            key = (id(e), env)
+            if stage == 0 and key in nodes:
+                continue
+
+            if e.op == '$':
+                n = libfab.builder_parse(builder, e.text, *env).value
+
+            elif e.op == 'm' and stage < 2:
+                # Build the new X, Y, Z expressions, then the body (in an
+                # environment where they replace the current variables).
+                if stage == 0:
+                    tasks.append((e, env, 1))
+                    tasks += [(a, env, 0) for a in e.args[:3] if a is not None]
+                else:
+                    inner = tuple(v if a is None else nodes[(id(a), env)]
+                                  for a, v in zip(e.args[:3], env))
+                    tasks.append((e, env, 2))
+                    tasks.append((e.args[3], inner, 0))
+                continue
+
+            elif e.op == 'm':
+                inner = tuple(v if a is None else nodes[(id(a), env)]
+                              for a, v in zip(e.args[:3], env))
+                n = nodes[(id(e.args[3]), inner)]
+
+            elif stage == 0:
+                tasks.append((e, env, 1))
+                tasks += [(a, env, 0) for a in e.args]
+                continue
+
+            else:
+                lhs = nodes[(id(e.args[0]), env)]
+                rhs = nodes[(id(e.args[1]), env)] if len(e.args) > 1 else None
+                n = libfab.builder_op(builder, e.op, lhs, rhs).value
+
+            if n is None:
+                libfab.free_builder(builder)
+                return MathTreeP()
+            nodes[key] = n
+
+        return libfab.builder_finish(builder, nodes[(id(self), identity)])
@@ -4,11 +4,11 @@ import  ctypes
 import  math
 import  threading
 
-import  wx
 import  numpy as np
 
 from    koko.c.libfab       import libfab
-from    koko.c.multithread  import multithread
+from    koko.c.multithread  import multithread, POOL
+from    koko.c.multiprocess import SharedBuffer
 from    koko.c.path         import Path as Path_
 
 from    koko.fab.path       import Path
@@ -19,12 +19,13 @@ class Image(object):
         @brief Wraps a numpy array (indexed by row, column) and various parameters
     '''
 
-    def __init__(self, w, h, channels=1, depth=8):
+    def __init__(self, w, h, channels=1, depth=8, shared=False):
         """ @brief Image constructor
             @param w Image width in pixels
             @param h Image height in pixels
             @param channels Number of channels (1 or 3)
             @param depth Image depth (8, 16, 32, or 'f' for floating-point)
+            @param shared If true, pixels are stored in shared memory, so that worker processes can write directly into the image
         """
 
         if depth == 8:      dtype = np.uint8
@@ -33,12 +34,20 @@ class Image(object):
         elif depth == 'f':  dtype = np.float32
         else:   raise ValueError("Invalid bit depth (must be 8, 16, or 'f')")
 
+        if channels != 1 and channels != 3:
+            raise ValueError('Invalid number of channels (must be 1 or 3)')
+
+        ## @var _shared
+        # SharedBuffer holding the image pixels (or None)
+        self._shared = None
+
         ## @var array
         # NumPy array storing image pixels
-        if channels == 1 or channels == 3:
-            self.array = np.zeros( (h, w, channels), dtype=dtype )
+        if shared:
+            self._shared = SharedBuffer((h, w, channels), dtype)
+            self.array = self._shared.array
         else:
-            raise ValueError('Invalid number of channels (must be 1 or 3)')
+            self.array = np.zeros( (h, w, channels), dtype=dtype )
 
         ## @var color
         # Base image color (used when merging black-and-white images)
@@ -55,6 +64,24 @@ class Image(object):
         # String representing filename or None
         self.filename = None
 
+    def __getstate__(self):
+        """ @brief Returns the state used when pickling
+            @details Images in shared memory are pickled by reference,
+            so the pixel array isn't copied.
+        """
+        state = dict(self.__dict__, _wx=None)
+        if self._shared is not None and self.array is self._shared.array:
+            del state['array']
+        else:
+            state['_shared'] = None
+        return state
+
+    def __setstate__(self, state):
+        """ @brief Restores an image from its pickled state
+        """
+        self.__dict__.update(state)
+        if self._shared is not None:    self.array = self._shared.array
+
     def __eq__(self, other):
         eq = self.array == other.array
         if eq is False: return False
@@ -77,7 +104,7 @@ class Image(object):
             self.width, self.height,
             self.channels, self.depth
         )
-        out.array = self.array.copy()
+        out.array = np.array(self.array)
         for a in ['xmin','ymin','zmin',
                   'xmax','ymax','zmax']:
             setattr(out, a, getattr(self, a))
@@ -122,6 +149,7 @@ class Image(object):
     def wximg(self):
         """ @brief Returns (after constructing, if necessary) a wx.Image representation of this Image.
         """
+        import wx
         if self._wx is None:
             img = self.copy(channels=3, depth=8)
             self._wx = wx.ImageFromBuffer(img.width, img.height, img.array)
@@ -161,21 +189,21 @@ class Image(object):
             elif self.depth == 32:
                 self.array = np.array(self.array >> 24, dtype=np.uint8)
             elif self.depth == 'f':
-                self.array = np.array(self.array*255, dtype=np.uint8)
+                self.array = np.array(self._unit()*255, dtype=np.uint8)
         elif d == 16:
             if self.depth == 8:
                 self.array = np.array(self.array << 8, dtype=np.uint16)
             elif self.depth == 32:
                 self.array = np.array(self.array >> 16, dtype=np.uint16)
             elif self.depth == 'f':
-                self.array = np.array(self.array*65535, dtype=np.uint16)
+                self.array = np.array(self._unit()*65535, dtype=np.uint16)
         elif d == 32:
             if self.depth == 8:
                 self.array = np.array(self.array << 24, dtype=np.uint32)
             elif self.depth == 16:
                 self.array = np.array(self.array << 16, dtype=np.uint32)
             elif self.depth == 'f':
-                self.array = np.array(self.array*4294967295., dtype=np.uint32)
+                self.array = np.array(self._unit()*4294967295., dtype=np.uint32)
         elif d == 'f':
             if self.depth == 8:
                 self.array = np.array(self.array/255., dtype=np.float32)
@@ -187,6 +215,26 @@ class Image(object):
             raise ValueError("Invalid depth (must be 8, 16, 32, or 'f')")
 
 
+    def _unit(self):
+        """ @brief Scales a floating-point image into the range [0, 1]
+            @details Heightmaps (with a z range) are scaled so that zmin and zmax map to 0 and 1, as in integer heightmaps; other images are scaled by their own minimum and maximum.  NaN pixels (e.g. empty pixels in a heightmap) become 0.
+            @returns A float64 array
+        """
+        array = np.array(self.array, dtype=np.float64)
+        finite = np.isfinite(array)
+
+        if self.dz:
+            lower, upper = self.zmin, self.zmax
+        elif finite.any():
+            lower, upper = array[finite].min(), array[finite].max()
+        else:
+            lower, upper = 0, 1
+        if upper <= lower:  upper = lower + 1
+
+        array[~finite] = lower
+        return np.clip((array - lower) / (upper - lower), 0, 1)
+
+
     @property
     def dx(self):
         try:                return self.xmax - self.xmin
@@ -377,13 +425,22 @@ class Image(object):
 
     def save(self, filename):
         """ @brief Saves an image as a png
-            @detail 3-channel images are saved as RGB images without metadata; 1-channel images are saved as 16-bit greyscale images with correct bounds and 'zmax', 'zmin' fields as text chunks.
+            @detail 3-channel images are saved as 8-bit RGB images with physical dimensions; 1-channel images are saved as 16-bit greyscale images with correct bounds and 'zmax', 'zmin' fields as text chunks.
         """
         if filename[-4:].lower() != '.png':
             raise ValueError('Image must be saved with .png extension')
 
         if self.channels == 3:
-            self.wximg.SaveFile(filename, wx.BITMAP_TYPE_PNG)
+            img = self.copy(channels=3, depth=8)
+            nan = float('nan')
+            bounds = (ctypes.c_float*6)(
+                self.xmin if self.xmin is not None else nan,
+                self.ymin if self.ymin is not None else nan, nan,
+                self.xmax if self.xmax is not None else nan,
+                self.ymax if self.ymax is not None else nan, nan
+            )
+            libfab.save_png8RGB(filename, self.width, self.height,
+                                bounds, img.flipped_pixels)
         else:
             img = self.copy(channels=1, depth=16)
             bounds = (ctypes.c_float*6)(
@@ -396,7 +453,7 @@ class Image(object):
 
     def threshold(self, z):
         """ @brief Thresholds a heightmap at a given depth.
-            @brief Can only be called on an 8, 16, or 32-bit image.
+            @details Floating-point heightmaps (from MathTree.render with depth='f') store heights directly, with NaN for empty pixels.
             @param z Z depth (in image units)
             @returns Thresholded image (8-bit, single-channel)
         """
@@ -410,7 +467,13 @@ class Image(object):
         elif self.depth == 16:  k = int(65535*(z-self.zmin) / self.dz)
         elif self.depth == 32:  k = int(4294967295*(z-self.zmin) / self.dz)
         elif self.depth == 'f':
-            raise ValueError('Cannot take threshold of floating-point image')
+            with np.errstate(invalid='ignore'):
+                filled = self.array >= np.float32(z)
+            # Empty pixels are at zmin (as in integer heightmaps)
+            if self.zmin is not None and z <= self.zmin:
+                filled |= np.isnan(self.array)
+            out.array = np.array(filled, dtype=np.uint8)
+            return out
 
         out.array = np.array(self.array >= k, dtype=np.uint8)
 
@@ -418,18 +481,24 @@ class Image(object):
 
 
     def finish_cut(self, bit_diameter, overlap, bit_type):
-        ''' Calculates xy and yz finish cuts on a 16-bit heightmap
+        ''' Calculates xy and yz finish cuts on a 16-bit or floating-point heightmap
         '''
 
-        if self.depth != 16 or self.channels != 1:
+        if self.depth not in (16, 'f') or self.channels != 1:
             raise ValueError('Invalid image type for finish cut '+
-                '(requires 16-bit, 1-channel image)')
+                '(requires 16-bit or floating-point, 1-channel image)')
 
         ptr = ctypes.POINTER(ctypes.POINTER(Path_))()
-        path_count = libfab.finish_cut(
-            self.width, self.height, self.pixels,
-            self.mm_per_pixel, self.mm_per_bit,
-            bit_diameter, overlap, bit_type, ptr)
+        if self.depth == 'f':
+            path_count = libfab.finish_cut_f(
+                self.width, self.height, self.pixels,
+                self.zmin, self.mm_per_pixel,
+                bit_diameter, overlap, bit_type, ptr)
+        else:
+            path_count = libfab.finish_cut(
+                self.width, self.height, self.pixels,
+                self.mm_per_pixel, self.mm_per_bit,
+                bit_diameter, overlap, bit_type, ptr)
 
         paths = [Path.from_ptr(ptr[i]) for i in range(path_count)]
         libfab.free_paths(ptr, path_count)
@@ -472,18 +541,22 @@ class Image(object):
         return Path.sort(paths)
 
 
-    def distance(self, threads=2):
+    def distance(self, threads=None):
         """ @brief Finds the distance transform of an input image.
-            @param threads Number of threads to use
+            @param threads Number of threads to use (if None, one per worker in the shared pool)
             @returns A one-channel floating-point image
         """
+        if threads is None: threads = POOL.size
         input = self.copy(depth=8)
 
-        # Temporary storage for G lattice
-        g = self.__class__(
+        # Temporary storage for G lattice (which is completely overwritten,
+        # so it's reused between calls with the same image size, as long
+        # as it fits in the pool's scratch budget)
+        key = ('distance', self.width, self.height)
+        g = POOL.borrow(key, lambda: Image(
             self.width, self.height,
             channels=1, depth=32
-        )
+        ))
         ibounds = [int(t/float(threads)*self.width) for t in range(threads)]
         ibounds = zip(ibounds, ibounds[1:] + [self.width])
 
@@ -503,6 +576,7 @@ class Image(object):
                  g.pixels, output.pixels) for j in jbounds]
 
         multithread(libfab.distance_transform2, args2)
+        POOL.give_back(key, g, g.array.nbytes)
 
         output.zmin = output.zmax = None
 
@@ -5,6 +5,8 @@ import  operator
 import  os
 import  tempfile
 
+import  numpy as np
+
 from    koko.struct     import Struct
 
 class Mesh(object):
@@ -92,6 +94,22 @@ class Mesh(object):
         else:
             libfab.save_mesh(filename, self.ptr)
 
+    def set_normals(self, expr, scale=1):
+        """ @brief Replaces vertex normals with the gradient of a math tree
+            @details Gradients are found exactly at each vertex (with
+            MathTree.gradient_points), rather than from the ASDF's samples.
+            @param expr MathTree that this mesh was generated from
+            @param scale Real-world scale (mm per unit) of the mesh
+        """
+        if not self.ptr or not self.vcount:    return
+
+        vdata = np.ctypeslib.as_array(self.vdata, shape=(self.vcount, 6))
+        g = expr.gradient_points(vdata[:,:3] / scale)[:,1:]
+
+        length = np.sqrt((g**2).sum(axis=1))
+        length[length == 0] = 1
+        vdata[:,3:] = g / length[:,np.newaxis]
+
 ################################################################################
 
     def refine(self):
@@ -130,6 +148,7 @@ class Mesh(object):
                 region=s, mm_per_unit=self.source.scale
             )
             mesh = asdf.triangulate()
+            mesh.set_normals(self.source.expr, self.source.scale)
 
             mesh.source = Struct(
                 type=MathTree,
@@ -0,0 +1,211 @@
+""" Module defining a multi-resolution tile cache for 2D heightmaps. """
+
+import  collections
+import  math
+import  threading
+
+import  numpy as np
+
+from    koko.c.region   import Region
+from    koko.fab.image  import Image
+from    koko.fab.tree   import MathTree
+
+## @var TILE_SIZE
+# Width and height of each tile (in pixels)
+TILE_SIZE = 256
+
+
+class TilePyramid(object):
+    """ @class TilePyramid
+        @brief Stores rendered heightmap tiles at power-of-two resolutions.
+
+        @details
+        Level L renders at 2**L pixels per unit, and tile (i, j) on that
+        level covers the square whose lower corner is
+        (i, j) * TILE_SIZE / 2**L.  Tiles are keyed by the digest of the
+        shape's expression (plus the z range), so they're reused when
+        the view moves or when other shapes in the design change.
+    """
+
+    def __init__(self, budget=256*2**20):
+        """ @brief TilePyramid constructor
+            @param budget Memory budget (in bytes)
+        """
+
+        ## @var budget
+        # Maximum number of bytes of tiles stored
+        self.budget = budget
+
+        self._tiles = collections.OrderedDict()
+        self._bytes = 0
+        self._lock  = threading.Lock()
+
+    ############################################################################
+
+    @staticmethod
+    def level(pixels_per_unit):
+        """ @brief Picks the pyramid level closest to a given resolution
+        """
+        return int(round(math.log(pixels_per_unit, 2)))
+
+    @staticmethod
+    def tile_range(level, xmin, xmax, ymin, ymax):
+        """ @brief Finds the tiles on a level that overlap a rectangle
+            @returns (i0, i1, j0, j1) tuple of inclusive tile indices
+            (always including at least one tile)
+        """
+        size = TILE_SIZE / 2.**level
+        i0, j0 = int(math.floor(xmin / size)), int(math.floor(ymin / size))
+        i1, j1 = int(math.ceil(xmax / size)) - 1, int(math.ceil(ymax / size)) - 1
+        return i0, max(i0, i1), j0, max(j0, j1)
+
+    @staticmethod
+    def tile_region(level, i, j, zmin, zmax):
+        """ @brief Makes the render region for a single tile
+        """
+        size = TILE_SIZE / 2.**level
+        return Region((i*size, j*size, zmin),
+                      ((i+1)*size, (j+1)*size, zmax), 2.**level)
+
+    @staticmethod
+    def shape_key(shape, zmin, zmax):
+        """ @brief Identifies a shape's tiles
+        """
+        return (shape.digest, zmin, zmax)
+
+    ############################################################################
+
+    def render(self, shapes, bounds, level, zmin, zmax, mm_per_unit,
+               interrupt=None, stats=False):
+        """ @brief Renders a set of shapes, using tiles where possible
+            @details Missing tiles are rendered together (in a pool of
+            worker processes, with each shape's tiles batched so that
+            workers pack the shape once per batch), then stitched into
+            one Image per shape.
+            @param shapes List of MathTrees
+            @param bounds List of (xmin, xmax, ymin, ymax) tuples (one per shape)
+            @param level Pyramid level
+            @param zmin Minimum Z value (arbitrary units)
+            @param zmax Maximum Z value (arbitrary units)
+            @param mm_per_unit Real-world scale
+            @param interrupt threading.Event that aborts rendering if set
+            @param stats Boolean determining whether libfab's profiling
+            counters are stored in each shape's stats attribute (None for
+            shapes whose tiles were all stored already)
+            @returns List of Images, or None if interrupted
+        """
+        keys = [self.shape_key(s, zmin, zmax) for s in shapes]
+
+        # Find missing tiles, grouped by shape (each shape's tiles are
+        # only rendered once, even if the shape appears multiple times)
+        todo = collections.OrderedDict()
+        with self._lock:
+            for s, k, b in zip(shapes, keys, bounds):
+                i0, i1, j0, j1 = self.tile_range(level, *b)
+                for i in range(i0, i1+1):
+                    for j in range(j0, j1+1):
+                        t = k + (level, i, j)
+                        if t in self._tiles:    continue
+                        if k not in todo:
+                            todo[k] = (s, collections.OrderedDict())
+                        todo[k][1][t] = True
+        todo = [(s, tiles.keys()) for s, tiles in todo.values()]
+
+        if stats:
+            for s in shapes:    s.stats = None
+
+        if todo:
+            batches = [[self.tile_region(level, t[-2], t[-1], zmin, zmax)
+                        for t in tiles] for s, tiles in todo]
+            imgs = MathTree.render_batches(
+                [s for s, tiles in todo], batches,
+                mm_per_unit=mm_per_unit, interrupt=interrupt, stats=stats
+            )
+            if imgs is None:    return None
+            for (s, tiles), batch in zip(todo, imgs):
+                for t, img in zip(tiles, batch):
+                    self._store(t, np.array(img.array[:,:,0]))
+
+        return [self.assemble(k, b, level, zmin, zmax, mm_per_unit)
+                for k, b in zip(keys, bounds)]
+
+    def preview(self, shapes, bounds, level, zmin, zmax, mm_per_unit):
+        """ @brief Stitches images from coarser tiles that are already stored
+            @details Searches for the finest level below the given level
+            on which every shape has all of its tiles.
+            @returns (level, images) tuple, or (None, None) if no level is complete
+        """
+        keys = [self.shape_key(s, zmin, zmax) for s in shapes]
+        with self._lock:
+            levels = sorted(set(t[3] for t in self._tiles if t[3] < level),
+                            reverse=True)
+        for L in levels:
+            imgs = [self.assemble(k, b, L, zmin, zmax, mm_per_unit)
+                    for k, b in zip(keys, bounds)]
+            if all(imgs):   return L, imgs
+        return None, None
+
+    def assemble(self, key, bounds, level, zmin, zmax, mm_per_unit):
+        """ @brief Stitches a shape's tiles into a single Image
+            @details The image is cropped to the given bounds (rounded
+            outwards to the nearest pixel).
+            @param key Shape key (from TilePyramid.shape_key)
+            @param bounds (xmin, xmax, ymin, ymax) tuple
+            @returns An Image, or None if any tiles are missing
+        """
+        i0, i1, j0, j1 = self.tile_range(level, *bounds)
+        ni, nj = (i1 - i0 + 1)*TILE_SIZE, (j1 - j0 + 1)*TILE_SIZE
+        array = np.zeros((nj, ni, 1), dtype=np.uint16)
+
+        with self._lock:
+            for i in range(i0, i1+1):
+                for j in range(j0, j1+1):
+                    t = key + (level, i, j)
+                    tile = self._tiles.get(t)
+                    if tile is None:    return None
+                    self._tiles[t] = self._tiles.pop(t)
+
+                    # Rows are stored from top to bottom
+                    x = (i - i0)*TILE_SIZE
+                    y = (j1 - j)*TILE_SIZE
+                    array[y:y+TILE_SIZE, x:x+TILE_SIZE, 0] = tile
+
+        # Crop to the requested bounds
+        scale = 2.**level
+        xmin, xmax, ymin, ymax = bounds
+        x0 = int(math.floor(xmin*scale)) - i0*TILE_SIZE
+        x1 = int(math.ceil(xmax*scale))  - i0*TILE_SIZE
+        y0 = (j1 + 1)*TILE_SIZE - int(math.ceil(ymax*scale))
+        y1 = (j1 + 1)*TILE_SIZE - int(math.floor(ymin*scale))
+        x1, y1 = max(x1, x0 + 1), max(y1, y0 + 1)
+
+        img = Image(x1 - x0, y1 - y0, channels=1, depth=16)
+        img.array = np.ascontiguousarray(array[y0:y1, x0:x1])
+        img.xmin = (i0*TILE_SIZE + x0) / scale * mm_per_unit
+        img.xmax = (i0*TILE_SIZE + x1) / scale * mm_per_unit
+        img.ymax = ((j1 + 1)*TILE_SIZE - y0) / scale * mm_per_unit
+        img.ymin = ((j1 + 1)*TILE_SIZE - y1) / scale * mm_per_unit
+        img.zmin = zmin*mm_per_unit
+        img.zmax = zmax*mm_per_unit
+        return img
+
+    def clear(self):
+        """ @brief Discards all stored tiles
+        """
+        with self._lock:
+            self._tiles.clear()
+            self._bytes = 0
+
+    ############################################################################
+
+    def _store(self, key, tile):
+        """ @brief Stores a tile, evicting the least recently used tiles
+        """
+        with self._lock:
+            old = self._tiles.pop(key, None)
+            if old is not None:     self._bytes -= old.nbytes
+            self._tiles[key] = tile
+            self._bytes += tile.nbytes
+            while self._bytes > self.budget:
+                k, t = self._tiles.popitem(last=False)
+                self._bytes -= t.nbytes
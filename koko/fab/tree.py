@@ -1,15 +1,39 @@
 """ Module defining MathTree class and helper decorators. """
 
+import  collections
 import  ctypes
 import  os, sys
 import  threading
 import  math
-import  Queue
+import  multiprocessing
+import  tempfile
+import  time
 
-from    koko.c.libfab       import libfab
+import  numpy as np
+
+from    koko.c.libfab       import libfab, PackedTreeP
+from    koko.fab.expr       import Expr
 from    koko.c.interval     import Interval
 from    koko.c.region       import Region
-from    koko.c.multithread  import multithread, threadsafe
+from    koko.c.vec3f        import Vec3f
+from    koko.c.stats        import Stats
+from    koko.c.multithread  import multithread, monothread, threadsafe
+import  koko.c.multiprocess as multiprocess
+
+## @var BLOCK_SIZES
+# Candidate voxel block sizes for leaf evaluation (see MathTree.tune_block)
+BLOCK_SIZES = (16, 32, 64, 128, 256, 512)
+
+## @var CALIBRATION_VOXELS
+# Approximate voxel count of the sample render used by MathTree.tune_block
+# (regions smaller than 16 samples aren't worth calibrating)
+CALIBRATION_VOXELS = 2**12
+
+## @var IDLE_PACKED
+# Maximum number of idle evaluation contexts kept by each MathTree
+# (see MathTree._give_packed); one per core, so that a full-width render
+# doesn't have to repack the tree
+IDLE_PACKED = multiprocessing.cpu_count()
 
 ################################################################################
 
@@ -52,7 +76,7 @@ class MathTree(object):
 
     def __init__(self, math, shape=False, color=None):
         """ @brief MathTree constructor
-            @param math Math string (in prefix notation)
+            @param math Math string (in prefix notation) or Expr
             @param shape Boolean modifying arithmetic operators
             @param color Color tuple or None
         """
@@ -61,6 +85,8 @@ class MathTree(object):
         # Math string (in sparse prefix syntax)
         if type(math) in [int, float]:
             self.math = 'f' + str(math)
+        elif isinstance(math, Expr):
+            self.expr = math
         else:
             self.math   = math
 
@@ -73,26 +99,108 @@ class MathTree(object):
         self.color  = color
 
         self._str   = None
-        self._ptr    = None
 
         ## @var bounds
         # X, Y, Z bounds (or None)
         self.bounds  = [None]*6
 
+        ## @var block
+        # Voxel block size for leaf evaluation (None to pick one
+        # automatically; see default_block and tune_block)
+        self.block  = None
+
+        ## @var _tuned
+        # Block size picked for renders by tune_block (or None)
+        self._tuned = None
+
+        ## @var busy
+        # Each thread's busy time (in seconds) during the last render
+        self.busy   = []
+
+        ## @var halted
+        # True if the last render was interrupted
+        self.halted = False
+
+        ## @var stats
+        # Profiling counters from the last render or ASDF built with
+        # stats=True (see Stats.combine), or None
+        self.stats  = None
+
         self.lock  = threading.Lock()
 
+        # Expression, packed template, and idle evaluation contexts
+        # forked from the template (see _take_packed)
+        self._packed = (None, None, [])
+        self._packed_lock = threading.Lock()
+
     @threadsafe
     def __del__(self):
         """ @brief MathTree destructor """
-        if self._ptr is not None and libfab is not None:
+        if libfab is None:  return
+        expr, template, idle = self._packed
+        for packed in idle:     libfab.free_packed(packed)
+        if template is not None:    libfab.free_packed(template)
+        if self._ptr is not None:
             libfab.free_tree(self.ptr)
 
+    def __getstate__(self):
+        """ @brief Returns the state used when pickling
+            @details The C tree pointer and lock are left out, so the tree is
+            re-parsed (lazily) on the other end.
+        """
+        return {'math': self.math, 'shape': self.shape,
+                'color': self.color, 'bounds': self.bounds,
+                'block': self.block, 'tuned': self._tuned}
+
+    def __setstate__(self, state):
+        """ @brief Restores a tree from its pickled state
+        """
+        self.__init__(state['math'], state['shape'], state['color'])
+        self.bounds = list(state['bounds'])
+        self.block  = state.get('block')
+        self._tuned = state.get('tuned')
+
+    @property
+    def math(self):
+        """ @brief Math string (serialized from the expression if necessary)
+        """
+        if self._math is None:
+            self._math = self._expr.math
+        return self._math
+    @math.setter
+    def math(self, value):
+        self._math = value
+        self._expr = Expr.raw(value)
+        self._ptr  = None
+
+    @property
+    def digest(self):
+        """ @brief Hex digest of the expression (see Expr.digest)
+        """
+        return self._expr.digest
+
+    @property
+    def expr(self):
+        """ @brief Expression graph (an Expr) representing this tree
+        """
+        return self._expr
+    @expr.setter
+    def expr(self, value):
+        self._math = value.text if value.op == '$' else None
+        self._expr = value
+        self._ptr  = None
+
     @property
     def ptr(self):
-        """ @brief Parses self.math and returns a pointer to a MathTree structure
+        """ @brief Builds the C tree and returns a pointer to a MathTree structure
+            @details Trees from a math string are parsed; trees built with
+            MathTree operators are constructed node-by-node from self.expr.
         """
         if self._ptr is None:
-            self._ptr = libfab.parse(self.math)
+            if self._expr.op == '$':
+                self._ptr = libfab.parse(self._expr.text)
+            else:
+                self._ptr = self._expr.build()
         return self._ptr
 
     ############################################################################
@@ -230,51 +338,51 @@ class MathTree(object):
 
     @classmethod
     @forcetree
-    def min(cls, A, B): return cls('i'+A.math+B.math)
+    def min(cls, A, B): return cls(Expr('i', A.expr, B.expr))
 
     @classmethod
     @forcetree
-    def max(cls, A, B): return cls('a'+A.math+B.math)
+    def max(cls, A, B): return cls(Expr('a', A.expr, B.expr))
 
     @classmethod
     @forcetree
-    def pow(cls, A, B): return cls('p'+A.math+B.math)
+    def pow(cls, A, B): return cls(Expr('p', A.expr, B.expr))
 
     @classmethod
     @forcetree
-    def sqrt(cls, A):   return cls('r'+A.math)
+    def sqrt(cls, A):   return cls(Expr('r', A.expr))
 
     @classmethod
     @forcetree
-    def abs(cls, A):    return cls('b'+A.math)
+    def abs(cls, A):    return cls(Expr('b', A.expr))
 
     @classmethod
     @forcetree
-    def square(cls, A): return cls('q'+A.math)
+    def square(cls, A): return cls(Expr('q', A.expr))
 
     @classmethod
     @forcetree
-    def sin(cls, A):    return cls('s'+A.math)
+    def sin(cls, A):    return cls(Expr('s', A.expr))
 
     @classmethod
     @forcetree
-    def cos(cls, A):    return cls('c'+A.math)
+    def cos(cls, A):    return cls(Expr('c', A.expr))
 
     @classmethod
     @forcetree
-    def tan(cls, A):    return cls('t'+A.math)
+    def tan(cls, A):    return cls(Expr('t', A.expr))
 
     @classmethod
     @forcetree
-    def asin(cls, A):   return cls('S'+A.math)
+    def asin(cls, A):   return cls(Expr('S', A.expr))
 
     @classmethod
     @forcetree
-    def acos(cls, A):   return cls('C'+A.math)
+    def acos(cls, A):   return cls(Expr('C', A.expr))
 
     @classmethod
     @forcetree
-    def atan(cls, A):   return cls('T'+A.math)
+    def atan(cls, A):   return cls(Expr('T', A.expr))
 
     #########################
     #  MathTree Arithmetic  #
@@ -289,7 +397,7 @@ class MathTree(object):
 
             if rhs is None: return self.clone()
 
-            t = MathTree('i'+self.math+rhs.math, True)
+            t = MathTree(Expr('i', self.expr, rhs.expr), True)
 
             if self.dx is not None and rhs.dx is not None:
                 t.xmin = min(self.xmin, rhs.xmin)
@@ -303,7 +411,7 @@ class MathTree(object):
 
             return t
         else:
-            return MathTree('+' + self.math + rhs.math)
+            return MathTree(Expr('+', self.expr, rhs.expr))
     @matching
     @forcetree
     def __radd__(self, lhs):
@@ -311,7 +419,7 @@ class MathTree(object):
 
         if self.shape or (lhs and lhs.shape):
 
-            t = MathTree('i'+lhs.math+self.math)
+            t = MathTree(Expr('i', lhs.expr, self.expr))
             if self.dx is not None and lhs.dx is not None:
                 t.xmin = min(self.xmin, lhs.xmin)
                 t.xmax = max(self.xmax, lhs.xmax)
@@ -323,7 +431,7 @@ class MathTree(object):
                 t.zmax = max(self.zmax, lhs.zmax)
             return t
         else:
-            return MathTree('+' + lhs.math + self.math)
+            return MathTree(Expr('+', lhs.expr, self.expr))
 
     @matching
     @forcetree
@@ -332,32 +440,32 @@ class MathTree(object):
 
             if rhs is None: return self.clone()
 
-            t = MathTree('a'+self.math+'n'+rhs.math, True)
+            t = MathTree(Expr('a', self.expr, Expr('n', rhs.expr)), True)
             for i in ['xmin','xmax','ymin','ymax','zmin','zmax']:
                 setattr(t, i, getattr(self, i))
             return t
         else:
-            return MathTree('-'+self.math+rhs.math)
+            return MathTree(Expr('-', self.expr, rhs.expr))
 
     @matching
     @forcetree
     def __rsub__(self, lhs):
         if self.shape or (lhs and lhs.shape):
 
-            if lhs is None: return MathTree('n' + self.math)
+            if lhs is None: return MathTree(Expr('n', self.expr))
 
-            t = MathTree('a'+lhs.math+'n'+self.math, True)
+            t = MathTree(Expr('a', lhs.expr, Expr('n', self.expr)), True)
             for i in ['xmin','xmax','ymin','ymax','zmin','zmax']:
                 setattr(t, i, getattr(lhs, i))
             return t
         else:
-            return MathTree('-'+lhs.math+self.math)
+            return MathTree(Expr('-', lhs.expr, self.expr))
 
     @matching
     @forcetree
     def __and__(self, rhs):
         if self.shape or rhs.shape:
-            t = MathTree('a' + self.math + rhs.math, True)
+            t = MathTree(Expr('a', self.expr, rhs.expr), True)
             if self.dx is not None and rhs.dx is not None:
                 t.xmin = max(self.xmin, rhs.xmin)
                 t.xmax = min(self.xmax, rhs.xmax)
@@ -376,7 +484,7 @@ class MathTree(object):
     @forcetree
     def __rand__(self, lhs):
         if self.shape or lhs.shape:
-            t = MathTree('a' + lhs.math + self.math, True)
+            t = MathTree(Expr('a', lhs.expr, self.expr), True)
             if self.dx is not None and lhs.dx is not None:
                 t.xmin = max(self.xmin, lhs.xmin)
                 t.xmax = min(self.xmax, lhs.xmax)
@@ -396,7 +504,7 @@ class MathTree(object):
     @forcetree
     def __or__(self, rhs):
         if self.shape or rhs.shape:
-            t = MathTree('i' + self.math + rhs.math, True)
+            t = MathTree(Expr('i', self.expr, rhs.expr), True)
             if self.dx is not None and rhs.dx is not None:
                 t.xmin = min(self.xmin, rhs.xmin)
                 t.xmax = max(self.xmax, rhs.xmax)
@@ -416,7 +524,7 @@ class MathTree(object):
     @forcetree
     def __ror__(self, lhs):
         if self.shape or lhs.shape:
-            t = MathTree('i' + lhs.math + self.math, True)
+            t = MathTree(Expr('i', lhs.expr, self.expr), True)
             if self.dx is not None and lhs.dx is not None:
                 t.xmin = min(self.xmin, lhs.xmin)
                 t.xmax = max(self.xmax, lhs.xmax)
@@ -433,23 +541,23 @@ class MathTree(object):
 
     @forcetree
     def __mul__(self, rhs):
-        return MathTree('*' + self.math + rhs.math)
+        return MathTree(Expr('*', self.expr, rhs.expr))
 
     @forcetree
     def __rmul__(self, lhs):
-        return MathTree('*' + lhs.math + self.math)
+        return MathTree(Expr('*', lhs.expr, self.expr))
 
     @forcetree
     def __div__(self, rhs):
-        return MathTree('/' + self.math + rhs.math)
+        return MathTree(Expr('/', self.expr, rhs.expr))
 
     @forcetree
     def __rdiv__(self, lhs):
-        return MathTree('/' + lhs.math + self.math)
+        return MathTree(Expr('/', lhs.expr, self.expr))
 
     @forcetree
     def __neg__(self):
-        return MathTree('n' + self.math, shape=self.shape)
+        return MathTree(Expr('n', self.expr), shape=self.shape)
 
 
     ###############################
@@ -505,8 +613,21 @@ class MathTree(object):
 
     @property
     def node_count(self):
+        """ @brief Number of nodes in the parsed (and simplified) tree
+        """
         return libfab.count_nodes(self.ptr)
 
+    @property
+    def raw_node_count(self):
+        """ @brief Number of nodes the tree would have without simplification
+            @details Builds the tree again (without simplification),
+            so this is as slow as the original build.
+        """
+        ptr = self.expr.build(simplify=False)
+        count = libfab.count_nodes(ptr)
+        libfab.free_tree(ptr)
+        return count
+
     #################################
     ## Tree manipulation functions ##
     #################################
@@ -517,12 +638,11 @@ class MathTree(object):
             @param Y New Y function or None
             @param Z New Z function or None
         """
-        return MathTree('m'+
-                           (X.math if X else ' ')+
-                           (Y.math if Y else ' ')+
-                           (Z.math if Z else ' ')+
-                           self.math,
-                      shape=self.shape, color=self.color)
+        return MathTree(Expr.map(self.expr,
+                                 X.expr if X else None,
+                                 Y.expr if Y else None,
+                                 Z.expr if Z else None),
+                        shape=self.shape, color=self.color)
 
     @forcetree
     def map_bounds(self, X=None, Y=None, Z=None):
@@ -574,27 +694,299 @@ class MathTree(object):
 
     @threadsafe
     def clone(self):
-        m = MathTree(self.math, shape=self.shape, color=self.color)
+        m = MathTree(self.expr, shape=self.shape, color=self.color)
+        m._math  = self._math
         m.bounds = [b for b in self.bounds]
+        m.block  = self.block
+        m._tuned = self._tuned
         if self._ptr is not None:
             m._ptr = libfab.clone_tree(self._ptr)
         return m
 
+    def _take_packed(self, count, block=None, affine=False):
+        """ @brief Borrows evaluation contexts for this tree (one per thread)
+            @details The tree is packed once into a template, and each
+            thread gets a context forked from it (which shares nothing
+            with the other threads' contexts, but doesn't need a clone of
+            the tree).  Hand contexts back with _give_packed, which keeps
+            up to IDLE_PACKED of them for later calls.
+            @param count Number of contexts
+            @param block Voxel block size for leaf evaluation (or None)
+            @param affine Boolean determining whether to find bounds with affine arithmetic
+            @returns List of packed trees
+        """
+        with self._packed_lock:
+            expr, template, idle = self._packed
+            if expr is not self._expr:
+                for p in idle:  libfab.free_packed(p)
+                if template is not None:    libfab.free_packed(template)
+                template, idle = libfab.make_packed(self.ptr), []
+                self._packed = (self._expr, template, idle)
+
+            taken = idle[:count]
+            del idle[:count]
+            taken += [libfab.fork_packed(template)
+                      for i in range(count - len(taken))]
+
+        for p in taken:
+            if block is not None:   libfab.set_block_size(p, block)
+            libfab.set_affine(p, affine)
+        return taken
+
+    def _attach_stats(self, taken):
+        """ @brief Attaches a fresh Stats structure to each packed tree
+            @returns List of Stats structures (pass to _give_packed)
+        """
+        counters = [Stats() for p in taken]
+        for p, c in zip(taken, counters):   libfab.set_stats(p, c)
+        return counters
+
+    def _give_packed(self, taken, counters=None):
+        """ @brief Returns contexts from _take_packed for reuse
+            @param taken List of packed trees
+            @param counters Stats structures from _attach_stats (if any),
+            which are detached and combined into self.stats
+        """
+        if counters is not None:
+            for p in taken:     libfab.set_stats(p, None)
+            self.stats = Stats.combine(counters)
+
+        with self._packed_lock:
+            expr, template, idle = self._packed
+            if expr is self._expr:
+                keep = max(0, IDLE_PACKED - len(idle))
+                idle += taken[:keep]
+                taken = taken[keep:]
+        for p in taken:     libfab.free_packed(p)
+
+    #################################
+    #    Evaluation functions       #
+    #################################
+
+    def eval_points(self, xyz, threads=8, interrupt=None):
+        """ @brief Evaluates a math tree at many points
+            @details Points are evaluated in C (in chunks, with eval_r) and
+            split between multiple threads.
+            @param xyz NumPy array of points with shape (N, 3)
+            @param threads Number of threads to use
+            @param interrupt threading.Event that aborts evaluation if set
+            @returns NumPy float32 array of N results
+        """
+        xyz = np.asarray(xyz, dtype=np.float32)
+        if xyz.ndim != 2 or xyz.shape[1] != 3:
+            raise ValueError('Points must be an array with shape (N, 3)')
+
+        X, Y, Z = [np.ascontiguousarray(xyz[:,i]) for i in range(3)]
+        out = np.empty(len(xyz), dtype=np.float32)
+
+        def evaluate(packed, start, count, halt):
+            libfab.eval_points(
+                packed, _offset(X, start, ctypes.c_float),
+                _offset(Y, start, ctypes.c_float),
+                _offset(Z, start, ctypes.c_float),
+                _offset(out, start, ctypes.c_float), count, halt
+            )
+        self._eval_threads(evaluate, len(xyz), threads, interrupt)
+
+        return out
+
+
+    def gradient_points(self, xyz, threads=8, interrupt=None):
+        """ @brief Evaluates a math tree and its gradient at many points
+            @details Partial derivatives are found exactly (with forward-mode
+            automatic differentiation in C) rather than by sampling nearby
+            points.
+            @param xyz NumPy array of points with shape (N, 3)
+            @param threads Number of threads to use
+            @param interrupt threading.Event that aborts evaluation if set
+            @returns NumPy float32 array with shape (N, 4), where each row is
+            [value, d/dx, d/dy, d/dz]
+        """
+        xyz = np.asarray(xyz, dtype=np.float32)
+        if xyz.ndim != 2 or xyz.shape[1] != 3:
+            raise ValueError('Points must be an array with shape (N, 3)')
+
+        X, Y, Z = [np.ascontiguousarray(xyz[:,i]) for i in range(3)]
+        out = np.empty((len(xyz), 4), dtype=np.float32)
+
+        def evaluate(packed, start, count, halt):
+            libfab.eval_gradients(
+                packed, _offset(X, start, ctypes.c_float),
+                _offset(Y, start, ctypes.c_float),
+                _offset(Z, start, ctypes.c_float),
+                _offset(out, start, ctypes.c_float*4), count, halt
+            )
+        self._eval_threads(evaluate, len(xyz), threads, interrupt)
+
+        return out
+
+
+    def eval_intervals(self, boxes, threads=8, interrupt=None):
+        """ @brief Evaluates a math tree over many boxes with interval arithmetic
+            @param boxes NumPy array with shape (N, 3, 2), where each box is
+            [[xmin, xmax], [ymin, ymax], [zmin, zmax]]
+            @param threads Number of threads to use
+            @param interrupt threading.Event that aborts evaluation if set
+            @returns NumPy float32 array with shape (N, 2) of [lower, upper] results
+        """
+        boxes = np.ascontiguousarray(boxes, dtype=np.float32)
+        if boxes.ndim != 3 or boxes.shape[1:] != (3, 2):
+            raise ValueError('Boxes must be an array with shape (N, 3, 2)')
+
+        out = np.empty((len(boxes), 2), dtype=np.float32)
+
+        def evaluate(packed, start, count, halt):
+            libfab.eval_intervals(
+                packed, _offset(boxes, start, Interval*3),
+                _offset(out, start, Interval), count, halt
+            )
+        self._eval_threads(evaluate, len(boxes), threads, interrupt)
+
+        return out
+
+
+    def _eval_threads(self, target, count, threads, interrupt):
+        """ @brief Splits an evaluation task between multiple threads
+            @param target Function called with (packed tree, start, count, halt)
+            @param count Number of items to evaluate
+            @param threads Maximum number of threads to use
+            @param interrupt threading.Event that aborts evaluation if set
+        """
+        if count == 0:  return
+
+        if interrupt is None:   interrupt = threading.Event()
+        halt = ctypes.c_int(0)  # flag to abort evaluation
+
+        # Small jobs aren't worth the cost of cloning the tree many times
+        threads = max(1, min(threads, count / 4096))
+        step = (count + threads - 1) / threads
+
+        taken = self._take_packed(threads)
+
+        args = [(p, start, min(step, count - start), halt)
+                for p, start in zip(taken, range(0, count, step))]
+        multithread(target, args, interrupt, halt)
+
+        self._give_packed(taken)
+
     #################################
     #    Rendering functions        #
     #################################
 
+    @property
+    def default_block(self):
+        """ @brief Voxel block size picked from the tree's node count
+            @details Small trees prefer large blocks and large trees prefer
+            small ones.  Unlike tune_block, this is deterministic, so it's
+            used wherever the block size changes the output (e.g. ASDFs).
+            @returns Block size (in voxels)
+        """
+        if self.block is not None:  return self.block
+
+        nodes = self.node_count
+        if   nodes < 32:    return 256
+        elif nodes < 512:   return 128
+        elif nodes < 8192:  return 64
+        else:               return 32
+
+
+    def tune_block(self, region=None):
+        """ @brief Picks a voxel block size for rendering
+            @details Regions with fewer voxels than the block size are
+            evaluated point-by-point rather than subdivided.  The
+            default_block guess and its neighbours in BLOCK_SIZES are timed
+            on a small window of the region (if it is large enough to be
+            worth the effort).  Timing is noisy, so the result is only
+            used for renders, whose output doesn't depend on the block
+            size; it is cached in self._tuned.
+            @param region Evaluation region (if None, the guess is used)
+            @returns Block size (in voxels)
+        """
+        if self.block is not None:  return self.block
+        if self._tuned is not None: return self._tuned
+
+        guess = self.default_block
+        sample = self._calibration_region(region)
+        if sample is None:
+            return guess
+
+        i = BLOCK_SIZES.index(guess)
+        candidates = BLOCK_SIZES[max(0, i-1):i+2]
+
+        packed, = self._take_packed(1)
+        halt = ctypes.c_int(0)
+
+        times = {}
+        for block in candidates:
+            libfab.set_block_size(packed, block)
+            image = Image(sample.ni, sample.nj, channels=1, depth=16)
+            start = time.time()
+            libfab.render16(packed, sample, image.pixels, halt)
+            times[block] = time.time() - start
+        self._give_packed([packed])
+
+        self._tuned = min(candidates, key=lambda b: times[b])
+        return self._tuned
+
+
+    @staticmethod
+    def _calibration_region(region):
+        """ @brief Picks a window in the middle of a region for tune_block
+            @details The window keeps the region's resolution (so that
+            interval pruning behaves as it would in the full render) and
+            has about CALIBRATION_VOXELS voxels.
+            @param region Evaluation region
+            @returns Region, or None if the region is too small to bother
+        """
+        if region is None or region.voxels < 16*CALIBRATION_VOXELS:
+            return None
+
+        ticks  = [region.X, region.Y, region.Z]
+        counts = [region.ni, region.nj, region.nk]
+        axes = [a for a in range(3) if counts[a] > 1]
+        side = int(round(CALIBRATION_VOXELS**(1./len(axes))))
+
+        # Flat axes stay flat
+        lower = [ticks[a][0] for a in range(3)]
+        upper = [ticks[a][0] for a in range(3)]
+        scales = []
+        for a in axes:
+            n = min(side, counts[a])
+            start = (counts[a] - n) / 2
+            lower[a] = ticks[a][start]
+            upper[a] = ticks[a][start + n]
+            scales.append(n / (upper[a] - lower[a]))
+
+        # Keep the region's resolution, averaged over the window's axes
+        scale = sum(scales) / len(scales)
+
+        return Region(lower, upper, scale)
+
+
     def render(self, region=None, resolution=None, mm_per_unit=None,
-               threads=8, interrupt=None):
+               threads=None, interrupt=None, block=None, affine=False,
+               depth=16, stats=False):
         """ @brief Renders a math tree into an Image
+            @details Threads share work through libfab's work-stealing
+            scheduler; each thread's busy time is stored in self.busy,
+            and self.halted records whether it was interrupted.
+            With depth='f', the image stores the height of each filled
+            pixel in mm (or NaN for empty pixels) rather than a 16-bit level.
             @param region Evaluation region (if None, taken from expression bounds)
             @param resolution Render resolution in voxels/unit
             @param mm_per_unit Real-world scale
-            @param threads Number of threads to use
+            @param threads Number of threads to use (if None, one per core)
             @param interrupt threading.Event that aborts rendering if set
+            @param block Voxel block size for leaf evaluation (if None, picked by tune_block)
+            @param affine Boolean determining whether to find bounds with affine arithmetic (tighter on rotated or sheared shapes, but slower per cell)
+            @param depth Image depth (16 or 'f')
+            @param stats Boolean determining whether libfab's profiling counters are stored in self.stats
             @returns Image data structure
         """
 
+        if depth not in (16, 'f'):
+            raise ValueError("Invalid render depth (must be 16 or 'f')")
+
         if region is None:
             if self.dx is None or self.dy is None:
                 raise Exception('Unknown render region!')
@@ -608,27 +1000,39 @@ class MathTree(object):
 
         try:
             float(mm_per_unit)
-        except ValueError, TypeError:
+        except (ValueError, TypeError):
             raise ValueError('mm_per_unit must be a number')
 
         if interrupt is None:   interrupt = threading.Event()
         halt = ctypes.c_int(0)  # flag to abort render
         image = Image(
-            region.ni, region.nj, channels=1, depth=16,
+            region.ni, region.nj, channels=1, depth=depth,
         )
+        if depth == 'f':    image.array.fill(np.nan)
+
+        if block is None:   block = self.tune_block(region)
+        if threads is None: threads = multiprocessing.cpu_count()
+
+        # Get a packed tree for each thread
+        taken = self._take_packed(threads, block, affine)
+        packed = (PackedTreeP*threads)(*taken)
+        counters = self._attach_stats(taken) if stats else None
+
+        # Render the region, with threads sharing work in libfab
+        busy = (ctypes.c_double*threads)()
+        if depth == 'f':
+            multithread(libfab.renderf_parallel,
+                        [(packed, threads, region, mm_per_unit,
+                          image.pixels, halt, busy)],
+                        interrupt, halt)
+        else:
+            multithread(libfab.render16_parallel,
+                        [(packed, threads, region, image.pixels, halt, busy)],
+                        interrupt, halt)
 
-        # Divide the task to share among multiple threads
-        clones = [self.clone() for i in range(threads)]
-        packed = [libfab.make_packed(c.ptr) for c in clones]
-
-        subregions = region.split_xy(threads)
-
-        # Solve each region in a separate thread
-        args = zip(packed, subregions, [image.pixels]*threads, [halt]*threads)
-
-        multithread(libfab.render16, args, interrupt, halt)
-
-        for p in packed:    libfab.free_packed(p)
+        self._give_packed(taken, counters)
+        self.busy = list(busy)
+        self.halted = bool(halt.value)
 
         image.xmin = region.X[0]*mm_per_unit
         image.xmax = region.X[region.ni]*mm_per_unit
@@ -640,15 +1044,280 @@ class MathTree(object):
         return image
 
 
+    def render_shaded(self, resolution=10, alpha=0, beta=0, region=None,
+                      mm_per_unit=1, threads=None, interrupt=None):
+        """ @brief Renders a shaded 3D view of the tree
+            @details Rays are traced through the tree directly (using
+            interval bounds to skip empty space), so this is a quick preview
+            that doesn't need an ASDF or mesh.  As in render, threads share
+            work through libfab's work-stealing scheduler.
+            @param resolution Render resolution in voxels/unit
+            @param alpha Rotation about Z axis (degrees)
+            @param beta Rotation about X axis (degrees)
+            @param region Render region in the view frame (if None, the rotated expression bounds)
+            @param mm_per_unit Real-world scale
+            @param threads Number of threads to use (if None, one per core)
+            @param interrupt threading.Event that aborts rendering if set
+            @returns A tuple with a height-map, shaded image, and image with colored normals
+        """
+        M = (ctypes.c_float*4)(math.cos(math.radians(alpha)),
+                               math.sin(math.radians(alpha)),
+                               math.cos(math.radians(beta)),
+                               math.sin(math.radians(beta)))
+
+        if region is None:
+            if not self.bounded:
+                raise Exception('Unknown render region!')
+            corners = [libfab.project(Vec3f(
+                            self.xmax if (i & 4) else self.xmin,
+                            self.ymax if (i & 2) else self.ymin,
+                            self.zmax if (i & 1) else self.zmin), M)
+                       for i in range(8)]
+            region = Region(
+                (min(c.x for c in corners), min(c.y for c in corners),
+                 min(c.z for c in corners)),
+                (max(c.x for c in corners), max(c.y for c in corners),
+                 max(c.z for c in corners)),
+                resolution
+            )
+
+        if interrupt is None:   interrupt = threading.Event()
+        halt = ctypes.c_int(0)  # flag to abort render
+
+        depth   = Image(region.ni, region.nj, channels=1, depth=16)
+        shaded  = Image(region.ni, region.nj, channels=1, depth=16)
+        normals = Image(region.ni, region.nj, channels=3, depth=8)
+
+        if threads is None: threads = multiprocessing.cpu_count()
+        block = self.tune_block(region)
+
+        # Get a packed tree for each thread
+        taken = self._take_packed(threads, block)
+        packed = (PackedTreeP*threads)(*taken)
+
+        # Trace the region, with threads sharing work in libfab
+        busy = (ctypes.c_double*threads)()
+        multithread(libfab.trace_shaded_parallel,
+                    [(packed, threads, region, M, depth.pixels,
+                      shaded.pixels, normals.pixels, halt, busy)],
+                    interrupt, halt)
+        self._give_packed(taken)
+        self.busy = list(busy)
+        self.halted = bool(halt.value)
+
+        for image in [depth, shaded, normals]:
+            image.xmin = region.X[0]*mm_per_unit
+            image.xmax = region.X[region.ni]*mm_per_unit
+            image.ymin = region.Y[0]*mm_per_unit
+            image.ymax = region.Y[region.nj]*mm_per_unit
+            image.zmin = region.Z[0]*mm_per_unit
+            image.zmax = region.Z[region.nk]*mm_per_unit
+        return depth, shaded, normals
+
+
+    @classmethod
+    def render_shapes(cls, shapes, regions, mm_per_unit=None,
+                      interrupt=None, threads=None, affine=False):
+        """ @brief Renders a set of math trees in a pool of worker processes
+            @details Each render is split into parts, which are spread across
+            worker processes; workers write directly into Images backed by
+            shared memory.  Falls back to MathTree.render if worker processes
+            aren't available.
+            @param shapes List of MathTrees
+            @param regions List of evaluation regions (one per shape)
+            @param mm_per_unit Real-world scale
+            @param interrupt threading.Event that aborts rendering if set
+            @param threads Number of threads to use if falling back to MathTree.render
+            @param affine Boolean determining whether to find bounds with affine arithmetic
+            @returns List of Images
+        """
+        if not multiprocess.available():
+            return [s.render(r, mm_per_unit=mm_per_unit, interrupt=interrupt,
+                             threads=threads, affine=affine)
+                    for s, r in zip(shapes, regions)]
+
+        try:
+            float(mm_per_unit)
+        except (ValueError, TypeError):
+            raise ValueError('mm_per_unit must be a number')
+
+        if interrupt is None:   interrupt = threading.Event()
+        halt = multiprocess.SharedFlag()  # flag to abort render
+
+        # Tune block sizes here, so that workers don't each repeat the work
+        for s, r in zip(shapes, regions):
+            s.tune_block(r)
+
+        images = [Image(r.ni, r.nj, channels=1, depth=16, shared=True)
+                  for r in regions]
+
+        # Split each region into a number of parts proportional to its size,
+        # aiming for a few parts per worker process.
+        parts = 2*multiprocessing.cpu_count()
+        total = float(sum(r.voxels for r in regions)) or 1
+        args = []
+        for s, r, image in zip(shapes, regions, images):
+            count = max(1, int(round(parts*r.voxels/total)))
+            args += [(s, r, i, count, image, halt, affine)
+                     for i in range(count)]
+
+        multiprocess.multiprocess(_render_part, args, interrupt, halt)
+
+        for image, region in zip(images, regions):
+            image.xmin = region.X[0]*mm_per_unit
+            image.xmax = region.X[region.ni]*mm_per_unit
+            image.ymin = region.Y[0]*mm_per_unit
+            image.ymax = region.Y[region.nj]*mm_per_unit
+            image.zmin = region.Z[0]*mm_per_unit
+            image.zmax = region.Z[region.nk]*mm_per_unit
+
+        return images
+
+
+    @classmethod
+    def render_batches(cls, shapes, batches, mm_per_unit=None,
+                       interrupt=None, threads=None, affine=False,
+                       stats=False):
+        """ @brief Renders many small regions of a set of math trees
+            @details Each shape's regions are split into a few batches,
+            which are spread across worker processes; a worker packs its
+            shape once for the whole batch (rather than once per region).
+            Falls back to MathTree.render if worker processes aren't available.
+            With stats=True, the workers' profiling counters are summed
+            into each shape's stats attribute.
+            @param shapes List of MathTrees
+            @param batches List of lists of evaluation regions (one list per shape)
+            @param mm_per_unit Real-world scale
+            @param interrupt threading.Event that aborts rendering if set
+            @param threads Number of threads to use if falling back to MathTree.render
+            @param affine Boolean determining whether to find bounds with affine arithmetic
+            @param stats Boolean determining whether libfab's profiling counters are stored in each shape's stats attribute
+            @returns List of lists of Images (one list per shape), or None if interrupted
+        """
+        if not multiprocess.available():
+            images = []
+            for s, rs in zip(shapes, batches):
+                images.append([])
+                counters = []
+                for r in rs:
+                    images[-1].append(s.render(
+                        r, mm_per_unit=mm_per_unit, interrupt=interrupt,
+                        threads=threads, affine=affine, stats=stats))
+                    if s.halted:    return None
+                    counters.append(s.stats)
+                if stats:   s.stats = Stats.merge(counters)
+            return images
+
+        try:
+            float(mm_per_unit)
+        except (ValueError, TypeError):
+            raise ValueError('mm_per_unit must be a number')
+
+        if interrupt is None:   interrupt = threading.Event()
+        halt = multiprocess.SharedFlag()  # flag to abort render
+
+        for s, rs in zip(shapes, batches):
+            if rs:  s.tune_block(rs[0])
+
+        images = [[Image(r.ni, r.nj, channels=1, depth=16, shared=True)
+                   for r in rs] for rs in batches]
+
+        # Split each shape's regions into a number of batches proportional
+        # to their size, aiming for a few batches per worker process.
+        parts = 2*multiprocessing.cpu_count()
+        total = float(sum(r.voxels for rs in batches for r in rs)) or 1
+        args, owners = [], []
+        for n, (s, rs, imgs) in enumerate(zip(shapes, batches, images)):
+            if not rs:  continue
+            voxels = sum(r.voxels for r in rs)
+            count = min(len(rs), max(1, int(round(parts*voxels/total))))
+            args += [(s, rs[i::count], imgs[i::count], halt, affine, stats)
+                     for i in range(count)]
+            owners += [n]*count
+
+        counters = multiprocess.multiprocess(_render_batch, args,
+                                             interrupt, halt)
+        if halt.value:  return None
+
+        if stats:
+            for n, s in enumerate(shapes):
+                s.stats = Stats.merge([c for c, o in zip(counters, owners)
+                                       if o == n])
+
+        for rs, imgs in zip(batches, images):
+            for region, image in zip(rs, imgs):
+                image.xmin = region.X[0]*mm_per_unit
+                image.xmax = region.X[region.ni]*mm_per_unit
+                image.ymin = region.Y[0]*mm_per_unit
+                image.ymax = region.Y[region.nj]*mm_per_unit
+                image.zmin = region.Z[0]*mm_per_unit
+                image.zmax = region.Z[region.nk]*mm_per_unit
+
+        return images
+
+
+    def bounds_stats(self, region=None, resolution=None):
+        """ @brief Compares interval and affine arithmetic on a render
+            @details Renders the tree in a single thread with each bounds
+            evaluator, counting cells that were checked and cells that
+            were found to be entirely filled or empty (and so weren't
+            subdivided further).
+            @param region Evaluation region (if None, taken from expression bounds)
+            @param resolution Render resolution in voxels/unit
+            @returns Dictionary mapping 'interval' and 'affine' to
+            dictionaries with 'cells', 'pruned', and 'time' entries
+        """
+        if region is None:
+            if self.dx is None or self.dy is None:
+                raise Exception('Unknown render region!')
+            elif resolution is None:
+                raise Exception('Region or resolution must be provided!')
+            region = Region(
+                (self.xmin, self.ymin, self.zmin if self.zmin else 0),
+                (self.xmax, self.ymax, self.zmax if self.zmax else 0),
+                resolution
+            )
+        block = self.tune_block(region)
+
+        halt = ctypes.c_int(0)
+        stats = {}
+        for mode in ('interval', 'affine'):
+            packed = libfab.make_packed(self.ptr)
+            libfab.set_block_size(packed, block)
+            libfab.set_affine(packed, mode == 'affine')
+            counters = Stats()
+            libfab.set_stats(packed, counters)
+
+            image = Image(region.ni, region.nj, channels=1, depth=16)
+            start = time.time()
+            libfab.render16(packed, region, image.pixels, halt)
+            dt = time.time() - start
+
+            libfab.set_stats(packed, None)
+            libfab.free_packed(packed)
+
+            stats[mode] = {'cells': counters.regions,
+                           'pruned': counters.filled + counters.empty,
+                           'time': dt}
+        return stats
+
+
     def asdf(self, region=None, resolution=None, mm_per_unit=None,
-             merge_leafs=True, interrupt=None):
+             merge_leafs=True, interrupt=None, block=None, affine=False,
+             stats=False, threads=None):
         """ @brief Constructs an ASDF from a math tree.
-            @details Runs in up to eight threads.
+            @details Threads share work through libfab's work-stealing
+            scheduler at every level of the octree; each thread's busy
+            time is stored in self.busy.
             @param region Evaluation region (if None, taken from expression bounds)
             @param resolution Render resolution in voxels/unit
             @param mm_per_unit Real-world scale
             @param merge_leafs Boolean determining whether leaf cells are combined
             @param interrupt threading.Event that aborts rendering if set
+            @param block Voxel block size for leaf evaluation (if None, default_block).  This changes where leaf cells are built from sampled lattices, so the ASDF's structure depends on it; it's never picked by timing.
+            @param affine Boolean determining whether to find bounds with affine arithmetic
+            @param stats Boolean determining whether libfab's profiling counters are stored in self.stats
+            @param threads Number of threads to use (if None, one per core)
             @returns ASDF data structure
         """
 
@@ -668,47 +1337,27 @@ class MathTree(object):
         # Shared flag to interrupt rendering
         halt = ctypes.c_int(0)
 
-        # Split the region into up to 8 sections
-        split = region.octsect(all=True)
-        subregions = [split[i] for i in range(8) if split[i] is not None]
-        ids = [i for i in range(8) if split[i] is not None]
+        if block is None:   block = self.default_block
+        if threads is None: threads = multiprocessing.cpu_count()
 
-        threads = len(subregions)
-        clones  = [self.clone() for i in range(threads)]
-        packed  = [libfab.make_packed(c.ptr) for c in clones]
+        # Get a packed tree for each thread
+        taken = self._take_packed(threads, block, affine)
+        packed = (PackedTreeP*threads)(*taken)
+        counters = self._attach_stats(taken) if stats else None
 
-        # Generate a root for the tree
-        asdf = ASDF(libfab.asdf_root(packed[0], region), color=self.color)
-        asdf.lock.acquire()
+        # Build the tree, with threads sharing work in libfab
+        busy = (ctypes.c_double*threads)()
+        ptr = monothread(libfab.build_asdf_parallel,
+                         (packed, threads, region, merge_leafs, halt, busy),
+                         interrupt, halt)
 
-        # Multithread the solver process
-        q = Queue.Queue()
-        args = zip(packed, ids, subregions, [q]*threads)
+        self._give_packed(taken, counters)
+        self.busy = list(busy)
 
-        # Helper function to construct a single branch
-        def construct_branch(ptree, id, region, queue):
-            asdf = libfab.build_asdf(ptree, region, merge_leafs, halt)
-            queue.put((id, asdf))
-
-        # Run the constructor in parallel to make the branches
-        multithread(construct_branch, args, interrupt, halt)
-        for p in packed:    libfab.free_packed(p)
-
-        # Attach the branches to the root
-        for s in subregions:
-            try:                id, branch = q.get_nowait()
-            except Queue.Empty: break
-            else:
-                # Make sure we didn't get a NULL pointer back
-                # (which could occur if the halt flag was raised)
-                try: branch.contents
-                except ValueError:
-                    asdf.lock.release()
-                    return None
-                asdf.ptr.contents.branches[id] = branch
-        libfab.get_d_from_children(asdf.ptr)
-        libfab.simplify(asdf.ptr, merge_leafs)
-        asdf.lock.release()
+        # Make sure we didn't get a NULL pointer back
+        # (which could occur if the halt flag was raised)
+        if not ptr:     return None
+        asdf = ASDF(ptr, color=self.color)
 
         # Set a scale on the ASDF if one was provided
         if mm_per_unit is not None:     asdf.rescale(mm_per_unit)
@@ -719,7 +1368,7 @@ class MathTree(object):
     def triangulate(self, region=None, resolution=None,
                     mm_per_unit=None, merge_leafs=True, interrupt=None):
         """ @brief Triangulates a math tree (via ASDF)
-            @details Runs in up to eight threads
+            @details Builds the ASDF with one thread per core
             @param region Evaluation region (if not, taken from expression)
             @param resolution Render resolution in voxels/unit
             @param mm_per_unit Real-world scale
@@ -731,6 +1380,52 @@ class MathTree(object):
         return asdf.triangulate()
 
 
+    @classmethod
+    def triangulate_shapes(cls, shapes, regions, mm_per_unit=None,
+                           merge_leafs=True, use_cms=False, interrupt=None):
+        """ @brief Triangulates a set of math trees in a pool of worker processes
+            @details Each shape is handled by a separate worker process, which
+            passes its mesh back through a temporary file.  Falls back to
+            MathTree.asdf if worker processes aren't available.
+            @param shapes List of MathTrees
+            @param regions List of evaluation regions (one per shape)
+            @param mm_per_unit Real-world scale
+            @param merge_leafs Boolean determining whether leaf cells are combined
+            @param use_cms Boolean determining whether to use watertight meshing
+            @param interrupt threading.Event that aborts rendering if set
+            @returns List of Meshes (or None for shapes that were aborted)
+        """
+        if not multiprocess.available():
+            meshes = []
+            for s, r in zip(shapes, regions):
+                asdf = s.asdf(region=r, mm_per_unit=mm_per_unit,
+                              merge_leafs=merge_leafs, interrupt=interrupt)
+                if asdf is None:    meshes.append(None)
+                elif use_cms:       meshes.append(asdf.triangulate_cms())
+                else:   meshes.append(asdf.triangulate(interrupt=interrupt))
+            return meshes
+
+        if interrupt is None:   interrupt = threading.Event()
+        halt = multiprocess.SharedFlag()  # flag to abort render
+
+        args = [(s, r, mm_per_unit, merge_leafs, use_cms, halt)
+                for s, r in zip(shapes, regions)]
+        filenames = multiprocess.multiprocess(
+            _triangulate_shape, args, interrupt, halt
+        )
+
+        meshes = []
+        for s, f in zip(shapes, filenames):
+            if f is None:
+                meshes.append(None)
+                continue
+            mesh = Mesh.load(f)
+            mesh.color = s.color
+            os.remove(f)
+            meshes.append(mesh)
+        return meshes
+
+
     @staticmethod
     def Constant(f):   return MathTree('f%g' % f)
 
@@ -743,6 +1438,108 @@ class MathTree(object):
     @staticmethod
     def Z():    return MathTree('Z')
 
+################################################################################
+
+def _offset(array, index, ctype):
+    """ @brief Returns a pointer to a row of a contiguous NumPy array
+        @param array NumPy array
+        @param index Row index
+        @param ctype Type of each row
+    """
+    return ctypes.cast(array.ctypes.data + index*array.strides[0],
+                       ctypes.POINTER(ctype))
+
+
+## @var WORKER_TREES
+# Number of trees kept (with their packed contexts) by each worker process
+WORKER_TREES = 8
+
+_worker_trees = collections.OrderedDict()
+
+def _worker_tree(tree):
+    """ @brief Finds this worker process's copy of a tree
+        @details Trees arrive in worker processes as freshly unpickled
+        copies, so each would be parsed and packed again; instead, the
+        first copy of each expression is kept (with the evaluation
+        contexts that it has packed) and returned for later copies.
+        @param tree MathTree received by a worker process
+        @returns A MathTree with the same expression
+    """
+    kept = _worker_trees.pop(tree.math, tree)
+    _worker_trees[tree.math] = kept
+    while len(_worker_trees) > WORKER_TREES:
+        _worker_trees.popitem(last=False)
+    return kept
+
+
+def _render_part(tree, region, index, count, image, halt, affine=False):
+    """ @brief Renders one part of a region into a shared Image
+        @details Called in a worker process by MathTree.render_shapes
+        @param tree MathTree to render
+        @param region Full render region
+        @param index Index of the part to render
+        @param count Number of parts into which the region is split
+        @param image Image (backed by shared memory) to fill
+        @param halt SharedFlag used to abort rendering
+        @param affine Boolean determining whether to find bounds with affine arithmetic
+    """
+    subregions = region.split_xy(count)
+    if index >= len(subregions):    return
+
+    kept = _worker_tree(tree)
+    taken = kept._take_packed(1, tree.block or tree._tuned, affine)
+    libfab.render16(taken[0], subregions[index], image.pixels, halt.c_int)
+    kept._give_packed(taken)
+
+
+def _render_batch(tree, regions, images, halt, affine=False, stats=False):
+    """ @brief Renders a list of regions into shared Images
+        @details Called in a worker process by MathTree.render_batches
+        @param tree MathTree to render
+        @param regions List of render regions
+        @param images List of Images (backed by shared memory) to fill
+        @param halt SharedFlag used to abort rendering
+        @param affine Boolean determining whether to find bounds with affine arithmetic
+        @param stats Boolean determining whether libfab's profiling counters are recorded
+        @returns Dictionary of counters (see Stats.combine), or None if stats is False
+    """
+    kept = _worker_tree(tree)
+    taken = kept._take_packed(1, tree.block or tree._tuned, affine)
+    counters = kept._attach_stats(taken) if stats else None
+    for region, image in zip(regions, images):
+        if halt.value:  break
+        libfab.render16(taken[0], region, image.pixels, halt.c_int)
+    kept._give_packed(taken, counters)
+    return kept.stats if stats else None
+
+
+def _triangulate_shape(tree, region, mm_per_unit, merge_leafs, use_cms, halt):
+    """ @brief Triangulates a math tree, saving the mesh to a temporary file
+        @details Called in a worker process by MathTree.triangulate_shapes
+        (on a single thread, since each worker process takes one shape)
+        @returns Mesh filename, or None if aborted
+    """
+    interrupt = threading.Event()
+    stop = multiprocess.watch(halt, interrupt)
+
+    asdf = tree.asdf(region=region, mm_per_unit=mm_per_unit,
+                     merge_leafs=merge_leafs, threads=1, interrupt=interrupt)
+    if asdf is None or halt.value:
+        mesh = None
+    elif use_cms:
+        mesh = asdf.triangulate_cms()
+    else:
+        mesh = asdf.triangulate(threads=False, interrupt=interrupt)
+    stop.set()
+
+    if mesh is None or halt.value:  return None
+
+    fd, filename = tempfile.mkstemp(prefix='koko-', suffix='.mesh',
+                                    dir=multiprocess.SHARED_DIR)
+    os.close(fd)
+    mesh.save(filename)
+    return filename
+
 if libfab:
     X = MathTree.X()
     Y = MathTree.Y()
@@ -751,3 +1548,4 @@ if libfab:
 
 from    koko.fab.image      import Image
 from    koko.fab.asdf       import ASDF
+from    koko.fab.mesh       import Mesh
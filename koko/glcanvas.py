@@ -79,6 +79,7 @@ class GLCanvas(glcanvas.GLCanvas):
         self.path_vbo   = None
 
         self.image      = None
+        self.preview    = None
 
         self.loaded     = False
         self.snap       = True
@@ -95,6 +96,9 @@ class GLCanvas(glcanvas.GLCanvas):
         self.mesh_vbos  = []
         self.path_vbo   = None
         self.image      = None
+        if self.preview is not None:
+            glDeleteTextures(self.preview[0])
+        self.preview    = None
         self.Refresh()
 
     def clear_path(self):
@@ -523,23 +527,60 @@ class GLCanvas(glcanvas.GLCanvas):
     def _load_image(self, image):
 
         image = image.copy(depth=8, channels=3)
+        self.texture, self.tex_vbo = self.make_texture(image, 0)
+        self.image = image
+
+        corner = Vec3f(image.xmin, image.ymin, 0)
+        self._center = corner + Vec3f(image.dx, image.dy, 0)/2
+        self._scale = 4/(Vec3f(image.dx, image.dy, 0)/2).length()
+
+    def load_preview(self, image, alpha, beta):
+        ''' Loads a shaded image of the view (from MathTree.render_shaded),
+            which is shown until meshes are loaded. '''
+        wx.CallAfter(self._load_preview, image, alpha, beta)
+
+    def _load_preview(self, image, alpha, beta):
+        if self.preview is not None:
+            glDeleteTextures(self.preview[0])
+
+        # The image is in the view frame, so it's drawn halfway through
+        # the rotated bounds (facing the camera)
+        image = image.copy(depth=8, channels=3)
+        texture, tex_vbo = self.make_texture(
+            image, (image.zmin + image.zmax) / 2
+        )
+        self.preview = (texture, tex_vbo, alpha, beta)
+
+        # Frame the preview if nothing has been loaded yet (meshes will
+        # still snap the view when they arrive)
+        if self.snap:
+            half = Vec3f(image.dx, image.dy, image.dz)/2
+            corner = Vec3f(image.xmin, image.ymin, image.zmin)
+            self.center = (corner + half).deproject(alpha, beta)
+            self.scale = 4/half.length()
+
+        self.Refresh()
+
+    def make_texture(self, image, z):
+        ''' Uploads an 8-bit, 3-channel image to a new texture, returning
+            the texture and a VBO with a rectangle covering the image's
+            bounds (at height z). '''
         data = np.flipud(image.array)
 
-        self.tex_vbo = vbo.VBO((ctypes.c_float*30)(
-            image.xmin, image.ymin, 0, 0, 0,
-            image.xmax, image.ymin, 0, 1, 0,
-            image.xmax, image.ymax, 0, 1, 1,
+        tex_vbo = vbo.VBO((ctypes.c_float*30)(
+            image.xmin, image.ymin, z, 0, 0,
+            image.xmax, image.ymin, z, 1, 0,
+            image.xmax, image.ymax, z, 1, 1,
 
-            image.xmin, image.ymin, 0, 0, 0,
-            image.xmax, image.ymax, 0, 1, 1,
-            image.xmin, image.ymax, 0, 0, 1
+            image.xmin, image.ymin, z, 0, 0,
+            image.xmax, image.ymax, z, 1, 1,
+            image.xmin, image.ymax, z, 0, 1
         ))
 
-        self.texture = glGenTextures(1)
-        self.image = image
+        texture = glGenTextures(1)
 
         glPixelStorei(GL_UNPACK_ALIGNMENT, 1)
-        glBindTexture(GL_TEXTURE_2D, self.texture)
+        glBindTexture(GL_TEXTURE_2D, texture)
         glTexImage2D(GL_TEXTURE_2D, 0, GL_RGBA, image.width, image.height, 0,
                      GL_RGB, GL_UNSIGNED_BYTE, data.flatten())
 
@@ -548,9 +589,7 @@ class GLCanvas(glcanvas.GLCanvas):
         glTexParameterf(GL_TEXTURE_2D, GL_TEXTURE_MAG_FILTER, GL_NEAREST)
         glTexParameterf(GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER, GL_NEAREST)
 
-        corner = Vec3f(image.xmin, image.ymin, 0)
-        self._center = corner + Vec3f(image.dx, image.dy, 0)/2
-        self._scale = 4/(Vec3f(image.dx, image.dy, 0)/2).length()
+        return texture, tex_vbo
 
 ################################################################################
 
@@ -573,6 +612,12 @@ class GLCanvas(glcanvas.GLCanvas):
         if self.image is not None:
             self.draw_image()
 
+        # Draw the shaded preview until meshes are loaded (as long as
+        # the view hasn't been rotated since it was rendered)
+        if (self.preview is not None and not self.meshes and
+                self.preview[2:] == (self.alpha, self.beta)):
+            self.draw_preview()
+
         # Draw border around window
         if self.border is not None:
             self.draw_border()
@@ -956,6 +1001,29 @@ class GLCanvas(glcanvas.GLCanvas):
         glPushMatrix()
 
         self.orient()
+        self.draw_texture(self.texture, self.tex_vbo)
+
+        glPopMatrix()
+
+    def draw_preview(self):
+
+        glPolygonMode(GL_FRONT_AND_BACK, GL_FILL)
+
+        glPushMatrix()
+
+        # The preview is already rotated, so only the view's translation
+        # and scale are applied (with the center moved into the view frame)
+        center = self.center.project(self.alpha, self.beta)
+        glTranslatef(0, 0, -5)
+        glScalef(self.scale, self.scale, self.scale)
+        glTranslatef(-center.x, -center.y, -center.z)
+
+        self.draw_texture(self.preview[0], self.preview[1])
+
+        glPopMatrix()
+
+    def draw_texture(self, texture, tex_vbo):
+        ''' Draws a textured rectangle from make_texture. '''
 
         # Set up various parameters
         shaders.glUseProgram(self.image_shader)
@@ -965,19 +1033,19 @@ class GLCanvas(glcanvas.GLCanvas):
             glEnableVertexAttribArray(attributes[a])
 
         glActiveTexture(GL_TEXTURE0)
-        glBindTexture(GL_TEXTURE_2D, self.texture)
+        glBindTexture(GL_TEXTURE_2D, texture)
         glUniform1i(
             glGetUniformLocation(self.image_shader, 'texture'), 0
         )
 
-        self.tex_vbo.bind()
+        tex_vbo.bind()
         glVertexAttribPointer(
             attributes['vertex_position'],
-            3, GL_FLOAT, False, 5*4, self.tex_vbo
+            3, GL_FLOAT, False, 5*4, tex_vbo
         )
         glVertexAttribPointer(
             attributes['vertex_texcoord'],
-            2, GL_FLOAT, False, 5*4, self.tex_vbo+3*4
+            2, GL_FLOAT, False, 5*4, tex_vbo+3*4
         )
 
 
@@ -986,11 +1054,9 @@ class GLCanvas(glcanvas.GLCanvas):
         # And disable all of those parameter
         for a in attributes.itervalues():   glDisableVertexAttribArray(a)
 
-        self.tex_vbo.unbind()
+        tex_vbo.unbind()
         shaders.glUseProgram(0)
 
-        glPopMatrix()
-
 ################################################################################
 
     def draw_paths(self):
@@ -11,11 +11,22 @@ import  wx
 import  koko
 from    koko.struct         import Struct
 from    koko.fab.asdf       import ASDF
+from    koko.fab.cache      import RenderCache
 from    koko.fab.tree       import MathTree
 from    koko.fab.fabvars    import FabVars
 from    koko.fab.mesh       import Mesh
 
 from    koko.c.region       import Region
+from    koko.c.stats        import Stats
+
+## @var COARSE_LEVELS
+# Number of tile pyramid levels below the view's level at which progressive
+# renders start (3 levels is 1/8 of the view's resolution)
+COARSE_LEVELS = 3
+
+## @var PREVIEW_PIXELS
+# Approximate length (in pixels) of the longest side of the shaded 3D preview
+PREVIEW_PIXELS = 400
 
 
 class RenderTask(object):
@@ -23,11 +34,14 @@ class RenderTask(object):
         @brief A render job running in a separate thread
     """
 
-    def __init__(self, view, script=None, cad=None):
+    def __init__(self, view, script=None, cad=None,
+                 progressive=True, budget=None):
         """ @brief Constructs and starts a render task.
             @param view Render view (Struct with xmin, xmax, ymin, ymax, zmin, zmax, and pixels_per_unit member variables)
             @param script Source script to render
             @param cad Data structure from previous run
+            @param progressive If true, 2D images are rendered coarse-to-fine
+            @param budget Time budget (in seconds) for progressive renders, after which refinement stops (or None)
         """
 
         if not (bool(script) ^ bool(cad)):
@@ -57,6 +71,14 @@ class RenderTask(object):
         # String holding text to be loaded into the output panel
         self.output  = ''
 
+        ## @var progressive
+        # Boolean determining whether 2D images are rendered coarse-to-fine
+        self.progressive = progressive
+
+        ## @var budget
+        # Time budget (in seconds) for progressive renders (or None)
+        self.budget = budget
+
         ## @var thread
         # threading.Thread that actually runs the task
         self.thread = threading.Thread(target=self.run)
@@ -131,6 +153,9 @@ class RenderTask(object):
         if make_mesh and '3D' in render_mode:
             koko.GLCANVAS.loaded = False
 
+            # If there's nothing in the 3D view yet, show a quick preview
+            if not koko.GLCANVAS.meshes:    self.make_preview()
+
             images = []
             meshes = []
             try:
@@ -275,19 +300,119 @@ class RenderTask(object):
 
     def make_images(self):
         """ @brief Renders a set of images from self.cad.shapes
+            @details Finished images are looked up in the render cache
+            first.  The rest are stitched together from tiles in the
+            canvas's tile pyramid, and only missing tiles are rendered
+            (in parallel, by a pool of worker processes).
+
+            If self.progressive is set, the images are first rendered at a
+            fraction of the view's resolution then refined one pyramid level
+            at a time, loading each pass into the canvas.  Refinement stops
+            early if the task is cancelled or runs past self.budget (and
+            coarse images aren't cached).
             @returns List of Image objects
         """
         zmin = self.cad.zmin if self.cad.zmin is not None else 0
         zmax = self.cad.zmax if self.cad.zmax is not None else 0
 
-        imgs = []
-        for e in self.cad.shapes:
-            if self.event.is_set(): return
-            imgs.append(self.make_image(e, zmin, zmax))
+        if self.event.is_set(): return
+        shapes = self.cad.shapes
+        bounds = [self.image_bounds(e) for e in shapes]
+        level = koko.CANVAS.tiles.level(self.view.pixels_per_unit)
+
+        keys = [RenderCache.key('tiles', e,
+                                Region((b[0], b[2], zmin), (b[1], b[3], zmax),
+                                       2.**level),
+                                self.cad.mm_per_unit)
+                for e, b in zip(shapes, bounds)]
+
+        koko.FRAME.status = 'Rendering with libfab'
+        self.output += ">>  Rendering images with libfab\n"
 
+        start = datetime.now()
+        partial = []
+        def render(indices):
+            # Coarse passes are shown along with images from the cache
+            found = [None if i in indices else koko.CACHE.get(k)
+                     for i, k in enumerate(keys)]
+            def show(imgs):
+                shown = list(found)
+                for i, img in zip(indices, imgs):   shown[i] = img
+                partial[:] = [img for img in shown if img is not None]
+                for e, img in zip(shapes, shown):
+                    if img is not None:     img.color = e.color
+                koko.CANVAS.load_images(partial, self.cad.mm_per_unit)
+
+            return self.render_tiles([shapes[i] for i in indices],
+                                     [bounds[i] for i in indices],
+                                     level, zmin, zmax, show)
+        imgs = koko.CACHE.lookup(keys, render)
+
+        if self.event.is_set():     return
+        elif imgs is None:
+            # Refinement stopped early, so keep the last coarse pass
+            imgs = partial or None
+        else:
+            for e, img in zip(shapes, imgs):
+                img.color = e.color
+
+        self.output += "#   libfab render time: %s\n" % (
+            datetime.now() - start)
         return imgs
 
 
+    def render_tiles(self, shapes, bounds, level, zmin, zmax, show):
+        """ @brief Renders images from the canvas's tile pyramid
+            @param shapes List of MathTree expressions
+            @param bounds List of (xmin, xmax, ymin, ymax) tuples (one per shape)
+            @param level Pyramid level of the finished images
+            @param zmin Minimum Z value (arbitrary units)
+            @param zmax Maximum Z value (arbitrary units)
+            @param show Function called with each coarse pass's images
+            @returns List of Image objects, or None if refinement was
+            cancelled or stopped early
+        """
+        tiles = koko.CANVAS.tiles
+
+        # Show the best coarser level that we've already rendered
+        first, preview = tiles.preview(shapes, bounds, level, zmin, zmax,
+                                       self.cad.mm_per_unit)
+        if preview:     show(preview)
+
+        if not self.progressive:
+            first = level
+        elif first is None:
+            first = level - COARSE_LEVELS
+        else:
+            first = max(first + 1, level - COARSE_LEVELS)
+
+        start = datetime.now()
+        done = None
+        counters = []
+        for L in range(first, level + 1):
+            imgs = tiles.render(shapes, bounds, L, zmin, zmax,
+                                self.cad.mm_per_unit, interrupt=self.c_event,
+                                stats=koko.STATS)
+            if imgs is None or self.event.is_set():     return None
+            if koko.STATS:
+                counters += dict((id(e), e.stats) for e in shapes).values()
+
+            dT = datetime.now() - start
+            if L < level:
+                self.output += "#   pass at 1/%i scale: %s\n" % (
+                    2**(level - L), dT)
+                show(imgs)
+                if self.budget is not None and \
+                        dT.total_seconds() > self.budget:
+                    break
+            else:
+                done = imgs
+
+        # Counters are summed over every shape and pass
+        self.output_stats(Stats.merge(counters))
+        return done
+
+
     def make_flat_image(self, expr, scale):
         """ @brief Renders a flat single image
             @param expr MathTree expression
@@ -307,21 +432,37 @@ class RenderTask(object):
         self.output += ">>  Rendering image with libfab\n"
 
         start = datetime.now()
-        img = expr.render(region, interrupt=self.c_event,
-                          mm_per_unit=self.cad.mm_per_unit)
+        key = RenderCache.key('image', expr, region, self.cad.mm_per_unit)
+        img = koko.CACHE.get(key)
+        if img is None:
+            img = expr.render(region, interrupt=self.c_event,
+                              mm_per_unit=self.cad.mm_per_unit,
+                              stats=koko.STATS)
+            if not self.event.is_set():     koko.CACHE.put(key, img)
+        else:
+            expr.stats = None
         img.color = expr.color
 
         dT = datetime.now() - start
         self.output += "#   libfab render time: %s\n" % dT
+        self.output_stats(expr.stats)
         return img
 
 
-    def make_image(self, expr, zmin, zmax):
-        """ @brief Renders an expression
+    def output_stats(self, stats):
+        """ @brief Adds profiling counters to the output pane
+            @param stats Dictionary of counters (from a MathTree rendered
+            with stats=koko.STATS), or None
+        """
+        if stats is None:   return
+        for line in Stats.format(stats).split('\n'):
+            self.output += '#   %s\n' % line
+
+
+    def image_bounds(self, expr):
+        """ @brief Finds the render bounds for an expression
             @param expr MathTree expression
-            @param zmin Minimum Z value (arbitrary units)
-            @param zmax Maximum Z value (arbitrary units)
-            @returns None for a null image, False for a failure, the Image if success.
+            @returns (xmin, xmax, ymin, ymax) tuple, clipped to the current view
         """
 
         # Adjust view bounds based on cad file scale
@@ -344,22 +485,33 @@ class RenderTask(object):
         if expr.ymax is None:   ymax = ymax
         else:   ymax = min(ymax, expr.ymax + self.cad.border*expr.dy)
 
-        region = Region( (xmin, ymin, zmin), (xmax, ymax, zmax),
-                         self.view.pixels_per_unit )
+        return xmin, xmax, ymin, ymax
 
-        koko.FRAME.status = 'Rendering with libfab'
-        self.output += ">>  Rendering image with libfab\n"
+################################################################################
+
+    def make_preview(self):
+        """ @brief Shows a shaded preview of the design in the 3D view
+            @details The preview is ray-traced from the math tree at the
+            view's current rotation, so it's shown long before meshes
+            are built.
+        """
+        expr = self.cad.shape
+        if not expr.bounded or self.event.is_set():    return
+
+        self.output += '>>  Rendering shaded preview\n'
+        koko.FRAME.status = 'Rendering preview'
 
         start = datetime.now()
-        img = expr.render(region, interrupt=self.c_event,
-                          mm_per_unit=self.cad.mm_per_unit)
+        alpha, beta = koko.GLCANVAS.alpha, koko.GLCANVAS.beta
+        depth, shaded, normals = expr.render_shaded(
+            PREVIEW_PIXELS / max(expr.dx, expr.dy, expr.dz), alpha, beta,
+            mm_per_unit=self.cad.mm_per_unit, interrupt=self.c_event
+        )
+        if self.event.is_set(): return
 
-        img.color = expr.color
-        dT = datetime.now() - start
-        self.output += "#   libfab render time: %s\n" % dT
-        return img
+        self.output += '#   preview time: %s\n' % (datetime.now() - start)
+        koko.GLCANVAS.load_preview(shaded, alpha, beta)
 
-################################################################################
 
     def make_mesh(self, expr):
         """ @brief Converts an expression into a mesh.
@@ -381,19 +533,32 @@ class RenderTask(object):
                  depth=DEPTH
             )
 
+            # Reuse the mesh from a previous render if nothing has changed
+            start = datetime.now()
+            key = RenderCache.key('mesh', expr, region, self.cad.mm_per_unit)
+            mesh = koko.CACHE.get(key)
+            if mesh is not None:
+                self.output += '#   Loaded mesh from cache\n'
+                if mesh.vcount: break
+                else:           DEPTH += 1
+                continue
+
             koko.FRAME.status = 'Rendering to ASDF'
 
-            start = datetime.now()
             asdf = expr.asdf(region=region, mm_per_unit=self.cad.mm_per_unit,
-                             interrupt=self.c_event)
+                             interrupt=self.c_event, stats=koko.STATS)
 
             self.output += '#   ASDF render time: %s\n' % (datetime.now() - start)
+            self.output_stats(expr.stats)
             if self.event.is_set(): return
             koko.FRAME.output = self.output
 
             koko.FRAME.status = 'Triangulating'
             start = datetime.now()
             mesh = asdf.triangulate(interrupt=self.c_event)
+            if self.event.is_set(): return
+            mesh.set_normals(expr, self.cad.mm_per_unit)
+            koko.CACHE.put(key, mesh)
 
             if mesh.vcount: break
             else:           DEPTH += 1
@@ -1,5 +1,6 @@
 #include <stdio.h>
 #include <stdlib.h>
+#include <string.h>
 #include <math.h>
 #include <assert.h>
 
@@ -10,6 +11,7 @@
 #include "tree/packed.h"
 #include "util/interval.h"
 #include "util/constants.h"
+#include "util/taskpool.h"
 
 #include "util/switches.h"
 
@@ -31,15 +33,105 @@ void merge_cells(ASDF* const A, ASDF* const B, const int axis);
     @param tree Target PackedTree
     @param region Region on which to evaluate
     @param merge_leafs Boolean determining whether leaf cells are merged
+    @param corners Cache of lattice samples (checked before evaluating)
 */
 _STATIC_
 ASDF*  build_asdf_region(struct PackedTree_* tree,
-                         Region region, const _Bool merge_leafs);
+                         Region region, const _Bool merge_leafs,
+                         CornerTable* const corners);
+
+/** @brief Samples the distance field at a cell's corners
+    @details Corners are looked up in the corner cache by lattice position,
+    and the rest are evaluated together with eval_r.
+*/
+_STATIC_
+void sample_corners(PackedTree* tree, const Region region,
+                    ASDF* const asdf, CornerTable* const corners);
 _STATIC_
 ASDF* _build_asdf_region(const float* const result, const Region region,
                          const int kstride, const int jstride,
                          const _Bool merge_leafs);
 
+/*  CORNER_BITS
+ *
+ *  Size of each thread's corner cache (as a power of two)
+ */
+#define CORNER_BITS 16
+
+
+/*  TASK_VOXELS
+ *
+ *  Minimum size (in voxels) of a region whose octants may be handed off
+ *  to other threads when building an ASDF in parallel.
+ */
+#define TASK_VOXELS 32768
+
+
+/* A subregion to be built by another thread, and the slot in its parent's
+   branches array that it fills */
+typedef struct AsdfTask_ {
+    ASDF** slot;
+    Region region;
+    unsigned depth;
+} AsdfTask;
+
+
+/* A cell that handed off some of its subtree, and so can't be merged with
+   get_d_from_children and simplify until the task pool is done */
+typedef struct Deferred_ {
+    ASDF* asdf;
+    unsigned depth;
+} Deferred;
+
+
+/* Arguments shared by every task in a parallel ASDF build */
+typedef struct AsdfJob_ {
+    PackedTree** trees;
+    ASDF* root;
+    _Bool merge_leafs;
+    volatile int* halt;
+
+    /* Corner caches, one per worker */
+    CornerTable** corners;
+
+    /* Deferred cells, recorded separately by each worker */
+    Deferred** deferred;
+    unsigned* count;
+    unsigned* size;
+} AsdfJob;
+
+
+/** @brief Recursively builds an ASDF
+    @details If pool is non-NULL, octants of large regions are pushed
+    to the pool rather than built immediately, and their parents are
+    recorded in the job's deferred lists (rather than being merged).
+    @param corners Cache of lattice samples
+    @param deferred Set to true if this cell or any cell below it was deferred
+*/
+_STATIC_
+ASDF* build_asdf_r(PackedTree* const tree, const Region region,
+                   const _Bool merge_leafs, volatile int* const halt,
+                   CornerTable* const corners,
+                   AsdfJob* const job, TaskPool* const pool,
+                   const unsigned worker, const unsigned depth,
+                   _Bool* const deferred);
+
+/** @brief Builds a single task's subregion (or splits the root region)
+*/
+_STATIC_
+void build_asdf_task(TaskPool* pool, unsigned worker, void* task, void* data);
+
+/** @brief Records a deferred cell in a worker's list
+*/
+_STATIC_
+void defer_cell(AsdfJob* const job, const unsigned worker,
+                ASDF* const asdf, const unsigned depth);
+
+/** @brief qsort comparison function that puts deeper cells first
+*/
+_STATIC_
+int deeper_first(const void* a, const void* b);
+
 /** @brief Finds the minimum cell sizes along each dimension.
     @param dx Minimum x size
     @param dy Minimum y size
@@ -79,15 +171,150 @@ ASDF* asdf_root(PackedTree* tree, Region region)
 
 ASDF* build_asdf(
     PackedTree* const tree, const Region region, const _Bool merge_leafs, volatile int* const halt)
+{
+    CornerTable* const corners = make_corner_table(CORNER_BITS);
+
+    _Bool deferred = false;
+    ASDF* const asdf = build_asdf_r(tree, region, merge_leafs, halt, corners,
+                                    NULL, NULL, 0, 0, &deferred);
+
+    free_corner_table(corners);
+    return asdf;
+}
+
+
+ASDF* build_asdf_parallel(PackedTree** trees, unsigned threads,
+                          const Region region, const _Bool merge_leafs,
+                          volatile int* const halt, double* busy)
+{
+    if (trees == NULL || threads == 0)  return NULL;
+    for (unsigned t=0; t < threads; ++t)    if (trees[t] == NULL) return NULL;
+
+    AsdfJob job = {
+        .trees=trees, .root=asdf_root(trees[0], region),
+        .merge_leafs=merge_leafs, .halt=halt,
+        .corners=malloc(threads * sizeof(CornerTable*)),
+        .deferred=calloc(threads, sizeof(Deferred*)),
+        .count=calloc(threads, sizeof(unsigned)),
+        .size=calloc(threads, sizeof(unsigned)),
+    };
+
+    for (unsigned t=0; t < threads; ++t)
+        job.corners[t] = make_corner_table(CORNER_BITS);
+
+    // The first task splits the root region into octants
+    AsdfTask first = { .slot=NULL, .region=region, .depth=0 };
+    run_taskpool(threads, sizeof(AsdfTask), &first,
+                 build_asdf_task, &job, busy);
+
+    // Gather up the deferred cells and merge them from the bottom up
+    // (so that each cell's children are merged before it is)
+    unsigned count = 0;
+    for (unsigned t=0; t < threads; ++t)    count += job.count[t];
+
+    Deferred* cells = malloc((count ? count : 1) * sizeof(Deferred));
+    count = 0;
+    for (unsigned t=0; t < threads; ++t) {
+        memcpy(cells + count, job.deferred[t], job.count[t]*sizeof(Deferred));
+        count += job.count[t];
+        free(job.deferred[t]);
+        free_corner_table(job.corners[t]);
+    }
+    free(job.corners);
+    free(job.deferred);
+    free(job.count);
+    free(job.size);
+
+    if (*halt) {
+        free(cells);
+        free_asdf(job.root);
+        return NULL;
+    }
+
+    qsort(cells, count, sizeof(Deferred), deeper_first);
+    for (unsigned i=0; i < count; ++i) {
+        get_d_from_children(cells[i].asdf);
+        simplify(cells[i].asdf, merge_leafs);
+    }
+    free(cells);
+
+    get_d_from_children(job.root);
+    simplify(job.root, merge_leafs);
+
+    return job.root;
+}
+
+////////////////////////////////////////////////////////////////////////////////
+
+_STATIC_
+void build_asdf_task(TaskPool* pool, unsigned worker, void* task, void* data)
+{
+    AsdfJob* const job = data;
+    const AsdfTask* const t = task;
+
+    // The root cell is split into octants without checking its bounds
+    // (its corners were sampled by asdf_root), each octant becoming a task.
+    if (t->slot == NULL) {
+        Region octants[8];
+        const uint8_t bits = octsect(t->region, octants);
+        for (int i=0; i < 8; ++i) {
+            if (bits & (1 << i)) {
+                AsdfTask child = { .slot=&job->root->branches[i],
+                                   .region=octants[i], .depth=1 };
+                taskpool_push(pool, worker, &child);
+            }
+        }
+        return;
+    }
+
+    _Bool deferred = false;
+    *(t->slot) = build_asdf_r(job->trees[worker], t->region,
+                              job->merge_leafs, job->halt, job->corners[worker],
+                              job, pool, worker, t->depth, &deferred);
+}
+
+
+_STATIC_
+void defer_cell(AsdfJob* const job, const unsigned worker,
+                ASDF* const asdf, const unsigned depth)
+{
+    if (job->count[worker] == job->size[worker]) {
+        job->size[worker] = job->size[worker] ? job->size[worker]*2 : 16;
+        job->deferred[worker] = realloc(job->deferred[worker],
+                                        job->size[worker]*sizeof(Deferred));
+    }
+    job->deferred[worker][job->count[worker]++] =
+        (Deferred){ .asdf=asdf, .depth=depth };
+}
+
+
+_STATIC_
+int deeper_first(const void* a, const void* b)
+{
+    const unsigned da = ((const Deferred*)a)->depth,
+                   db = ((const Deferred*)b)->depth;
+    return (da < db) - (da > db);
+}
+
+////////////////////////////////////////////////////////////////////////////////
+
+_STATIC_
+ASDF* build_asdf_r(PackedTree* const tree, const Region region,
+                   const _Bool merge_leafs, volatile int* const halt,
+                   CornerTable* const corners,
+                   AsdfJob* const job, TaskPool* const pool,
+                   const unsigned worker, const unsigned depth,
+                   _Bool* const deferred)
 {
     // Special interrupt system, set asynchronously by on high
     if (*halt) return NULL;
 
-    if ((region.ni+1)*(region.nj+1)*(region.nk+1) < MIN_VOLUME)
-        return build_asdf_region(tree, region, merge_leafs);
+    if ((region.ni+1)*(region.nj+1)*(region.nk+1) < tree->block)
+        return build_asdf_region(tree, region, merge_leafs, corners);
 
     // Allocate an ASDF structure
     ASDF* asdf = calloc(1, sizeof(ASDF));
+    STAT(tree, cells, 1);
 
     // Save the corners of the world
     *asdf = (ASDF){
@@ -102,7 +329,7 @@ ASDF* build_asdf(
     if (region.voxels == 1) {
         recurse = false;
     } else {
-        const Interval result = eval_i(tree, asdf->X, asdf->Y, asdf->Z);
+        const Interval result = eval_bounds(tree, asdf->X, asdf->Y, asdf->Z);
         if (result.lower >= 0 || result.upper < 0) {
             recurse = false;
         }
@@ -114,12 +341,8 @@ ASDF* build_asdf(
         _Bool empty  = true;
         _Bool filled = true;
 
+        sample_corners(tree, region, asdf, corners);
         for (int n=0; n < 8; ++n) {
-            asdf->d[n] = eval_f(tree,
-                (n & 4) ? asdf->X.upper : asdf->X.lower,
-                (n & 2) ? asdf->Y.upper : asdf->Y.lower,
-                (n & 1) ? asdf->Z.upper : asdf->Z.lower);
-
             if (asdf->d[n] < 0)     empty = false;
             else                    filled = false;
         }
@@ -139,23 +362,35 @@ ASDF* build_asdf(
         // If there's at least one active axis along which we can
         // split the system, then subdivide and recurse
         if (bits > 1) {
+            // In a large enough region, every octant but the first is
+            // handed off to the task pool (and will be evaluated from
+            // scratch, without this branch's pruning).
+            const _Bool spawn = pool && region.voxels >= TASK_VOXELS;
+            _Bool first = true;
+
             // Fill in up to eight octants, depending on whether we can still
             // split the region along this particular axis
             for (int i=0; i < 8; ++i) {
-                if (bits & (1 << i)) {
-                    asdf->branches[i] = build_asdf(tree, octants[i],
-                                                   merge_leafs, halt);
+                if (!(bits & (1 << i)))     continue;
+
+                if (spawn && !first) {
+                    AsdfTask task = { .slot=&asdf->branches[i],
+                                      .region=octants[i], .depth=depth+1 };
+                    taskpool_push(pool, worker, &task);
+                    *deferred = true;
+                } else {
+                    _Bool d = false;
+                    asdf->branches[i] = build_asdf_r(
+                        tree, octants[i], merge_leafs, halt, corners,
+                        job, pool, worker, depth+1, &d);
+                    *deferred |= d;
                 }
+                first = false;
             }
         }
         // Otherwise, we'll transform this into a leaf cell.
         else {
-            for (int n=0; n < 8; ++n) {
-                asdf->d[n] = eval_f(tree,
-                    (n & 4) ? asdf->X.upper : asdf->X.lower,
-                    (n & 2) ? asdf->Y.upper : asdf->Y.lower,
-                    (n & 1) ? asdf->Z.upper : asdf->Z.lower);
-            }
+            sample_corners(tree, region, asdf, corners);
             asdf->state = LEAF;
         }
 
@@ -163,6 +398,14 @@ ASDF* build_asdf(
             enable_nodes(tree);
         #endif
 
+        // If part of this subtree is still being built by other tasks,
+        // it's merged later by build_asdf_parallel (which also frees it
+        // if the build is halted).
+        if (*deferred) {
+            defer_cell(job, worker, asdf, depth);
+            return asdf;
+        }
+
         if (*halt) {
             free_asdf(asdf);
             return NULL;
@@ -181,41 +424,109 @@ ASDF* build_asdf(
 
 ////////////////////////////////////////////////////////////////////////////////
 
+_STATIC_
+void sample_corners(PackedTree* tree, const Region region,
+                    ASDF* const asdf, CornerTable* const corners)
+{
+    float X[8], Y[8], Z[8];
+    int missing[8];
+    int count = 0;
+
+    for (int n=0; n < 8; ++n) {
+        const uint32_t i = region.imin + ((n & 4) ? region.ni : 0),
+                       j = region.jmin + ((n & 2) ? region.nj : 0),
+                       k = region.kmin + ((n & 1) ? region.nk : 0);
+        if (corner_table_get(corners, i, j, k, &asdf->d[n])) {
+            STAT(tree, cached, 1);
+        } else {
+            X[count] = (n & 4) ? asdf->X.upper : asdf->X.lower;
+            Y[count] = (n & 2) ? asdf->Y.upper : asdf->Y.lower;
+            Z[count] = (n & 1) ? asdf->Z.upper : asdf->Z.lower;
+            missing[count++] = n;
+        }
+    }
+
+    if (count == 0)     return;
+
+    // Evaluate the missing corners together if they fit in one block
+    if ((unsigned)count <= tree->block) {
+        Region r = (Region) {.X = X, .Y = Y, .Z = Z, .voxels = count };
+        const float* const result = eval_r(tree, r);
+        for (int q=0; q < count; ++q)   asdf->d[missing[q]] = result[q];
+    } else {
+        for (int q=0; q < count; ++q)
+            asdf->d[missing[q]] = eval_f(tree, X[q], Y[q], Z[q]);
+    }
+
+    for (int q=0; q < count; ++q) {
+        const int n = missing[q];
+        corner_table_put(corners,
+                         region.imin + ((n & 4) ? region.ni : 0),
+                         region.jmin + ((n & 2) ? region.nj : 0),
+                         region.kmin + ((n & 1) ? region.nk : 0),
+                         asdf->d[n]);
+    }
+}
+
+
 _STATIC_
 ASDF* build_asdf_region(PackedTree* tree, Region region,
-                        const _Bool merge_leafs)
+                        const _Bool merge_leafs, CornerTable* const corners)
 {
     const int voxels = (region.ni+1)*(region.nj+1)*(region.nk+1);
 
+    // Samples for every lattice point, and coordinates (and indices into
+    // the samples array) for the points that aren't in the corner cache.
+    float* const result = malloc(voxels*sizeof(float));
     float *X = malloc(voxels*sizeof(float)),
           *Y = malloc(voxels*sizeof(float)),
           *Z = malloc(voxels*sizeof(float));
+    int* const missing = malloc(voxels*sizeof(int));
 
-    // Copy the X, Y, Z vectors into a flattened matrix form.
-    int q = 0;
+    // Copy the uncached X, Y, Z vectors into a flattened matrix form.
+    int q = 0, count = 0;
     for (int k = 0; k <= region.nk; ++k) {
         for (int j = 0; j <= region.nj; ++j) {
             for (int i = 0; i <= region.ni; ++i) {
-                X[q] = region.X[i];
-                Y[q] = region.Y[j];
-                Z[q] = region.Z[k];
+                if (corner_table_get(corners, region.imin + i,
+                                     region.jmin + j, region.kmin + k,
+                                     &result[q])) {
+                    STAT(tree, cached, 1);
+                } else {
+                    X[count] = region.X[i];
+                    Y[count] = region.Y[j];
+                    Z[count] = region.Z[k];
+                    missing[count++] = q;
+                }
                 q++;
             }
         }
     }
 
     // Create a dummy region with the flattened vectors
-    Region r = (Region) {.X = X, .Y = Y, .Z = Z, .voxels = voxels };
-    const float* const result = eval_r(tree, r);
+    if (count) {
+        Region r = (Region) {.X = X, .Y = Y, .Z = Z, .voxels = count };
+        const float* const evaluated = eval_r(tree, r);
+        for (int n=0; n < count; ++n)   result[missing[n]] = evaluated[n];
+    }
+
+    // Calculate k and j stride in the results array
+    const int kstride = (region.nj+1)*(region.ni+1);
+    const int jstride = region.ni+1;
+
+    // Store the newly evaluated points in the corner cache
+    for (int n=0; n < count; ++n) {
+        const int m = missing[n];
+        corner_table_put(corners, region.imin + m % jstride,
+                                  region.jmin + (m % kstride) / jstride,
+                                  region.kmin + m / kstride, result[m]);
+    }
 
     // Free the allocated matrices
     free(X);
     free(Y);
     free(Z);
-
-    // Calculate k and j stride in the results array
-    const int kstride = (region.nj+1)*(region.ni+1);
-    const int jstride = region.ni+1;
+    free(missing);
 
     // Set these values to zero so that lookups will index
     // into the results array at the correct point
@@ -223,7 +534,14 @@ ASDF* build_asdf_region(PackedTree* tree, Region region,
     region.jmin = 0;
     region.kmin = 0;
 
-    return _build_asdf_region(result, region, kstride, jstride, merge_leafs);
+    ASDF* const asdf = _build_asdf_region(result, region, kstride, jstride,
+                                          merge_leafs);
+    free(result);
+
+    STAT(tree, blocks, 1);
+    STAT(tree, cells, count_cells(asdf));
+
+    return asdf;
 }
 
 _STATIC_
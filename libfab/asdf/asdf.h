@@ -66,6 +66,24 @@ ASDF*  build_asdf(
     const _Bool merge_leafs, volatile int* const halt);
 
 
+/** @brief Converts a PackedTree into an ASDF, using many threads
+    @details Threads share work through a task pool: large regions hand
+    off their octants to other threads at any depth.  Cells whose subtrees
+    were handed off are merged (with get_d_from_children and simplify)
+    once every task has finished.
+    @param trees Array of packed trees (one per thread, from fork_packed)
+    @param threads Number of threads
+    @param region Region on which to render the expression
+    @param merge_leafs Boolean determining whether leaf cells are merged
+    @param halt Integer that should be set to 1 to abort render
+    @param busy Array filled with each thread's busy time (in seconds), or NULL
+    @returns The ASDF, or NULL if the build was halted
+*/
+ASDF* build_asdf_parallel(
+    struct PackedTree_** trees, unsigned threads, const Region region,
+    const _Bool merge_leafs, volatile int* const halt, double* busy);
+
+
 /** @brief Verifies that all corner signs are correct
     @details Prints an error message if there's a non-negative corner
     in a FILLED cell or a negative corner in an EMPTY cell.
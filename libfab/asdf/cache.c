@@ -28,6 +28,9 @@ _STATIC_
 void _fill_corner_cache_all(
     const ASDF* const asdf, Corner* const cache, const Region r);
 
+_STATIC_
+uint64_t corner_key(const uint32_t i, const uint32_t j, const uint32_t k);
+
 ////////////////////////////////////////////////////////////////////////////////
 //      Corner cache functions
 ////////////////////////////////////////////////////////////////////////////////
@@ -310,3 +313,66 @@ void _fill_corner_cache_all(
         }
     }
 }
+
+////////////////////////////////////////////////////////////////////////////////
+//      Corner table functions
+////////////////////////////////////////////////////////////////////////////////
+
+CornerTable* make_corner_table(const unsigned bits)
+{
+    CornerTable* const table = malloc(sizeof(CornerTable));
+    *table = (CornerTable){
+        .keys   = calloc(1 << bits, sizeof(uint64_t)),
+        .values = malloc((1 << bits) * sizeof(float)),
+        .mask   = (1 << bits) - 1,
+    };
+    return table;
+}
+
+
+void free_corner_table(CornerTable* const table)
+{
+    if (!table) return;
+    free(table->keys);
+    free(table->values);
+    free(table);
+}
+
+
+// Packs a lattice position into 21 bits per axis, plus one so that
+// the key is never zero (which marks an empty slot).
+_STATIC_
+uint64_t corner_key(const uint32_t i, const uint32_t j, const uint32_t k)
+{
+    return ((((uint64_t)i << 42) | ((uint64_t)j << 21) | k) + 1);
+}
+
+
+// Fibonacci hashing, keeping the upper half of the product
+#define CORNER_SLOT(table, key) \
+    ((uint32_t)(((key) * 0x9E3779B97F4A7C15ull) >> 32) & (table)->mask)
+
+
+_Bool corner_table_get(const CornerTable* const table,
+                       const uint32_t i, const uint32_t j, const uint32_t k,
+                       float* const value)
+{
+    const uint64_t key = corner_key(i, j, k);
+    const uint32_t slot = CORNER_SLOT(table, key);
+
+    if (table->keys[slot] != key)   return false;
+    *value = table->values[slot];
+    return true;
+}
+
+
+void corner_table_put(CornerTable* const table,
+                      const uint32_t i, const uint32_t j, const uint32_t k,
+                      const float value)
+{
+    const uint64_t key = corner_key(i, j, k);
+    const uint32_t slot = CORNER_SLOT(table, key);
+
+    table->keys[slot] = key;
+    table->values[slot] = value;
+}
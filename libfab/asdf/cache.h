@@ -79,4 +79,56 @@ Corner* fill_corner_cache(const struct ASDF_* const asdf);
 */
 Corner* fill_corner_cache_all(const struct ASDF_* const asdf);
 
+
+////////////////////////////////////////////////////////////////////////////////
+
+/** @struct CornerTable_
+    @brief A fixed-size cache of sampled values indexed by i, j, k
+    position in a discrete lattice.
+
+    @details
+    Used while building an ASDF, so that neighboring cells don't re-evaluate
+    their shared corners.  The table is direct-mapped: each position hashes
+    to a single slot, and storing a value evicts whatever was in that slot.
+    Since the ASDF is built in depth-first order, neighbors are usually
+    evaluated close together, so this catches most shared corners while
+    keeping memory use constant.
+*/
+typedef struct CornerTable_ {
+    /** @var keys
+        Packed lattice position for each slot (or 0 if the slot is empty) */
+    uint64_t* keys;
+    /** @var values
+        Sample value for each slot */
+    float* values;
+    /** @var mask
+        Number of slots, minus one (the number of slots is a power of two) */
+    uint32_t mask;
+} CornerTable;
+
+
+/** @brief Creates an empty corner table with 2^bits slots
+*/
+CornerTable* make_corner_table(const unsigned bits);
+
+
+/** @brief Frees a corner table
+*/
+void free_corner_table(CornerTable* const table);
+
+
+/** @brief Looks up the value at the given i, j, k position
+    @returns true if the value was found (and stored in value)
+*/
+_Bool corner_table_get(const CornerTable* const table,
+                       const uint32_t i, const uint32_t j, const uint32_t k,
+                       float* const value);
+
+
+/** @brief Stores the value at the given i, j, k position
+*/
+void corner_table_put(CornerTable* const table,
+                      const uint32_t i, const uint32_t j, const uint32_t k,
+                      const float value);
+
 #endif
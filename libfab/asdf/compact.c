@@ -0,0 +1,405 @@
+#include <stdlib.h>
+#include <math.h>
+
+#include "asdf/asdf.h"
+#include "asdf/compact.h"
+#include "asdf/render.h"
+
+#include "util/region.h"
+#include "util/macros.h"
+
+////////////////////////////////////////////////////////////////////////////////
+// Forward declarations of _STATIC_ functions
+
+/** @brief Counts terminal (non-branch) cells in an ASDF
+*/
+_STATIC_
+void count_terminals(const ASDF* const asdf, uint32_t* const count);
+
+
+/** @brief Packs an ASDF cell (and its children) into slot n
+    @details The cell's slot must already be reserved; its children's
+    slots are reserved here, so that they're stored next to each other.
+*/
+_STATIC_
+void pack_cell(CompactASDF* const c, const ASDF* const asdf, const uint32_t n);
+
+
+/** @brief Unpacks a single cell into a temporary ASDF structure
+    @details Bounds are taken from the lattice region.  Branch cells
+    have dummy (non-NULL) branch pointers wherever a branch exists,
+    so that octsect_merged splits them in the right way.
+*/
+_STATIC_
+void unpack_cell(const CompactASDF* const c, const uint32_t n,
+                 const Region r, ASDF* const out);
+
+
+/** @brief Returns the index of a branch cell's i'th child
+*/
+_STATIC_
+uint32_t child_index(const CompactASDF* const c, const uint32_t n,
+                     const uint8_t i);
+
+
+/** @brief Builds the lattice region for the root cell
+    @details The region's arrays must be freed with free_arrays.
+*/
+_STATIC_
+Region root_region(const CompactASDF* const c);
+
+
+_STATIC_
+ASDF* expand_cell(const CompactASDF* const c, const uint32_t n,
+                  const Region r);
+
+_STATIC_
+void render_cell(const CompactASDF* const c, const uint32_t n,
+                 const Region lattice, const Region r_,
+                 const float M[4], uint16_t*const*const depth,
+                 uint16_t*const*const shaded, uint8_t (**normals)[3]);
+
+_STATIC_
+ASDF* slice_cell(const CompactASDF* const c, const uint32_t n,
+                 const Region r, const float z);
+
+// End of forward declarations
+////////////////////////////////////////////////////////////////////////////////
+
+CompactASDF* compact_asdf(const ASDF* const asdf)
+{
+    if (!asdf)  return NULL;
+
+    int ni, nj, nk;
+    find_dimensions(asdf, &ni, &nj, &nk);
+
+    // We'll get fifteen bits of resolution on each side
+    const float min = asdf_get_min(asdf);
+    const float max = asdf_get_max(asdf);
+
+    float scale = 32767;
+    if (fabs(max) > fabs(min))  scale /= fabs(max);
+    else                        scale /= fabs(min);
+    if (!isfinite(scale))       scale = 1;
+
+    const uint32_t cells = count_cells(asdf);
+    uint32_t terminals = 0;
+    count_terminals(asdf, &terminals);
+
+    CompactASDF* const c = malloc(sizeof(CompactASDF));
+    *c = (CompactASDF){
+        .X = asdf->X, .Y = asdf->Y, .Z = asdf->Z,
+        .ni = ni, .nj = nj, .nk = nk,
+        .scale = scale,
+        .cells = 1,     // The root's slot is reserved
+        .terminals = 0,
+        .state = malloc(cells),
+        .branching = malloc(cells),
+        .index = malloc(cells * sizeof(uint32_t)),
+        .d = malloc((terminals ? terminals : 1) * sizeof(*c->d)),
+    };
+
+    pack_cell(c, asdf, 0);
+
+    return c;
+}
+
+
+_STATIC_
+void count_terminals(const ASDF* const asdf, uint32_t* const count)
+{
+    if (!asdf)  return;
+
+    if (asdf->state == BRANCH) {
+        for (int i=0; i < 8; ++i)   count_terminals(asdf->branches[i], count);
+    } else {
+        (*count)++;
+    }
+}
+
+
+_STATIC_
+void pack_cell(CompactASDF* const c, const ASDF* const asdf, const uint32_t n)
+{
+    c->state[n] = asdf->state;
+
+    if (asdf->state == BRANCH) {
+        uint8_t branching = 0;
+        for (int i=0; i < 8; ++i) {
+            if (asdf->branches[i])  branching |= (1 << i);
+        }
+        c->branching[n] = branching;
+
+        // Reserve a contiguous block of slots for the children
+        uint32_t child = c->cells;
+        c->index[n] = child;
+        for (int i=0; i < 8; ++i) {
+            if (asdf->branches[i])  c->cells++;
+        }
+
+        for (int i=0; i < 8; ++i) {
+            if (asdf->branches[i])  pack_cell(c, asdf->branches[i], child++);
+        }
+    } else {
+        c->branching[n] = 0;
+        c->index[n] = c->terminals;
+
+        int16_t* const d = c->d[c->terminals++];
+        for (int a=0; a < 8; ++a) {
+            d[a] = BOUND(asdf->d[a] * c->scale, -32768, 32767);
+
+            // Preserve corner sign to ensure closed shapes
+            if (d[a] == 0 && asdf->d[a] < 0)   d[a] = -1;
+        }
+    }
+}
+
+////////////////////////////////////////////////////////////////////////////////
+
+_STATIC_
+void unpack_cell(const CompactASDF* const c, const uint32_t n,
+                 const Region r, ASDF* const out)
+{
+    *out = (ASDF){
+        .state = c->state[n],
+        .X = (Interval){r.X[0], r.X[r.ni]},
+        .Y = (Interval){r.Y[0], r.Y[r.nj]},
+        .Z = (Interval){r.Z[0], r.Z[r.nk]},
+    };
+
+    if (out->state == BRANCH) {
+        for (int i=0; i < 8; ++i) {
+            if (c->branching[n] & (1 << i))     out->branches[i] = (ASDF*)0x1;
+        }
+    } else {
+        const int16_t* const d = c->d[c->index[n]];
+        for (int a=0; a < 8; ++a)   out->d[a] = d[a] / c->scale;
+    }
+}
+
+
+_STATIC_
+uint32_t child_index(const CompactASDF* const c, const uint32_t n,
+                     const uint8_t i)
+{
+    uint32_t index = c->index[n];
+    for (int b=0; b < i; ++b) {
+        if (c->branching[n] & (1 << b))     index++;
+    }
+    return index;
+}
+
+
+_STATIC_
+Region root_region(const CompactASDF* const c)
+{
+    Region r = (Region){
+        .imin = 0,  .jmin = 0,  .kmin = 0,
+        .ni = c->ni, .nj = c->nj, .nk = c->nk,
+        .voxels = c->ni * c->nj * c->nk
+    };
+    build_arrays(&r, c->X.lower, c->Y.lower, c->Z.lower,
+                     c->X.upper, c->Y.upper, c->Z.upper);
+    return r;
+}
+
+////////////////////////////////////////////////////////////////////////////////
+
+ASDF* expand_compact(const CompactASDF* const c)
+{
+    if (!c)     return NULL;
+
+    Region r = root_region(c);
+    ASDF* const asdf = expand_cell(c, 0, r);
+    free_arrays(&r);
+
+    return asdf;
+}
+
+
+ASDF* expand_compact_branch(const CompactASDF* const c, const uint8_t branch)
+{
+    if (!c || c->state[0] != BRANCH || branch >= 8 ||
+        !(c->branching[0] & (1 << branch)))
+    {
+        return NULL;
+    }
+
+    Region r = root_region(c);
+
+    ASDF root;
+    unpack_cell(c, 0, r, &root);
+
+    Region octants[8];
+    octsect_merged(r, &root, octants);
+    ASDF* const asdf = expand_cell(c, child_index(c, 0, branch),
+                                   octants[branch]);
+    free_arrays(&r);
+
+    return asdf;
+}
+
+
+_STATIC_
+ASDF* expand_cell(const CompactASDF* const c, const uint32_t n,
+                  const Region r)
+{
+    ASDF* const asdf = malloc(sizeof(ASDF));
+    unpack_cell(c, n, r, asdf);
+
+    if (asdf->state == BRANCH) {
+        Region octants[8];
+        octsect_merged(r, asdf, octants);
+
+        // Replace the dummy pointers with real branches
+        for (int i=0; i < 8; ++i) {
+            if (asdf->branches[i]) {
+                asdf->branches[i] = expand_cell(c, child_index(c, n, i),
+                                                octants[i]);
+            }
+        }
+
+        // Pull corner values from children
+        get_d_from_children(asdf);
+    }
+
+    return asdf;
+}
+
+////////////////////////////////////////////////////////////////////////////////
+
+void free_compact(CompactASDF* const c)
+{
+    if (!c)     return;
+    free(c->state);
+    free(c->branching);
+    free(c->index);
+    free(c->d);
+    free(c);
+}
+
+
+size_t compact_bytes(const CompactASDF* const c)
+{
+    if (!c)     return 0;
+    return sizeof(CompactASDF) +
+           c->cells * (2*sizeof(uint8_t) + sizeof(uint32_t)) +
+           c->terminals * sizeof(*c->d);
+}
+
+
+void compact_scale(CompactASDF* const c, const float scale)
+{
+    if (!c)     return;
+
+    c->X.lower *= scale;
+    c->X.upper *= scale;
+    c->Y.lower *= scale;
+    c->Y.upper *= scale;
+    c->Z.lower *= scale;
+    c->Z.upper *= scale;
+}
+
+////////////////////////////////////////////////////////////////////////////////
+
+void render_compact_shaded(const CompactASDF* const c, const Region r,
+                           const float M[4], uint16_t*const*const depth,
+                           uint16_t*const*const shaded,
+                           uint8_t (**normals)[3])
+{
+    if (!c)     return;
+
+    Region lattice = root_region(c);
+    render_cell(c, 0, lattice, r, M, depth, shaded, normals);
+    free_arrays(&lattice);
+}
+
+
+_STATIC_
+void render_cell(const CompactASDF* const c, const uint32_t n,
+                 const Region lattice, const Region r_,
+                 const float M[4], uint16_t*const*const depth,
+                 uint16_t*const*const shaded, uint8_t (**normals)[3])
+{
+    ASDF cell;
+    unpack_cell(c, n, lattice, &cell);
+
+    if (cell.state == EMPTY)    return;
+
+    // Terminal cells are drawn by the usual renderer
+    if (cell.state != BRANCH) {
+        render_asdf_shaded(&cell, r_, M, depth, shaded, normals);
+        return;
+    }
+
+    // Shrink the region based on the bounds of this cell
+    // (taking the rotation matrix into account)
+    const Region r = rot_bound_region(&cell, r_, M);
+    if (r.voxels == 0)  return;
+
+    Region octants[8];
+    octsect_merged(lattice, &cell, octants);
+    for (int i=0; i < 8; ++i) {
+        if (cell.branches[i]) {
+            render_cell(c, child_index(c, n, i), octants[i], r,
+                        M, depth, shaded, normals);
+        }
+    }
+}
+
+////////////////////////////////////////////////////////////////////////////////
+
+ASDF* compact_slice(const CompactASDF* const c, const float z)
+{
+    if (!c)     return NULL;
+
+    Region r = root_region(c);
+    ASDF* const out = slice_cell(c, 0, r, z);
+    free_arrays(&r);
+
+    return out;
+}
+
+
+_STATIC_
+ASDF* slice_cell(const CompactASDF* const c, const uint32_t n,
+                 const Region r, const float z)
+{
+    ASDF cell;
+    unpack_cell(c, n, r, &cell);
+
+    ASDF* const out = calloc(1, sizeof(ASDF));
+    *out = (ASDF){
+        .state = BRANCH,
+        .X = cell.X,
+        .Y = cell.Y,
+        .Z = (Interval){z, z}
+    };
+
+    if (cell.state == LEAF) {
+        out->state = LEAF;
+        for (int i=0; i < 8; ++i) {
+            out->d[i] = asdf_interpolate(&cell,
+                i & 4 ? cell.X.upper : cell.X.lower,
+                i & 2 ? cell.Y.upper : cell.Y.lower,
+                z);
+        }
+    } else if (cell.state == FILLED) {
+        out->state = FILLED;
+    } else if (cell.state == EMPTY) {
+        out->state = EMPTY;
+    } else if (cell.state == BRANCH) {
+        Region octants[8];
+        octsect_merged(r, &cell, octants);
+
+        uint8_t upper = cell.branches[1] && z > octants[1].Z[0];
+        for (int i=0; i < 8; i += 2) {
+            if (cell.branches[i+upper]) {
+                out->branches[i] = slice_cell(
+                    c, child_index(c, n, i+upper), octants[i+upper], z);
+            }
+        }
+    }
+
+    return out;
+}
@@ -0,0 +1,127 @@
+#ifndef COMPACT_H
+#define COMPACT_H
+
+#include <stdint.h>
+#include <stddef.h>
+
+#include "util/interval.h"
+#include "util/region.h"
+
+struct ASDF_;
+
+/** @struct CompactASDF_
+    @brief An ASDF stored as a linear octree in contiguous arrays
+
+    @details
+    Cells are numbered from the root (cell 0), and a branch's children
+    are stored next to each other, so each branch only needs the index
+    of its first child.  Cell bounds aren't stored: as in the .asdf file
+    format, they're found by splitting the root's lattice with
+    octsect_merged.  Corner values are stored only for terminal cells
+    (FILLED, EMPTY, and LEAF), quantized to 16 bits with a shared scale.
+*/
+typedef struct CompactASDF_ {
+    /** @var X
+        X bounds of the root cell */
+    /** @var Y
+        Y bounds of the root cell */
+    /** @var Z
+        Z bounds of the root cell */
+    Interval X, Y, Z;
+
+    /** @var ni
+        Lattice size along the x axis */
+    /** @var nj
+        Lattice size along the y axis */
+    /** @var nk
+        Lattice size along the z axis */
+    int32_t ni, nj, nk;
+
+    /** @var scale
+        Scale used to quantize corner values (value = d / scale) */
+    float scale;
+
+    /** @var cells
+        Number of cells */
+    uint32_t cells;
+
+    /** @var terminals
+        Number of terminal cells (and rows in the d array) */
+    uint32_t terminals;
+
+    /** @var state
+        State of each cell (an ASDFstate) */
+    uint8_t* state;
+
+    /** @var branching
+        Bit field of populated branches for each cell (0 if not a branch) */
+    uint8_t* branching;
+
+    /** @var index
+        For branches, index of the first child; for terminal cells,
+        row in the d array. */
+    uint32_t* index;
+
+    /** @var d
+        Quantized corner values for each terminal cell */
+    int16_t (*d)[8];
+} CompactASDF;
+
+
+/** @brief Packs an ASDF into a CompactASDF
+    @details Corner values are quantized in the same way as the
+    .asdf file format.
+*/
+CompactASDF* compact_asdf(const struct ASDF_* const asdf);
+
+
+/** @brief Unpacks a CompactASDF into a pointer-based ASDF
+*/
+struct ASDF_* expand_compact(const CompactASDF* const c);
+
+
+/** @brief Unpacks one of the root cell's branches into a pointer-based ASDF
+    @returns The branch, or NULL if it doesn't exist
+*/
+struct ASDF_* expand_compact_branch(const CompactASDF* const c,
+                                    const uint8_t branch);
+
+
+/** @brief Frees a CompactASDF
+*/
+void free_compact(CompactASDF* const c);
+
+
+/** @brief Returns the number of bytes used by a CompactASDF
+*/
+size_t compact_bytes(const CompactASDF* const c);
+
+
+/** @brief Scales a CompactASDF's bounds (as in asdf_scale)
+*/
+void compact_scale(CompactASDF* const c, const float scale);
+
+
+/** @brief Renders a CompactASDF to a height-map image, shaded,
+    and normals image
+    @details Works like render_asdf_shaded, but only unpacks one cell
+    at a time.
+    @param c CompactASDF to render
+    @param r Render region (ni, nj must be lattice dimensions)
+    @param M Array of rotation parameters [cos(a), sin(a), cos(b), sin(b)]
+    @param depth Height-map lattice to populate
+    @param shaded Shaded image to populate with shaded render
+    @param normals RGB image to populate with colored normals
+*/
+void render_compact_shaded(const CompactASDF* const c, const Region r,
+                           const float M[4], uint16_t*const*const depth,
+                           uint16_t*const*const shaded,
+                           uint8_t (**normals)[3]);
+
+
+/** @brief Finds a 2D ASDF at a given z height (as in asdf_slice)
+    @returns A pointer-based ASDF
+*/
+struct ASDF_* compact_slice(const CompactASDF* const c, const float z);
+
+#endif
@@ -1,20 +1,166 @@
 #include <stdlib.h>
+#include <string.h>
 #include <math.h>
 
+#include <zlib.h>
+
 #include "asdf/asdf.h"
 #include "asdf/cache.h"
 #include "asdf/file_io.h"
 
 #include "util/region.h"
+#include "util/taskpool.h"
 #include "util/macros.h"
 
+/** @struct Buffer_
+    @brief A growable block of bytes
+    @details If file is set, the buffer is written out whenever it fills
+    up (and by buffer_flush), rather than growing.
+*/
+typedef struct Buffer_ {
+    uint8_t* data;
+    size_t size;
+    size_t alloc;
+    FILE* file;
+} Buffer;
+
+/** @struct Reader_
+    @brief A cursor into a block of bytes
+*/
+typedef struct Reader_ {
+    const uint8_t* data;
+    size_t size;
+    size_t pos;
+} Reader;
+
+/** @struct BlockEntry_
+    @brief Index entry describing one compressed block of a v3 file
+*/
+typedef struct BlockEntry_ {
+    float bounds[6];
+    uint64_t offset;
+    uint32_t packed;
+    uint32_t size;
+} BlockEntry;
+
+/** @struct WriteBlock_
+    @brief A subtree to be encoded and compressed as one v3 block
+*/
+typedef struct WriteBlock_ {
+    const ASDF* asdf;
+    Region region;
+    uint8_t* packed;
+    uint32_t packed_size;
+    uint32_t size;
+} WriteBlock;
+
+/** @struct ReadBlock_
+    @brief A v3 block to be decompressed and decoded into a cell
+    @details The cell is a placeholder in the tree; it's overwritten
+    by the decoded subtree's root.
+*/
+typedef struct ReadBlock_ {
+    ASDF* cell;
+    Region region;
+    int depth;
+    const BlockEntry* entry;
+    uint8_t* packed;
+} ReadBlock;
+
+/** @struct PartialRead_
+    @brief Index and settings used while loading part of a v3 file
+*/
+typedef struct PartialRead_ {
+    float scale;
+    const BlockEntry* blocks;
+    uint32_t count;
+    uint32_t next;
+    Interval X, Y, Z;
+    int max_depth;
+
+    ReadBlock* pending;
+    uint32_t pending_count;
+} PartialRead;
+
+/** @struct BlockJob_
+    @brief Blocks shared between threads by write_block_task
+    and read_block_task
+*/
+typedef struct BlockJob_ {
+    void* blocks;
+    uint32_t count;
+    float scale;
+    int max_depth;
+} BlockJob;
+
+/** @var BLOCK_LEVELS
+    Target number of levels in each compressed block of a v3 file */
+#define BLOCK_LEVELS 5
+
+/** @var MAX_BLOCK_DEPTH
+    Maximum depth at which v3 blocks begin (limiting the index size) */
+#define MAX_BLOCK_DEPTH 4
+
+/** @var FILE_BUFFER
+    Size of the buffer used when streaming a file out */
+#define FILE_BUFFER (1 << 20)
+
 /* Forward declarations */
 _STATIC_
-ASDF*  asdf_read_2_0(FILE* file);
+void buffer_put(Buffer* const b, const void* const data, const size_t n);
+
+_STATIC_
+void buffer_flush(Buffer* const b);
+
+_STATIC_
+uint8_t* read_rest(FILE* file, size_t* const size);
+
+_STATIC_
+_Bool reader_get(Reader* const r, void* const data, const size_t n);
+
+_STATIC_
+float asdf_quantize_scale(const ASDF* const asdf);
+
+_STATIC_
+int16_t quantize(const float d, const float scale);
+
+_STATIC_
+void truncate_asdf(ASDF* const asdf, const int depth, const int max_depth);
 
 _STATIC_
-ASDF* _asdf_read_2_0(
-    FILE* file, Region r, Corner* const cache, const float scale);
+ASDF*  asdf_read_3_0(FILE* file, const Interval X, const Interval Y,
+                     const Interval Z, const int max_depth,
+                     const unsigned threads);
+
+_STATIC_
+ASDF* read_skeleton_3_0(Reader* const in, const Region r,
+                        const int depth, PartialRead* const p);
+
+_STATIC_
+void read_block_task(TaskPool* pool, unsigned worker, void* task, void* data);
+
+_STATIC_
+ASDF* decode_cells(Reader* const in, const Region r, Corner* const cache,
+                   const float scale, const int depth, const int max_depth);
+
+_STATIC_
+_Bool asdf_write_3_0(ASDF* const asdf, FILE* file, const unsigned threads);
+
+_STATIC_
+void write_skeleton_3_0(const ASDF* const asdf, Buffer* const out,
+                        const Region r, const int depth,
+                        const int block_depth, const float scale,
+                        WriteBlock* const blocks, uint32_t* const count);
+
+_STATIC_
+void write_block_task(TaskPool* pool, unsigned worker, void* task, void* data);
+
+_STATIC_
+void encode_cells(const ASDF* const asdf, Buffer* const out,
+                  const Region r, Corner* const cache, const float scale);
+
+_STATIC_
+ASDF*  asdf_read_2_0(FILE* file);
 
 _STATIC_
 ASDF*  asdf_read_1_4(FILE* file);
@@ -46,11 +192,6 @@ ASDF*  asdf_read_1_0(FILE* file);
 _STATIC_
 void asdf_write_2_0(ASDF* const asdf, FILE* file);
 
-_STATIC_
-void _asdf_write_2_0(
-    ASDF* const asdf, FILE* file, Region const r,
-    Corner* const cache, const float scale);
-
 _STATIC_
 void  asdf_write_1_4(const ASDF* const asdf, FILE* file);
 
@@ -85,11 +226,21 @@ void _asdf_write_1_0(const ASDF* const asdf, FILE* file);
 
 
 void asdf_write(ASDF* const asdf, const char* filename)
+{
+    asdf_write_parallel(asdf, filename, 3, 0, 1);
+}
+
+_Bool asdf_write_parallel(ASDF* const asdf, const char* filename,
+                          const int version_major, const int version_minor,
+                          const unsigned threads)
 {
     FILE* file = fopen(filename, "wb");
+    if (!file) {
+        printf("Error: could not open .asdf file for writing\n");
+        return false;
+    }
 
-    const int version_major = 2;
-    const int version_minor = 0;
+    _Bool ok = true;
 
     if (version_major == 1 && version_minor == 0) {
         asdf_write_1_0(asdf, file);
@@ -103,14 +254,29 @@ void asdf_write(ASDF* const asdf, const char* filename)
         asdf_write_1_4(asdf, file);
     } else if (version_major == 2 && version_minor == 0) {
         asdf_write_2_0(asdf, file);
+    } else if (version_major == 3 && version_minor == 0) {
+        ok = asdf_write_3_0(asdf, file, threads ? threads : 1);
     } else {
         printf("Error: Invalid version number for .asdf file\n");
+        ok = false;
     }
 
     fclose(file);
+
+    // Don't leave a partially written file behind
+    if (!ok)    remove(filename);
+    return ok;
 }
 
 ASDF* asdf_read(const char* filename)
+{
+    const Interval all = (Interval){-INFINITY, INFINITY};
+    return asdf_read_partial(filename, all, all, all, -1, 1);
+}
+
+ASDF* asdf_read_partial(const char* filename, const Interval X,
+                        const Interval Y, const Interval Z,
+                        const int max_depth, const unsigned threads)
 {
     FILE* file = fopen(filename, "rb");
     char a = fgetc(file);
@@ -139,37 +305,83 @@ ASDF* asdf_read(const char* filename)
         asdf = asdf_read_1_4(file);
     } else if (version_major == 2 && version_minor == 0) {
         asdf = asdf_read_2_0(file);
+    } else if (version_major == 3 && version_minor == 0) {
+        asdf = asdf_read_3_0(file, X, Y, Z, max_depth,
+                             threads ? threads : 1);
     } else {
         printf("Error: Invalid version number for .asdf file\n");
     }
     fclose(file);
+
+    // Older formats are always read in full, then cut down to size.
+    if (version_major < 3)  truncate_asdf(asdf, 0, max_depth);
+
     return asdf;
 }
 
 ////////////////////////////////////////////////////////////////////////////////
 
 _STATIC_
-void asdf_write_2_0(ASDF* const asdf, FILE* file)
+void buffer_put(Buffer* const b, const void* const data, const size_t n)
 {
-    fprintf(file, "ASDF%c%c", 2, 0);
+    if (b->file && b->size + n > b->alloc && b->size) {
+        fwrite(b->data, 1, b->size, b->file);
+        b->size = 0;
+    }
 
-    int ni, nj, nk;
-    find_dimensions(asdf, &ni, &nj, &nk);
+    if (b->size + n > b->alloc) {
+        if (b->alloc)           b->alloc *= 2;
+        else if (b->file)       b->alloc = FILE_BUFFER;
+        else                    b->alloc = 4096;
+        while (b->size + n > b->alloc)  b->alloc *= 2;
+        b->data = realloc(b->data, b->alloc);
+    }
+    memcpy(b->data + b->size, data, n);
+    b->size += n;
+}
 
-    float header_f[6] = {
-        asdf->X.lower, asdf->X.upper,
-        asdf->Y.lower, asdf->Y.upper,
-        asdf->Z.lower, asdf->Z.upper
-    };
-    int32_t header_i[3] = {ni, nj, nk};
 
-    for (int i=0; i < sizeof(header_f); ++i) {
-        fputc(((char*)&header_f)[i], file);
-    }
-    for (int i=0; i < sizeof(header_i); ++i) {
-        fputc(((char*)&header_i)[i], file);
+_STATIC_
+void buffer_flush(Buffer* const b)
+{
+    if (b->file && b->size)     fwrite(b->data, 1, b->size, b->file);
+    free(b->data);
+    *b = (Buffer){.file=b->file};
+}
+
+
+_STATIC_
+uint8_t* read_rest(FILE* file, size_t* const size)
+{
+    const long start = ftell(file);
+    fseek(file, 0, SEEK_END);
+    const long end = ftell(file);
+    fseek(file, start, SEEK_SET);
+
+    *size = end > start ? end - start : 0;
+    uint8_t* const data = malloc(*size ? *size : 1);
+    *size = fread(data, 1, *size, file);
+    return data;
+}
+
+
+_STATIC_
+_Bool reader_get(Reader* const r, void* const data, const size_t n)
+{
+    if (r->pos + n > r->size) {
+        memset(data, 0, n);
+        r->pos = r->size;
+        return false;
     }
+    memcpy(data, r->data + r->pos, n);
+    r->pos += n;
+    return true;
+}
+
 
+_STATIC_
+float asdf_quantize_scale(const ASDF* const asdf)
+{
     // We'll get fifteen bits of resolution on each side
     const float min = asdf_get_min(asdf);
     const float max = asdf_get_max(asdf);
@@ -178,40 +390,253 @@ void asdf_write_2_0(ASDF* const asdf, FILE* file)
     if (fabs(max) > fabs(min))  scale /= fabs(max);
     else                        scale /= fabs(min);
 
-    // Write the scale to file
-    for (int i=0; i < sizeof(scale); ++i) {
-        fputc( ((char*)&scale)[i], file);
+    // An ASDF that's zero everywhere can use any scale
+    return isfinite(scale) ? scale : 1;
+}
+
+
+_STATIC_
+int16_t quantize(const float d, const float scale)
+{
+    int16_t v = BOUND(d * scale, -32768, 32767);
+
+    // Preserve corner sign to ensure closed shapes
+    if (v == 0 && d < 0)    v = -1;
+    return v;
+}
+
+
+_STATIC_
+void truncate_asdf(ASDF* const asdf, const int depth, const int max_depth)
+{
+    if (!asdf || asdf->state != BRANCH || max_depth < 0)    return;
+
+    if (depth < max_depth) {
+        for (int i=0; i < 8; ++i) {
+            truncate_asdf(asdf->branches[i], depth + 1, max_depth);
+        }
+        return;
     }
 
+    // Corner values were already pulled up from the children,
+    // so this cell can stand in for its subtree.
+    for (int i=0; i < 8; ++i) {
+        free_asdf(asdf->branches[i]);
+        asdf->branches[i] = NULL;
+    }
+    asdf->state = LEAF;
+}
+
+////////////////////////////////////////////////////////////////////////////////
+
+/*  Version 3.0 files have the following layout:
+ *      "ASDF", 3, 0
+ *      Root bounds (6 floats), lattice size (3 int32), quantization scale
+ *      Block depth (uint8)
+ *      Skeleton size (uint32) and skeleton records
+ *      Block count (uint32) and block index
+ *      zlib-compressed blocks
+ *
+ *  The skeleton holds the top of the tree in depth-first order.  Each
+ *  record is a state character ('B', 'F', 'E', 'L', or 'S') followed by
+ *  eight quantized corner values; 'B' records are also followed by a
+ *  branching bit field.  'S' marks a branch at the block depth, whose
+ *  subtree is stored in the next block.
+ *
+ *  Each block is compressed separately and holds a subtree in the same
+ *  form as version 2.0 files.  The index lists each block's bounds,
+ *  file offset, and compressed and uncompressed sizes, so a reader can
+ *  skip blocks that it doesn't need.
+ */
+
+_STATIC_
+_Bool asdf_write_3_0(ASDF* const asdf, FILE* file, const unsigned threads)
+{
+    fprintf(file, "ASDF%c%c", 3, 0);
+
+    int ni, nj, nk;
+    find_dimensions(asdf, &ni, &nj, &nk);
+
+    const float header_f[6] = {
+        asdf->X.lower, asdf->X.upper,
+        asdf->Y.lower, asdf->Y.upper,
+        asdf->Z.lower, asdf->Z.upper
+    };
+    const int32_t header_i[3] = {ni, nj, nk};
+    const float scale = asdf_quantize_scale(asdf);
+    const uint8_t block_depth = BOUND(get_depth(asdf) - 1 - BLOCK_LEVELS,
+                                      0, MAX_BLOCK_DEPTH);
+
+    fwrite(header_f, sizeof(header_f), 1, file);
+    fwrite(header_i, sizeof(header_i), 1, file);
+    fwrite(&scale, sizeof(scale), 1, file);
+    fwrite(&block_depth, sizeof(block_depth), 1, file);
+
     Region r = (Region){
         .imin = 0,  .jmin = 0,  .kmin = 0,
         .ni   = ni, .nj   = nj, .nk   = nk,
         .voxels = ni*nj*nk
     };
+    build_arrays(&r, asdf->X.lower, asdf->Y.lower, asdf->Z.lower,
+                     asdf->X.upper, asdf->Y.upper, asdf->Z.upper);
+
+    // Encode the skeleton and find the subtree stored in each block.
+    // There's at most one block for each cell at the block depth.
+    const uint32_t max_blocks = 1 << (3*block_depth);
+    WriteBlock* const blocks = calloc(max_blocks, sizeof(WriteBlock));
+    uint32_t count = 0;
+
+    Buffer skeleton = {0};
+    write_skeleton_3_0(asdf, &skeleton, r, 0, block_depth, scale,
+                       blocks, &count);
+
+    // Blocks don't share corners, so they can be encoded and
+    // compressed independently (the first task hands them out).
+    BlockJob job = (BlockJob){.blocks=blocks, .count=count, .scale=scale};
+    const int32_t first = -1;
+    run_taskpool(threads, sizeof(first), &first, write_block_task, &job, NULL);
+
+    // The blocks' regions point into the root region's arrays
+    free_arrays(&r);
+
+    _Bool ok = true;
+    for (uint32_t b=0; b < count; ++b)  ok = ok && blocks[b].packed;
+    if (!ok) {
+        printf("Error: could not compress block for .asdf file\n");
+        for (uint32_t b=0; b < count; ++b)  free(blocks[b].packed);
+        free(blocks);
+        free(skeleton.data);
+        return false;
+    }
+
+    const uint32_t skeleton_size = skeleton.size;
+    fwrite(&skeleton_size, sizeof(skeleton_size), 1, file);
+    fwrite(skeleton.data, 1, skeleton.size, file);
+    free(skeleton.data);
+
+    // Now that every block's compressed size is known, the index
+    // can be written out before the blocks themselves.
+    fwrite(&count, sizeof(count), 1, file);
+    uint64_t offset = ftell(file) + count * sizeof(BlockEntry);
+
+    BlockEntry* const index = calloc(count ? count : 1, sizeof(BlockEntry));
+    for (uint32_t b=0; b < count; ++b) {
+        const ASDF* const cell = blocks[b].asdf;
+        index[b] = (BlockEntry){
+            .bounds = {cell->X.lower, cell->X.upper,
+                       cell->Y.lower, cell->Y.upper,
+                       cell->Z.lower, cell->Z.upper},
+            .offset = offset,
+            .packed = blocks[b].packed_size,
+            .size = blocks[b].size
+        };
+        offset += blocks[b].packed_size;
+    }
+    fwrite(index, sizeof(BlockEntry), count, file);
+    free(index);
+
+    for (uint32_t b=0; b < count; ++b) {
+        fwrite(blocks[b].packed, 1, blocks[b].packed_size, file);
+        free(blocks[b].packed);
+    }
+    free(blocks);
+
+    return true;
+}
+
+
+_STATIC_
+void write_skeleton_3_0(const ASDF* const asdf, Buffer* const out,
+                        const Region r, const int depth,
+                        const int block_depth, const float scale,
+                        WriteBlock* const blocks, uint32_t* const count)
+{
+    char state;
+    if (asdf->state == BRANCH)  state = depth < block_depth ? 'B' : 'S';
+    else if (asdf->state == FILLED) state = 'F';
+    else if (asdf->state == EMPTY)  state = 'E';
+    else                            state = 'L';
+    buffer_put(out, &state, 1);
+
+    for (int a=0; a < 8; ++a) {
+        const int16_t v = quantize(asdf->d[a], scale);
+        buffer_put(out, &v, sizeof(v));
+    }
+
+    if (state == 'B') {
+        uint8_t branching = 0;
+        for (int i=0; i < 8; ++i) {
+            if (asdf->branches[i])  branching |= (1 << i);
+        }
+        buffer_put(out, &branching, 1);
+
+        Region octants[8];
+        octsect_merged(r, asdf, octants);
+        for (int i=0; i < 8; ++i) {
+            if (asdf->branches[i]) {
+                write_skeleton_3_0(asdf->branches[i], out, octants[i],
+                                   depth + 1, block_depth, scale,
+                                   blocks, count);
+            }
+        }
+    } else if (state == 'S') {
+        blocks[(*count)++] = (WriteBlock){.asdf=asdf, .region=r};
+    }
+}
+
+
+_STATIC_
+void write_block_task(TaskPool* pool, unsigned worker, void* task, void* data)
+{
+    const int32_t b = *(int32_t*)task;
+    BlockJob* const job = data;
+
+    if (b < 0) {
+        for (int32_t i=job->count - 1; i >= 0; --i) {
+            taskpool_push(pool, worker, &i);
+        }
+        return;
+    }
+
+    WriteBlock* const block = (WriteBlock*)job->blocks + b;
+
     Corner* const cache = calloc(1, sizeof(Corner));
     cache->value = NAN;
 
-    _asdf_write_2_0(asdf, file, r, cache, scale);
-
+    Buffer raw = {0};
+    encode_cells(block->asdf, &raw, block->region, cache, job->scale);
     free_corner_cache(cache);
+
+    uLongf packed = compressBound(raw.size);
+    block->packed = malloc(packed);
+    if (compress2(block->packed, &packed, raw.data, raw.size,
+                  Z_DEFAULT_COMPRESSION) != Z_OK)
+    {
+        // A NULL block marks the write as failed
+        free(block->packed);
+        block->packed = NULL;
+        packed = 0;
+    }
+
+    block->packed_size = packed;
+    block->size = raw.size;
+    free(raw.data);
 }
 
+
 _STATIC_
-void _asdf_write_2_0(
-    ASDF* const asdf, FILE* file, Region const r,
-    Corner* const cache, const float scale)
+void encode_cells(const ASDF* const asdf, Buffer* const out,
+                  const Region r, Corner* const cache, const float scale)
 {
     if (asdf->state == BRANCH) {
-        fprintf(file, "B");
+        buffer_put(out, "B", 1);
 
         // Write out the populated branches as a bit field
-        char branching = 0;
+        uint8_t branching = 0;
         for (int i=0; i < 8; ++i) {
-            if (asdf->branches[i]) {
-                branching |= (1 << i);
-            }
+            if (asdf->branches[i])  branching |= (1 << i);
         }
-        fputc(branching, file);
+        buffer_put(out, &branching, 1);
 
         Region octants[8];
         octsect_merged(r, asdf, octants);
@@ -224,20 +649,18 @@ void _asdf_write_2_0(
             r.kmin, r.kmin+r.nk
         );
 
-        // Write out the branches one by one
         for (int i=0; i < 8; ++i) {
             if (asdf->branches[i]) {
-                _asdf_write_2_0(
-                    asdf->branches[i], file, octants[i],
-                    subcache, scale
-                );
+                encode_cells(asdf->branches[i], out, octants[i],
+                             subcache, scale);
             }
         }
     } else {
-        if (asdf->state == FILLED)      fprintf(file, "F");
-        else if (asdf->state == EMPTY)  fprintf(file, "E");
-        else if (asdf->state == LEAF)   fprintf(file, "L");
+        if (asdf->state == FILLED)      buffer_put(out, "F", 1);
+        else if (asdf->state == EMPTY)  buffer_put(out, "E", 1);
+        else if (asdf->state == LEAF)   buffer_put(out, "L", 1);
 
+        // Only write corners that haven't been written before
         for (int a=0; a < 8; ++a) {
             Corner* const pt = get_corner(
                 cache,
@@ -247,60 +670,228 @@ void _asdf_write_2_0(
             );
             if (isnan(pt->value)) {
                 pt->value = asdf->d[a];
-                int16_t v = BOUND(pt->value * scale, -32768, 32767);
-                // Preserve corner sign to ensure closed shapes
-                if (v == 0 && pt->value < 0) {
-                    v = -1;
-                }
-                for (int b=0; b < sizeof(v); ++b) {
-                    fputc( ((char*)&v)[b], file);
-                }
+                const int16_t v = quantize(pt->value, scale);
+                buffer_put(out, &v, sizeof(v));
             }
         }
     }
 }
 
+
 _STATIC_
-ASDF*  asdf_read_2_0(FILE* file)
+ASDF*  asdf_read_3_0(FILE* file, const Interval X, const Interval Y,
+                     const Interval Z, const int max_depth,
+                     const unsigned threads)
 {
-    float xmin, xmax, ymin, ymax, zmin, zmax;
-    int32_t ni, nj, nk;
+    float header_f[6];
+    int32_t header_i[3];
     float scale;
+    uint8_t block_depth;
+    uint32_t skeleton_size;
+
+    if (fread(header_f, sizeof(header_f), 1, file) != 1 ||
+        fread(header_i, sizeof(header_i), 1, file) != 1 ||
+        fread(&scale, sizeof(scale), 1, file) != 1 ||
+        fread(&block_depth, sizeof(block_depth), 1, file) != 1 ||
+        fread(&skeleton_size, sizeof(skeleton_size), 1, file) != 1)
+    {
+        printf("Error: truncated .asdf file\n");
+        return NULL;
+    }
 
-    fscanf(file, "%4c", (char*)&xmin);
-    fscanf(file, "%4c", (char*)&xmax);
-    fscanf(file, "%4c", (char*)&ymin);
-    fscanf(file, "%4c", (char*)&ymax);
-    fscanf(file, "%4c", (char*)&zmin);
-    fscanf(file, "%4c", (char*)&zmax);
-
-    fscanf(file, "%4c", (char*)&ni);
-    fscanf(file, "%4c", (char*)&nj);
-    fscanf(file, "%4c", (char*)&nk);
+    uint8_t* const skeleton = malloc(skeleton_size ? skeleton_size : 1);
+    uint32_t count = 0;
+    if (fread(skeleton, 1, skeleton_size, file) != skeleton_size ||
+        fread(&count, sizeof(count), 1, file) != 1)
+    {
+        printf("Error: truncated .asdf file\n");
+        free(skeleton);
+        return NULL;
+    }
 
-    fscanf(file, "%4c", (char*)&scale);
+    BlockEntry* const index = calloc(count ? count : 1, sizeof(BlockEntry));
+    if (fread(index, sizeof(BlockEntry), count, file) != count) {
+        printf("Error: truncated .asdf file\n");
+        free(skeleton);
+        free(index);
+        return NULL;
+    }
 
     Region r = (Region){
         .imin=0, .jmin=0, .kmin=0,
-        .ni=ni,  .nj=nj,  .nk=nk,
-        .voxels = ni*nj*nk
+        .ni=header_i[0],  .nj=header_i[1],  .nk=header_i[2],
+        .voxels = header_i[0]*header_i[1]*header_i[2]
     };
-    build_arrays(&r, xmin, ymin, zmin, xmax, ymax, zmax);
-
-    Corner* const cache = calloc(1, sizeof(Corner));
-    cache->value = NAN;
+    build_arrays(&r, header_f[0], header_f[2], header_f[4],
+                     header_f[1], header_f[3], header_f[5]);
+
+    // Walk the skeleton, making a list of the blocks that we need
+    PartialRead p = (PartialRead){
+        .scale=scale, .blocks=index, .count=count, .next=0,
+        .X=X, .Y=Y, .Z=Z, .max_depth=max_depth,
+        .pending=calloc(count ? count : 1, sizeof(ReadBlock)),
+        .pending_count=0
+    };
+    Reader in = (Reader){.data=skeleton, .size=skeleton_size, .pos=0};
+    ASDF* const asdf = read_skeleton_3_0(&in, r, 0, &p);
+    free(skeleton);
+
+    // Pull the compressed blocks in with one pass through the file
+    // (they're stored in the same order as the skeleton)
+    for (uint32_t b=0; b < p.pending_count; ++b) {
+        ReadBlock* const block = &p.pending[b];
+        block->packed = malloc(block->entry->packed ?
+                               block->entry->packed : 1);
+        if (fseek(file, block->entry->offset, SEEK_SET) ||
+            fread(block->packed, 1, block->entry->packed, file)
+                != block->entry->packed)
+        {
+            printf("Error: could not read block from .asdf file\n");
+            free(block->packed);
+            block->packed = NULL;
+        }
+    }
 
-    ASDF* asdf = _asdf_read_2_0(file, r, cache, scale);
+    // Then decompress and decode them in parallel
+    BlockJob job = (BlockJob){
+        .blocks=p.pending, .count=p.pending_count,
+        .scale=scale, .max_depth=max_depth
+    };
+    const int32_t first = -1;
+    run_taskpool(threads, sizeof(first), &first, read_block_task, &job, NULL);
 
     free_arrays(&r);
-    free_corner_cache(cache);
+    free(p.pending);
+    free(index);
+
+    return asdf;
+}
+
+
+_STATIC_
+ASDF* read_skeleton_3_0(Reader* const in, const Region r,
+                        const int depth, PartialRead* const p)
+{
+    ASDF* asdf = calloc(1, sizeof(ASDF));
+    *asdf = (ASDF) {
+        .X=(Interval){.lower=r.X[0], .upper=r.X[r.ni]},
+        .Y=(Interval){.lower=r.Y[0], .upper=r.Y[r.nj]},
+        .Z=(Interval){.lower=r.Z[0], .upper=r.Z[r.nk]},
+    };
+
+    char c = 0;
+    reader_get(in, &c, 1);
+    for (int a=0; a < 8; ++a) {
+        int16_t v;
+        reader_get(in, &v, sizeof(v));
+        asdf->d[a] = v / p->scale;
+    }
+
+    const _Bool truncated = p->max_depth >= 0 && depth >= p->max_depth;
+
+    if (c == 'B') {
+        asdf->state = BRANCH;
+
+        uint8_t branching = 0;
+        reader_get(in, &branching, 1);
+
+        // Put a dummy pointer in the appropriate places in asdf->branches
+        // so that octsect_merged splits in the right way.
+        for (int i=0; i < 8; ++i) {
+            if (branching & (1 << i))   asdf->branches[i] = (ASDF*)0x1;
+        }
+
+        Region octants[8];
+        octsect_merged(r, asdf, octants);
+
+        // Subtrees are always read, since they use up skeleton records
+        // and blocks even if they're about to be discarded.
+        for (int i=0; i < 8; ++i) {
+            if (asdf->branches[i]) {
+                asdf->branches[i] = read_skeleton_3_0(
+                    in, octants[i], depth + 1, p);
+            }
+        }
+
+        if (truncated)  truncate_asdf(asdf, depth, p->max_depth);
+
+    } else if (c == 'S') {
+        const BlockEntry* const block = p->next < p->count ?
+                                        &p->blocks[p->next] : NULL;
+        p->next++;
+
+        // Blocks that aren't needed are replaced by a leaf cell
+        // with the subtree's corner values.  Blocks that are needed
+        // are loaded later on, replacing this cell.
+        asdf->state = LEAF;
+        if (block && !truncated &&
+            block->bounds[1] >= p->X.lower && block->bounds[0] <= p->X.upper &&
+            block->bounds[3] >= p->Y.lower && block->bounds[2] <= p->Y.upper &&
+            block->bounds[5] >= p->Z.lower && block->bounds[4] <= p->Z.upper)
+        {
+            p->pending[p->pending_count++] = (ReadBlock){
+                .cell=asdf, .region=r, .depth=depth, .entry=block
+            };
+        }
+
+    } else if (c == 'F') {
+        asdf->state = FILLED;
+    } else if (c == 'E') {
+        asdf->state = EMPTY;
+    } else {
+        asdf->state = LEAF;
+    }
 
     return asdf;
 }
 
+
+_STATIC_
+void read_block_task(TaskPool* pool, unsigned worker, void* task, void* data)
+{
+    const int32_t b = *(int32_t*)task;
+    BlockJob* const job = data;
+
+    if (b < 0) {
+        for (int32_t i=job->count - 1; i >= 0; --i) {
+            taskpool_push(pool, worker, &i);
+        }
+        return;
+    }
+
+    ReadBlock* const block = (ReadBlock*)job->blocks + b;
+    if (!block->packed)     return;
+
+    const BlockEntry* const entry = block->entry;
+    uint8_t* const raw = malloc(entry->size ? entry->size : 1);
+
+    uLongf size = entry->size;
+    if (uncompress(raw, &size, block->packed, entry->packed) == Z_OK) {
+        Corner* const cache = calloc(1, sizeof(Corner));
+        cache->value = NAN;
+
+        Reader in = (Reader){.data=raw, .size=size, .pos=0};
+        ASDF* const subtree = decode_cells(&in, block->region, cache,
+                                           job->scale, block->depth,
+                                           job->max_depth);
+        free_corner_cache(cache);
+
+        // Move the subtree's root into the placeholder cell, so that
+        // its parent's branch pointer stays valid.
+        *block->cell = *subtree;
+        free(subtree);
+    } else {
+        printf("Error: could not read block from .asdf file\n");
+    }
+
+    free(raw);
+    free(block->packed);
+}
+
+
 _STATIC_
-ASDF* _asdf_read_2_0(
-    FILE* file, Region r, Corner* const cache, const float scale)
+ASDF* decode_cells(Reader* const in, const Region r, Corner* const cache,
+                   const float scale, const int depth, const int max_depth)
 {
     ASDF* const asdf = calloc(1, sizeof(ASDF));
     *asdf = (ASDF) {
@@ -309,19 +900,19 @@ ASDF* _asdf_read_2_0(
         .Z=(Interval){.lower=r.Z[0], .upper=r.Z[r.nk]},
     };
 
-    const char c = fgetc(file);
+    char c = 0;
+    reader_get(in, &c, 1);
     if (c == 'B') {
         asdf->state = BRANCH;
 
         // Get the bitfield marking split pattern
-        const uint8_t branching = fgetc(file);
+        uint8_t branching = 0;
+        reader_get(in, &branching, 1);
 
         // Put a dummy pointer in the appropriate places in asdf->branches
         // so that octsect_merged splits in the right way.
         for (int i=0; i < 8; ++i) {
-            if (branching & (1 << i)) {
-                asdf->branches[i] = (ASDF*)0x1;
-            }
+            if (branching & (1 << i))   asdf->branches[i] = (ASDF*)0x1;
         }
 
         // Split the region
@@ -339,8 +930,8 @@ ASDF* _asdf_read_2_0(
         // Read in subtrees if they exist
         for (int i=0; i < 8; ++i) {
             if (asdf->branches[i]) {
-                asdf->branches[i] = _asdf_read_2_0(
-                    file, octants[i], subcache, scale
+                asdf->branches[i] = decode_cells(
+                    in, octants[i], subcache, scale, depth + 1, max_depth
                 );
             }
         }
@@ -348,16 +939,18 @@ ASDF* _asdf_read_2_0(
         // Pull corner values and positions from children
         get_d_from_children(asdf);
 
+        if (max_depth >= 0 && depth >= max_depth) {
+            truncate_asdf(asdf, depth, max_depth);
+        }
+
     } else {
 
         if (c == 'F')       asdf->state = FILLED;
         else if (c == 'E')  asdf->state = EMPTY;
-        else if (c == 'L')  asdf->state = LEAF;
+        else                asdf->state = LEAF;
 
-        // Pull values from the cache or from the file
+        // Pull values from the cache or from the data
         for (int a=0; a<8; ++a) {
-
-            // Get a cache pointer to this corner
             Corner* const pt = get_corner(
                 cache,
                 r.imin + (a & 4 ? r.ni : 0),
@@ -365,22 +958,96 @@ ASDF* _asdf_read_2_0(
                 r.kmin + (a & 1 ? r.nk : 0)
             );
 
-            // If this cache pointer hasn't already been populated, then
-            // we'll read in the value from the file.
             if (isnan(pt->value)) {
                 int16_t v;
-                fscanf(file, "%2c", (char*)&v);
+                reader_get(in, &v, sizeof(v));
                 pt->value = v / scale;
-                asdf->d[a] = pt->value;
-            } else {
-                asdf->d[a] = pt->value;
             }
+            asdf->d[a] = pt->value;
         }
     }
 
     return asdf;
 }
 
+////////////////////////////////////////////////////////////////////////////////
+
+_STATIC_
+void asdf_write_2_0(ASDF* const asdf, FILE* file)
+{
+    fprintf(file, "ASDF%c%c", 2, 0);
+
+    int ni, nj, nk;
+    find_dimensions(asdf, &ni, &nj, &nk);
+
+    const float header_f[6] = {
+        asdf->X.lower, asdf->X.upper,
+        asdf->Y.lower, asdf->Y.upper,
+        asdf->Z.lower, asdf->Z.upper
+    };
+    const int32_t header_i[3] = {ni, nj, nk};
+    const float scale = asdf_quantize_scale(asdf);
+
+    fwrite(header_f, sizeof(header_f), 1, file);
+    fwrite(header_i, sizeof(header_i), 1, file);
+    fwrite(&scale, sizeof(scale), 1, file);
+
+    Region r = (Region){
+        .imin = 0,  .jmin = 0,  .kmin = 0,
+        .ni   = ni, .nj   = nj, .nk   = nk,
+        .voxels = ni*nj*nk
+    };
+    Corner* const cache = calloc(1, sizeof(Corner));
+    cache->value = NAN;
+
+    // Cells are encoded into a fixed-size buffer that's written out
+    // whenever it fills up, rather than one byte at a time.
+    Buffer out = (Buffer){.file=file};
+    encode_cells(asdf, &out, r, cache, scale);
+    buffer_flush(&out);
+
+    free_corner_cache(cache);
+}
+
+_STATIC_
+ASDF*  asdf_read_2_0(FILE* file)
+{
+    float header_f[6];
+    int32_t header_i[3];
+    float scale;
+
+    if (fread(header_f, sizeof(header_f), 1, file) != 1 ||
+        fread(header_i, sizeof(header_i), 1, file) != 1 ||
+        fread(&scale, sizeof(scale), 1, file) != 1)
+    {
+        printf("Error: truncated .asdf file\n");
+        return NULL;
+    }
+
+    Region r = (Region){
+        .imin=0, .jmin=0, .kmin=0,
+        .ni=header_i[0],  .nj=header_i[1],  .nk=header_i[2],
+        .voxels = header_i[0]*header_i[1]*header_i[2]
+    };
+    build_arrays(&r, header_f[0], header_f[2], header_f[4],
+                     header_f[1], header_f[3], header_f[5]);
+
+    Corner* const cache = calloc(1, sizeof(Corner));
+    cache->value = NAN;
+
+    // Pull the rest of the file into memory in one go, then decode it
+    size_t size;
+    uint8_t* const data = read_rest(file, &size);
+    Reader in = (Reader){.data=data, .size=size, .pos=0};
+    ASDF* asdf = decode_cells(&in, r, cache, scale, 0, -1);
+
+    free(data);
+    free_arrays(&r);
+    free_corner_cache(cache);
+
+    return asdf;
+}
+
 
 ////////////////////////////////////////////////////////////////////////////////
 
@@ -3,18 +3,52 @@
 
 #include <stdio.h>
 
+#include "util/interval.h"
+
 struct ASDF_;
 
-/** @brief Saves an ASDF to a file
+/** @brief Saves an ASDF to a file (in the latest format, version 3.0)
     @param asdf Pointer to an ASDF
     @param filename Name of file
 */
 void  asdf_write(struct ASDF_* const asdf, const char* filename);
 
+/** @brief Saves an ASDF to a file in a particular format version
+    @details Version 3 blocks are encoded and compressed in parallel;
+    older versions are written by a single thread.
+    @param asdf Pointer to an ASDF
+    @param filename Name of file
+    @param version_major Major version number (1, 2, or 3)
+    @param version_minor Minor version number
+    @param threads Number of threads to use
+    @returns True if the file was written (on failure, it's removed)
+*/
+_Bool asdf_write_parallel(struct ASDF_* const asdf, const char* filename,
+                          const int version_major, const int version_minor,
+                          const unsigned threads);
+
 /** @brief Loads an ASDF from a file
     @param filename Filename
     @returns The loaded ASDF
 */
 struct ASDF_*  asdf_read(const char* filename);
 
+/** @brief Loads part of an ASDF from a file
+    @details In version 3 files, compressed blocks that don't overlap the
+    given bounds (or that start below max_depth) aren't decoded; they're
+    replaced by leaf cells with the subtree's corner values, as are
+    branches at max_depth.  Older files are read in full, then cut
+    down to max_depth.
+    @param filename Filename
+    @param X X bounds of interest
+    @param Y Y bounds of interest
+    @param Z Z bounds of interest
+    @param max_depth Maximum cell depth (the root is at depth 0), or -1
+    @param threads Number of threads used to decompress and decode blocks
+    @returns The loaded ASDF
+*/
+struct ASDF_*  asdf_read_partial(const char* filename, const Interval X,
+                                 const Interval Y, const Interval Z,
+                                 const int max_depth, const unsigned threads);
+
 #endif
@@ -387,27 +387,107 @@ float get_max(const int i, const int j, const int ni, const int nj,
 }
 
 
-int finish_cut(const int ni, const int nj,
-               uint16_t const*const*const heights,
-               const float mm_per_pixel, const float mm_per_bit,
-               const float diameter, const float overlap,
-               const int mill_type, Path*** paths)
+/*  Height-map and end-mill used to find cut heights in finish_cut */
+typedef struct Cut16_ {
+    int ni, nj, side;
+    float mm_per_bit;
+    uint16_t const*const* heights;
+    _Bool** mask;
+    uint16_t** endmill;
+} Cut16;
+
+/*  Height-map and end-mill used to find cut heights in finish_cut_f */
+typedef struct CutF_ {
+    int ni, nj, side;
+    float zmin;
+    float const*const* heights;
+    _Bool** mask;
+    float** endmill;
+} CutF;
+
+
+_STATIC_
+float cut16_height(const int i, const int j, const void* data)
 {
+    const Cut16* c = data;
+    return get_max(i, j, c->ni, c->nj, c->side, c->mm_per_bit,
+                   c->heights, c->mask, c->endmill);
+}
 
-    _Bool** mask = NULL;
-    uint16_t** endmill = NULL;
-    int side = 0;
-    if (mill_type == 0) {
-        side = make_flat_mill(diameter, mm_per_pixel, mm_per_bit,
-                              &mask, &endmill);
-    } else if (mill_type == 1) {
-        side = make_ball_mill(diameter, mm_per_pixel, mm_per_bit,
-                              &mask, &endmill);
-    } else {
-        printf("Unknown end-mill type (expected 0 or 1, got %i)\n",
-               mill_type);
+
+/*  make_mill_f
+ *
+ *  Makes a mask and end-mill profile (in mm) for a flat (mill_type = 0)
+ *  or ball (mill_type = 1) end-mill.  Returns the side length of the arrays.
+ */
+_STATIC_
+int make_mill_f(const float diameter, const float mm_per_pixel,
+                const int mill_type, _Bool*** const mask,
+                float*** const endmill)
+{
+    int d = diameter / mm_per_pixel;
+    int r = d / 2;
+
+    *mask = malloc(sizeof(_Bool*)*d);
+    *endmill = malloc(sizeof(float*)*d);
+
+    for (int j=0; j < d; ++j) {
+        (*mask)[j] = calloc(d, sizeof(_Bool));
+        (*endmill)[j] = calloc(d, sizeof(float));
+
+        for (int i=0; i < d; ++i) {
+            const float p = sqrt( (i-r)*(i-r) + (j-r)*(j-r) ) * mm_per_pixel;
+            if (p < diameter/2) {
+                (*mask)[j][i] = true;
+                if (mill_type == 1) {
+                    (*endmill)[j][i] = diameter/2 -
+                                       sqrt(diameter*diameter/4 - p*p);
+                }
+            }
+        }
     }
+    return d;
+}
 
+
+/*  cutf_height
+ *
+ *  Equivalent to get_max for floating-point height-maps.  Empty (NaN)
+ *  pixels are skipped; the result is relative to zmin.
+ */
+_STATIC_
+float cutf_height(const int i, const int j, const void* data)
+{
+    const CutF* c = data;
+    float max = 0;
+
+    for (int b = j-c->side/2; b < j+c->side/2; ++b) {
+        for (int a = i-c->side/2; a < i+c->side/2; ++a) {
+            if (a < 0 || a >= c->ni || b < 0 || b >= c->nj)    continue;
+
+            int u = a-i+c->side/2, v = b-j+c->side/2;
+            if (!c->mask[v][u])    continue;
+
+            const float height = c->heights[b][a] - c->zmin - c->endmill[v][u];
+            if (height > max)    max = height;
+        }
+    }
+
+    return max;
+}
+
+
+/*  cut_paths
+ *
+ *  Makes the YZ and XZ passes of a finish cut, with heights
+ *  given by calling height(i, j, data) at each pixel.
+ */
+_STATIC_
+int cut_paths(const int ni, const int nj, const float mm_per_pixel,
+              const float diameter, const float overlap,
+              float (*height)(const int i, const int j, const void* data),
+              const void* data, Path*** paths)
+{
     int path_count = 0;
 
     // YZ cuts
@@ -422,8 +502,7 @@ int finish_cut(const int ni, const int nj,
 
         // And fill it with points
         for (int j=0; j < nj; ++j) {
-            float z = get_max(i, j, ni, nj, side, mm_per_bit,
-                              heights, mask, endmill);
+            float z = height(i, j, data);
 
             *current = malloc(sizeof(Path));
             **current = (Path) {
@@ -446,8 +525,7 @@ int finish_cut(const int ni, const int nj,
         Path** current = &(*paths)[path_count-1];
 
         for (int i=0; i < ni; ++i) {
-            float z = get_max(i, j, ni, nj, side, mm_per_bit,
-                              heights, mask, endmill);
+            float z = height(i, j, data);
 
             *current = malloc(sizeof(Path));
             **current = (Path) {
@@ -461,6 +539,72 @@ int finish_cut(const int ni, const int nj,
         }
     }
 
+    return path_count;
+}
+
+
+int finish_cut(const int ni, const int nj,
+               uint16_t const*const*const heights,
+               const float mm_per_pixel, const float mm_per_bit,
+               const float diameter, const float overlap,
+               const int mill_type, Path*** paths)
+{
+
+    _Bool** mask = NULL;
+    uint16_t** endmill = NULL;
+    int side = 0;
+    if (mill_type == 0) {
+        side = make_flat_mill(diameter, mm_per_pixel, mm_per_bit,
+                              &mask, &endmill);
+    } else if (mill_type == 1) {
+        side = make_ball_mill(diameter, mm_per_pixel, mm_per_bit,
+                              &mask, &endmill);
+    } else {
+        printf("Unknown end-mill type (expected 0 or 1, got %i)\n",
+               mill_type);
+    }
+
+    Cut16 cut = {
+        .ni=ni, .nj=nj, .side=side, .mm_per_bit=mm_per_bit,
+        .heights=heights, .mask=mask, .endmill=endmill
+    };
+    int path_count = cut_paths(ni, nj, mm_per_pixel, diameter, overlap,
+                               cut16_height, &cut, paths);
+
     free_endmill(mask, endmill, side);
     return path_count;
 }
+
+
+int finish_cut_f(const int ni, const int nj,
+                 float const*const*const heights, const float zmin,
+                 const float mm_per_pixel,
+                 const float diameter, const float overlap,
+                 const int mill_type, Path*** paths)
+{
+    if (mill_type != 0 && mill_type != 1) {
+        printf("Unknown end-mill type (expected 0 or 1, got %i)\n",
+               mill_type);
+    }
+
+    _Bool** mask = NULL;
+    float** endmill = NULL;
+    int side = make_mill_f(diameter, mm_per_pixel, mill_type,
+                           &mask, &endmill);
+
+    CutF cut = {
+        .ni=ni, .nj=nj, .side=side, .zmin=zmin,
+        .heights=heights, .mask=mask, .endmill=endmill
+    };
+    int path_count = cut_paths(ni, nj, mm_per_pixel, diameter, overlap,
+                               cutf_height, &cut, paths);
+
+    for (int i=0; i < side; ++i) {
+        free(mask[i]);
+        free(endmill[i]);
+    }
+    free(mask);
+    free(endmill);
+
+    return path_count;
+}
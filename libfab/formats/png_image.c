@@ -59,6 +59,40 @@ void save_png16L(const char *output_file_name, const int ni, const int nj,
 }
 
 
+void save_png8RGB(const char *output_file_name, const int ni, const int nj,
+                  const float bounds[6],
+                  uint8_t const (*const*const pixels)[3])
+{
+    FILE* output = fopen(output_file_name, "wb");
+
+    png_structp png_ptr = png_create_write_struct(
+        PNG_LIBPNG_VER_STRING, NULL, NULL, NULL);
+    png_infop info_ptr = png_create_info_struct(png_ptr);
+
+    png_set_IHDR(png_ptr, info_ptr, ni, nj, 8, PNG_COLOR_TYPE_RGB,
+                 PNG_INTERLACE_NONE, PNG_COMPRESSION_TYPE_BASE,
+                 PNG_FILTER_TYPE_BASE);
+
+    // Only store a physical size if the bounds are meaningful
+    if (!isnan(bounds[0]) && !isnan(bounds[3]) &&
+        !isnan(bounds[1]) && !isnan(bounds[4]) &&
+        bounds[3] > bounds[0] && bounds[4] > bounds[1])
+    {
+        png_set_pHYs(png_ptr, info_ptr,
+                     1000 * ni / (bounds[3]-bounds[0]),
+                     1000 * nj / (bounds[4]-bounds[1]),
+                     PNG_RESOLUTION_METER);
+    }
+
+    png_init_io(png_ptr, output);
+    png_set_rows(png_ptr, info_ptr, (png_bytepp)pixels);
+    png_write_png(png_ptr, info_ptr, PNG_TRANSFORM_IDENTITY, NULL);
+    fclose(output);
+
+    png_destroy_write_struct(&png_ptr, &info_ptr);
+}
+
+
 void count_by_color(const char* const image, const int w, const int h,
                     const uint32_t maxindex, uint32_t* const count)
 {
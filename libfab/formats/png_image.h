@@ -13,6 +13,18 @@ void save_png16L(const char *output_file_name, const int ni, const int nj,
                  const float bounds[6], uint16_t const*const*const pixels);
 
 
+/** @brief Saves an 8-bit RGB .png image
+    @param output_file_name Target filename
+    @param ni Image width (pixels)
+    @param nj Image height (pixels)
+    @param bounds Image bounds (mm) in the order [xmin, ymin, zmin, xmax, ymax, zmax]
+    @param pixels Image rows, ordered from top to bottom
+*/
+void save_png8RGB(const char *output_file_name, const int ni, const int nj,
+                  const float bounds[6],
+                  uint8_t const (*const*const pixels)[3]);
+
+
 /** @brief Loads various image parameters from a .png header
     @param filename Target .png image to examine
     @param ni Field to store image width
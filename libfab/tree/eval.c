@@ -1,49 +1,122 @@
 #include <stdio.h>
+#include <string.h>
+#include <math.h>
 
 #include "tree/packed.h"
 #include "tree/eval.h"
 
-#include "tree/node/node.h"
+#include "tree/node/opcodes.h"
 
+#include "tree/math/math_a.h"
 #include "tree/math/math_f.h"
+#include "tree/math/math_g.h"
 #include "tree/math/math_i.h"
 #include "tree/math/math_r.h"
 
+/*  count_clauses
+ *
+ *  Adds n evaluations of each active clause to the tree's opcode counters.
+ *  Only called if counting is enabled.
+ */
+_STATIC_
+void count_clauses(PackedTree* tree, const uint64_t n);
+
+////////////////////////////////////////////////////////////////////////////////
+
 float eval_f(PackedTree* tree, const float x, const float y, const float z)
 {
-    Node* node = NULL;
+    if (tree->stats) {
+        tree->stats->point++;
+        count_clauses(tree, 1);
+    }
+
+    float* const F = tree->f;
+
+    for (unsigned level=0; level < tree->num_levels; ++level) {
+        const Clause* c = tree->tape + tree->offsets[level];
+        const Clause* const end = c + tree->active[level];
+
+        for (; c < end; ++c) {
+            const float A = F[c->lhs],
+                        B = F[c->rhs];
+            float* const R = F + c->out;
+
+            switch (c->opcode) {
+                case OP_ADD:    *R = add_f(A, B); break;
+                case OP_SUB:    *R = sub_f(A, B); break;
+                case OP_MUL:    *R = mul_f(A, B); break;
+                case OP_DIV:    *R = div_f(A, B); break;
+                case OP_MIN:    *R = min_f(A, B); break;
+                case OP_MAX:    *R = max_f(A, B); break;
+                case OP_POW:    *R = pow_f(A, B); break;
+
+                case OP_ABS:    *R = abs_f(A); break;
+                case OP_SQUARE: *R = square_f(A); break;
+                case OP_SQRT:   *R = sqrt_f(A); break;
+                case OP_SIN:    *R = sin_f(A); break;
+                case OP_COS:    *R = cos_f(A); break;
+                case OP_TAN:    *R = tan_f(A); break;
+                case OP_ASIN:   *R = asin_f(A); break;
+                case OP_ACOS:   *R = acos_f(A); break;
+                case OP_ATAN:   *R = atan_f(A); break;
+                case OP_NEG:    *R = neg_f(A); break;
+
+                case OP_X:      *R = X_f(x); break;
+                case OP_Y:      *R = Y_f(y); break;
+                case OP_Z:      *R = Z_f(z); break;
+
+                case OP_CONST:  break;
+                default:
+                    printf("Unknown opcode!\n");
+            }
+        }
+    }
+    return F[tree->head];
+}
+
+////////////////////////////////////////////////////////////////////////////////
+
+Deriv eval_g(PackedTree* tree, const float x, const float y, const float z)
+{
+    if (tree->stats) {
+        tree->stats->gradient++;
+        count_clauses(tree, 1);
+    }
+
+    Deriv* const G = tree->g;
 
     for (unsigned level=0; level < tree->num_levels; ++level) {
-        for (unsigned n=0; n < tree->active[level]; ++n) {
-
-            node = tree->nodes[level][n];
-
-            float A = node->lhs ? node->lhs->results.f : 0,
-                  B = node->rhs ? node->rhs->results.f : 0;
-
-            switch (node->opcode) {
-                case OP_ADD:    node->results.f = add_f(A, B); break;
-                case OP_SUB:    node->results.f = sub_f(A, B); break;
-                case OP_MUL:    node->results.f = mul_f(A, B); break;
-                case OP_DIV:    node->results.f = div_f(A, B); break;
-                case OP_MIN:    node->results.f = min_f(A, B); break;
-                case OP_MAX:    node->results.f = max_f(A, B); break;
-                case OP_POW:    node->results.f = pow_f(A, B); break;
-
-                case OP_ABS:    node->results.f = abs_f(A); break;
-                case OP_SQUARE: node->results.f = square_f(A); break;
-                case OP_SQRT:   node->results.f = sqrt_f(A); break;
-                case OP_SIN:    node->results.f = sin_f(A); break;
-                case OP_COS:    node->results.f = cos_f(A); break;
-                case OP_TAN:    node->results.f = tan_f(A); break;
-                case OP_ASIN:   node->results.f = asin_f(A); break;
-                case OP_ACOS:   node->results.f = acos_f(A); break;
-                case OP_ATAN:   node->results.f = atan_f(A); break;
-                case OP_NEG:    node->results.f = neg_f(A); break;
-
-                case OP_X:      node->results.f = X_f(x); break;
-                case OP_Y:      node->results.f = Y_f(y); break;
-                case OP_Z:      node->results.f = Z_f(z); break;
+        const Clause* c = tree->tape + tree->offsets[level];
+        const Clause* const end = c + tree->active[level];
+
+        for (; c < end; ++c) {
+            const Deriv A = G[c->lhs],
+                        B = G[c->rhs];
+            Deriv* const R = G + c->out;
+
+            switch (c->opcode) {
+                case OP_ADD:    *R = add_g(A, B); break;
+                case OP_SUB:    *R = sub_g(A, B); break;
+                case OP_MUL:    *R = mul_g(A, B); break;
+                case OP_DIV:    *R = div_g(A, B); break;
+                case OP_MIN:    *R = min_g(A, B); break;
+                case OP_MAX:    *R = max_g(A, B); break;
+                case OP_POW:    *R = pow_g(A, B); break;
+
+                case OP_ABS:    *R = abs_g(A); break;
+                case OP_SQUARE: *R = square_g(A); break;
+                case OP_SQRT:   *R = sqrt_g(A); break;
+                case OP_SIN:    *R = sin_g(A); break;
+                case OP_COS:    *R = cos_g(A); break;
+                case OP_TAN:    *R = tan_g(A); break;
+                case OP_ASIN:   *R = asin_g(A); break;
+                case OP_ACOS:   *R = acos_g(A); break;
+                case OP_ATAN:   *R = atan_g(A); break;
+                case OP_NEG:    *R = neg_g(A); break;
+
+                case OP_X:      *R = X_g(x); break;
+                case OP_Y:      *R = Y_g(y); break;
+                case OP_Z:      *R = Z_g(z); break;
 
                 case OP_CONST:  break;
                 default:
@@ -51,7 +124,7 @@ float eval_f(PackedTree* tree, const float x, const float y, const float z)
             }
         }
     }
-    return tree->head->results.f;
+    return G[tree->head];
 }
 
 ////////////////////////////////////////////////////////////////////////////////
@@ -60,68 +133,229 @@ Interval eval_i(PackedTree* tree, const Interval X,
                                   const Interval Y,
                                   const Interval Z)
 {
-    Node* node = NULL;
+    if (tree->stats) {
+        tree->stats->interval++;
+        count_clauses(tree, 1);
+    }
+
+    Interval* const I = tree->i;
 
     for (unsigned level=0; level < tree->num_levels; ++level) {
-        for (unsigned n=0; n < tree->active[level]; ++n) {
-
-            node = tree->nodes[level][n];
-
-            Interval A = node->lhs ? node->lhs->results.i
-                                   : (Interval) {.upper=0, .lower=0},
-                     B = node->rhs ? node->rhs->results.i
-                                   : (Interval) {.upper=0, .lower=0};
-
-            switch (node->opcode) {
-                case OP_ADD:    node->results.i = add_i(A, B); break;
-                case OP_SUB:    node->results.i = sub_i(A, B); break;
-                case OP_MUL:    node->results.i = mul_i(A, B); break;
-                case OP_DIV:    node->results.i = div_i(A, B); break;
-                case OP_MIN:    node->results.i = min_i(A, B); break;
-                case OP_MAX:    node->results.i = max_i(A, B); break;
-                case OP_POW:    node->results.i = pow_i(A, B); break;
-
-                case OP_ABS:    node->results.i = abs_i(A); break;
-                case OP_SQUARE: node->results.i = square_i(A); break;
-                case OP_SQRT:   node->results.i = sqrt_i(A); break;
-                case OP_SIN:    node->results.i = sin_i(A); break;
-                case OP_COS:    node->results.i = cos_i(A); break;
-                case OP_TAN:    node->results.i = tan_i(A); break;
-                case OP_ASIN:   node->results.i = asin_i(A); break;
-                case OP_ACOS:   node->results.i = acos_i(A); break;
-                case OP_ATAN:   node->results.i = atan_i(A); break;
-                case OP_NEG:    node->results.i = neg_i(A); break;
+        const Clause* c = tree->tape + tree->offsets[level];
+        const Clause* const end = c + tree->active[level];
+
+        for (; c < end; ++c) {
+            const Interval A = I[c->lhs],
+                           B = I[c->rhs];
+            Interval* const R = I + c->out;
+
+            switch (c->opcode) {
+                case OP_ADD:    *R = add_i(A, B); break;
+                case OP_SUB:    *R = sub_i(A, B); break;
+                case OP_MUL:    *R = mul_i(A, B); break;
+                case OP_DIV:    *R = div_i(A, B); break;
+                case OP_MIN:    *R = min_i(A, B); break;
+                case OP_MAX:    *R = max_i(A, B); break;
+                case OP_POW:    *R = pow_i(A, B); break;
+
+                case OP_ABS:    *R = abs_i(A); break;
+                case OP_SQUARE: *R = square_i(A); break;
+                case OP_SQRT:   *R = sqrt_i(A); break;
+                case OP_SIN:    *R = sin_i(A); break;
+                case OP_COS:    *R = cos_i(A); break;
+                case OP_TAN:    *R = tan_i(A); break;
+                case OP_ASIN:   *R = asin_i(A); break;
+                case OP_ACOS:   *R = acos_i(A); break;
+                case OP_ATAN:   *R = atan_i(A); break;
+                case OP_NEG:    *R = neg_i(A); break;
 
                 case OP_CONST:  break;
-                case OP_X:      node->results.i = X_i(X); break;
-                case OP_Y:      node->results.i = Y_i(Y); break;
-                case OP_Z:      node->results.i = Z_i(Z); break;
+                case OP_X:      *R = X_i(X); break;
+                case OP_Y:      *R = Y_i(Y); break;
+                case OP_Z:      *R = Z_i(Z); break;
                 default:
                     printf("Unknown opcode!\n");
             }
         }
     }
 
-    return tree->head->results.i;
+    return I[tree->head];
 }
 
 ////////////////////////////////////////////////////////////////////////////////
 
-float* eval_r(PackedTree* tree, const Region r)
+/*  intersect
+ *
+ *  Returns the intersection of two intervals that both contain a result.
+ *  If rounding error makes them disjoint, falls back to the second one.
+ */
+_STATIC_
+Interval intersect(const Interval A, const Interval B)
+{
+    const Interval i = {.lower = fmax(A.lower, B.lower),
+                        .upper = fmin(A.upper, B.upper)};
+    return (i.lower <= i.upper) ? i : B;
+}
+
+Interval eval_a(PackedTree* tree, const Interval X,
+                                  const Interval Y,
+                                  const Interval Z)
+{
+    if (tree->stats) {
+        tree->stats->affine++;
+        count_clauses(tree, 1);
+    }
+
+    Affine* const F = tree->a;
+    Interval* const I = tree->i;
+
+    for (unsigned level=0; level < tree->num_levels; ++level) {
+        const Clause* c = tree->tape + tree->offsets[level];
+        const Clause* const end = c + tree->active[level];
+
+        for (; c < end; ++c) {
+            const Affine A = F[c->lhs],
+                         B = F[c->rhs];
+            const Interval Ai = I[c->lhs],
+                           Bi = I[c->rhs];
+            Affine* const R = F + c->out;
+            Interval* const Ri = I + c->out;
+
+            // Operations with a good linear approximation are done in
+            // affine arithmetic, then the resulting range is intersected
+            // with the interval result (so that it's never looser).
+            switch (c->opcode) {
+                case OP_ADD:
+                    *R = add_a(A, B);
+                    *Ri = intersect(a_to_interval(*R), add_i(Ai, Bi));
+                    break;
+                case OP_SUB:
+                    *R = sub_a(A, B);
+                    *Ri = intersect(a_to_interval(*R), sub_i(Ai, Bi));
+                    break;
+                case OP_MUL:
+                    *R = mul_a(A, B);
+                    *Ri = intersect(a_to_interval(*R), mul_i(Ai, Bi));
+                    break;
+                case OP_DIV:
+                    *R = mul_a(A, recip_a(B, Bi));
+                    *Ri = intersect(a_to_interval(*R), div_i(Ai, Bi));
+                    break;
+                case OP_NEG:
+                    *R = neg_a(A);
+                    *Ri = neg_i(Ai);
+                    break;
+                case OP_SQUARE:
+                    *R = square_a(A);
+                    *Ri = intersect(a_to_interval(*R), square_i(Ai));
+                    break;
+                case OP_SQRT:
+                    *R = sqrt_a(A, Ai);
+                    *Ri = intersect(a_to_interval(*R), sqrt_i(Ai));
+                    break;
+
+                // min, max, and abs keep the affine form of a branch
+                // if the choice of branch is unambiguous.
+                case OP_MIN:
+                    if (Ai.upper <= Bi.lower)       { *R = A; *Ri = Ai; }
+                    else if (Bi.upper <= Ai.lower)  { *R = B; *Ri = Bi; }
+                    else {
+                        *Ri = min_i(Ai, Bi);
+                        *R = interval_to_a(*Ri);
+                    }
+                    break;
+                case OP_MAX:
+                    if (Ai.lower >= Bi.upper)       { *R = A; *Ri = Ai; }
+                    else if (Bi.lower >= Ai.upper)  { *R = B; *Ri = Bi; }
+                    else {
+                        *Ri = max_i(Ai, Bi);
+                        *R = interval_to_a(*Ri);
+                    }
+                    break;
+                case OP_ABS:
+                    if (Ai.lower >= 0)      { *R = A; *Ri = Ai; }
+                    else if (Ai.upper <= 0) { *R = neg_a(A); *Ri = neg_i(Ai); }
+                    else {
+                        *Ri = abs_i(Ai);
+                        *R = interval_to_a(*Ri);
+                    }
+                    break;
+
+                // Everything else falls back to interval arithmetic
+                case OP_POW:    *Ri = pow_i(Ai, Bi); *R = interval_to_a(*Ri); break;
+                case OP_SIN:    *Ri = sin_i(Ai); *R = interval_to_a(*Ri); break;
+                case OP_COS:    *Ri = cos_i(Ai); *R = interval_to_a(*Ri); break;
+                case OP_TAN:    *Ri = tan_i(Ai); *R = interval_to_a(*Ri); break;
+                case OP_ASIN:   *Ri = asin_i(Ai); *R = interval_to_a(*Ri); break;
+                case OP_ACOS:   *Ri = acos_i(Ai); *R = interval_to_a(*Ri); break;
+                case OP_ATAN:   *Ri = atan_i(Ai); *R = interval_to_a(*Ri); break;
+
+                case OP_CONST:  break;
+                case OP_X:      *R = X_a(X); *Ri = X_i(X); break;
+                case OP_Y:      *R = Y_a(Y); *Ri = Y_i(Y); break;
+                case OP_Z:      *R = Z_a(Z); *Ri = Z_i(Z); break;
+                default:
+                    printf("Unknown opcode!\n");
+            }
+        }
+    }
+
+    return I[tree->head];
+}
+
+////////////////////////////////////////////////////////////////////////////////
+
+Interval eval_bounds(PackedTree* tree, const Interval X,
+                                       const Interval Y,
+                                       const Interval Z)
+{
+    const Interval result = tree->affine ? eval_a(tree, X, Y, Z)
+                                         : eval_i(tree, X, Y, Z);
+    STAT(tree, regions, 1);
+    STAT(tree, filled, result.upper < 0);
+    STAT(tree, empty, result.lower >= 0);
+
+    return result;
+}
+
+////////////////////////////////////////////////////////////////////////////////
+
+_STATIC_
+void count_clauses(PackedTree* tree, const uint64_t n)
 {
-    Node* node = NULL;
-    int c = r.voxels;
+    uint64_t* const opcodes = tree->stats->opcodes;
 
     for (unsigned level=0; level < tree->num_levels; ++level) {
-        for (unsigned n=0; n < tree->active[level]; ++n) {
+        const Clause* c = tree->tape + tree->offsets[level];
+        const Clause* const end = c + tree->active[level];
+        for (; c < end; ++c)    opcodes[c->opcode] += n;
+    }
+}
+
+////////////////////////////////////////////////////////////////////////////////
+
+float* eval_r(PackedTree* tree, const Region r)
+{
+    if (tree->stats) {
+        tree->stats->array++;
+        tree->stats->voxels += r.voxels;
+        count_clauses(tree, r.voxels);
+    }
 
-            node = tree->nodes[level][n];
+    float* const S = tree->r;
+    const unsigned block = tree->block;
+    const int c = r.voxels;
 
-            float *A = node->lhs ? node->lhs->results.r  : NULL,
-                  *B = node->rhs ? node->rhs->results.r : NULL,
-                  *R = node->results.r;
+    for (unsigned level=0; level < tree->num_levels; ++level) {
+        const Clause* clause = tree->tape + tree->offsets[level];
+        const Clause* const end = clause + tree->active[level];
+
+        for (; clause < end; ++clause) {
+            float *A = S + clause->lhs*block,
+                  *B = S + clause->rhs*block,
+                  *R = S + clause->out*block;
 
-            switch (node->opcode) {
+            switch (clause->opcode) {
                 case OP_ADD:    add_r(A, B, R, c); break;
                 case OP_SUB:    sub_r(A, B, R, c); break;
                 case OP_MUL:    mul_r(A, B, R, c); break;
@@ -151,5 +385,49 @@ float* eval_r(PackedTree* tree, const Region r)
         }
     }
 
-    return tree->head->results.r;
+    return S + tree->head*block;
+}
+
+////////////////////////////////////////////////////////////////////////////////
+
+void eval_points(PackedTree* tree,
+                 const float* X, const float* Y, const float* Z,
+                 float* out, const uint32_t count, volatile int* halt)
+{
+    const uint32_t block = tree->block;
+    for (uint32_t i=0; i < count; i += block) {
+        if (*halt)  return;
+
+        // eval_r works on up to block points at a time, since that's
+        // the size of every node's result array.
+        const uint32_t n = (count - i < block) ? count - i : block;
+        const Region r = (Region){
+            .X=(float*)X + i, .Y=(float*)Y + i, .Z=(float*)Z + i,
+            .voxels=n
+        };
+        memcpy(out + i, eval_r(tree, r), n*sizeof(float));
+    }
+}
+
+////////////////////////////////////////////////////////////////////////////////
+
+void eval_gradients(PackedTree* tree,
+                    const float* X, const float* Y, const float* Z,
+                    Deriv* out, const uint32_t count, volatile int* halt)
+{
+    for (uint32_t i=0; i < count; ++i) {
+        if (*halt)  return;
+        out[i] = eval_g(tree, X[i], Y[i], Z[i]);
+    }
+}
+
+////////////////////////////////////////////////////////////////////////////////
+
+void eval_intervals(PackedTree* tree, const Interval (*boxes)[3],
+                    Interval* out, const uint32_t count, volatile int* halt)
+{
+    for (uint32_t i=0; i < count; ++i) {
+        if (*halt)  return;
+        out[i] = eval_i(tree, boxes[i][0], boxes[i][1], boxes[i][2]);
+    }
 }
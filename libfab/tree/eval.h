@@ -1,6 +1,9 @@
 #ifndef EVAL_H
 #define EVAL_H
 
+#include <stdint.h>
+
+#include "util/deriv.h"
 #include "util/interval.h"
 #include "util/region.h"
 #include "util/switches.h"
@@ -10,21 +13,92 @@ struct PackedTree_;
 
 
 /** @brief Evaluates a math expression at a given floating-point position.
-    @details Results are stored in n->head->results.f
+    @details Results are stored in the head's slot of n->f
 */
 float  eval_f(struct PackedTree_* n, const float x, const float y, const float z);
 
 
+/** @brief Evaluates a math expression and its partial derivatives
+    at a given floating-point position
+    @details Derivatives are found with forward-mode automatic
+    differentiation.  Results are stored in the head's slot of n->g
+*/
+Deriv  eval_g(struct PackedTree_* n, const float x, const float y, const float z);
+
+
 /** @brief Evaluates a math expression over an interval region
-    @details Results are stored in n->head->results.i
+    @details Results are stored in the head's slot of n->i
 */
 Interval  eval_i(struct PackedTree_* n, const Interval X,
                                         const Interval Y,
                                         const Interval Z);
 
+/** @brief Evaluates a math expression over an interval region
+    with affine arithmetic
+    @details Affine arithmetic keeps track of correlation with the input
+    ranges, so it gives tighter bounds on rotated and sheared shapes.
+    Affine results are stored in n->a; their ranges (intersected with
+    plain interval results) are stored in n->i, so that pruning works
+    the same as after eval_i.
+*/
+Interval  eval_a(struct PackedTree_* n, const Interval X,
+                                        const Interval Y,
+                                        const Interval Z);
+
+
+/** @brief Finds bounds of a math expression over an interval region
+    @details Uses eval_a if n->affine is set and eval_i otherwise.
+    Counts checked, filled, and empty regions in n->stats (if attached).
+*/
+Interval  eval_bounds(struct PackedTree_* n, const Interval X,
+                                             const Interval Y,
+                                             const Interval Z);
+
+
 /** @brief Evaluates a math expression over a set of many positions
-    @details Results are stored in n->head->results.r
+    @details Results are stored in the head's slot of n->r
 */
 float*  eval_r(struct PackedTree_* n, const Region r);
 
+
+/** @brief Evaluates a math expression at an arbitrary list of points
+    @details Points are evaluated in chunks of the tree's block size with eval_r.
+    @param n Packed tree
+    @param X Array of x coordinates
+    @param Y Array of y coordinates
+    @param Z Array of z coordinates
+    @param out Array into which results are stored
+    @param count Number of points
+    @param halt Flag to abort evaluation
+*/
+void eval_points(struct PackedTree_* n,
+                 const float* X, const float* Y, const float* Z,
+                 float* out, const uint32_t count, volatile int* halt);
+
+
+/** @brief Evaluates a math expression and its gradient at an arbitrary
+    list of points
+    @param n Packed tree
+    @param X Array of x coordinates
+    @param Y Array of y coordinates
+    @param Z Array of z coordinates
+    @param out Array into which results (with derivatives) are stored
+    @param count Number of points
+    @param halt Flag to abort evaluation
+*/
+void eval_gradients(struct PackedTree_* n,
+                    const float* X, const float* Y, const float* Z,
+                    Deriv* out, const uint32_t count, volatile int* halt);
+
+
+/** @brief Evaluates a math expression over an arbitrary list of boxes
+    @param n Packed tree
+    @param boxes Array of boxes, each of which is an [X, Y, Z] interval triple
+    @param out Array into which result intervals are stored
+    @param count Number of boxes
+    @param halt Flag to abort evaluation
+*/
+void eval_intervals(struct PackedTree_* n, const Interval (*boxes)[3],
+                    Interval* out, const uint32_t count, volatile int* halt);
+
 #endif
@@ -0,0 +1,190 @@
+#include <math.h>
+#include <float.h>
+
+#include "tree/math/math_a.h"
+
+/*  Rounding
+ *
+ *  Affine forms are computed in float, so each term may be off by a few
+ *  ulps.  To keep the bounds conservative, every operation widens its
+ *  error term by FLT_EPSILON times the magnitude of its terms (which
+ *  covers a couple of roundings in each), plus FLT_EPSILON times the
+ *  magnitude of any intermediate values that could cancel out.
+ */
+
+/*  radius
+ *
+ *  Returns the maximum distance of an affine form from its center.
+ */
+_STATIC_
+float radius(Affine A)
+{
+    return fabs(A.dx) + fabs(A.dy) + fabs(A.dz) + A.err;
+}
+
+/*  round_out
+ *
+ *  Widens an affine form's error term to cover rounding in its terms.
+ */
+_STATIC_
+Affine round_out(Affine A)
+{
+    A.err += FLT_EPSILON * (fabs(A.center) + radius(A));
+    return A;
+}
+
+/*  linear
+ *
+ *  Returns alpha*A + zeta +/- delta.
+ */
+_STATIC_
+Affine linear(Affine A, float alpha, float zeta, float delta)
+{
+    return round_out((Affine){
+            .center = alpha*A.center + zeta,
+            .dx     = alpha*A.dx,
+            .dy     = alpha*A.dy,
+            .dz     = alpha*A.dz,
+            .err    = fabs(alpha)*A.err + delta +
+                      FLT_EPSILON*(fabs(alpha*A.center) + fabs(zeta))});
+}
+
+////////////////////////////////////////////////////////////////////////////////
+
+Affine add_a(Affine A, Affine B)
+{
+    return round_out((Affine){.center = A.center + B.center,
+                              .dx     = A.dx + B.dx,
+                              .dy     = A.dy + B.dy,
+                              .dz     = A.dz + B.dz,
+                              .err    = A.err + B.err});
+}
+
+Affine sub_a(Affine A, Affine B)
+{
+    return round_out((Affine){.center = A.center - B.center,
+                              .dx     = A.dx - B.dx,
+                              .dy     = A.dy - B.dy,
+                              .dz     = A.dz - B.dz,
+                              .err    = A.err + B.err});
+}
+
+Affine mul_a(Affine A, Affine B)
+{
+    // The product of the two non-central parts is bounded by the
+    // product of their radii, which goes into the error term.  The
+    // partial products in dx, dy, and dz can cancel, so their rounding
+    // is bounded by the products of the magnitudes.
+    const float ra = radius(A), rb = radius(B);
+    return round_out((Affine){
+            .center = A.center * B.center,
+            .dx     = A.center*B.dx + B.center*A.dx,
+            .dy     = A.center*B.dy + B.center*A.dy,
+            .dz     = A.center*B.dz + B.center*A.dz,
+            .err    = fabs(A.center)*B.err + fabs(B.center)*A.err + ra*rb +
+                      FLT_EPSILON*(fabs(A.center)*rb + fabs(B.center)*ra)});
+}
+
+////////////////////////////////////////////////////////////////////////////////
+
+Affine neg_a(Affine A)
+{
+    // Negation is exact, so no rounding term is needed
+    return (Affine){.center = -A.center,
+                    .dx     = -A.dx,
+                    .dy     = -A.dy,
+                    .dz     = -A.dz,
+                    .err    =  A.err};
+}
+
+Affine square_a(Affine A)
+{
+    // (c + s)^2 = c^2 + 2cs + s^2, with s^2 in [0, r^2]
+    const float r = radius(A);
+    Affine out = linear(A, 2*A.center, -A.center*A.center, 0);
+    out.center += r*r/2;
+    out.err    += r*r/2;
+    return round_out(out);
+}
+
+Affine recip_a(Affine A, Interval I)
+{
+    if (I.lower <= 0 && I.upper >= 0)   return interval_to_a(
+            (Interval){.lower=-INFINITY, .upper=INFINITY});
+
+    // Min-range linearization: the slope is taken at the endpoint that's
+    // farthest from zero, so 1/x - alpha*x is monotonic over the interval.
+    const float p = fabs(I.lower) > fabs(I.upper) ? I.lower : I.upper;
+    const float alpha = -1/(p*p);
+    const float d1 = 1/I.lower - alpha*I.lower,
+                d2 = 1/I.upper - alpha*I.upper;
+    const float e = FLT_EPSILON*(fabs(1/I.lower) + fabs(alpha*I.lower) +
+                                 fabs(1/I.upper) + fabs(alpha*I.upper));
+    return linear(A, alpha, (d1 + d2)/2, fabs(d1 - d2)/2 + e);
+}
+
+Affine sqrt_a(Affine A, Interval I)
+{
+    if (I.upper <= 0)   return constant_a(0);
+    if (I.lower < 0)    I.lower = 0;
+
+    // Min-range linearization: the slope is taken at the upper endpoint,
+    // so sqrt(x) - alpha*x is increasing over the interval.
+    const float alpha = 0.5/sqrt(I.upper);
+    const float d1 = sqrt(I.lower) - alpha*I.lower,
+                d2 = sqrt(I.upper) - alpha*I.upper;
+    const float e = FLT_EPSILON*(sqrt(I.lower) + fabs(alpha*I.lower) +
+                                 sqrt(I.upper) + fabs(alpha*I.upper));
+    return linear(A, alpha, (d1 + d2)/2, fabs(d2 - d1)/2 + e);
+}
+
+////////////////////////////////////////////////////////////////////////////////
+
+Affine X_a(Interval X)
+{
+    return round_out((Affine){.center = (X.lower + X.upper)/2,
+                              .dx     = (X.upper - X.lower)/2});
+}
+
+Affine Y_a(Interval Y)
+{
+    return round_out((Affine){.center = (Y.lower + Y.upper)/2,
+                              .dy     = (Y.upper - Y.lower)/2});
+}
+
+Affine Z_a(Interval Z)
+{
+    return round_out((Affine){.center = (Z.lower + Z.upper)/2,
+                              .dz     = (Z.upper - Z.lower)/2});
+}
+
+////////////////////////////////////////////////////////////////////////////////
+
+Affine constant_a(float f)
+{
+    return (Affine){.center = f};
+}
+
+Affine interval_to_a(Interval I)
+{
+    // Unbounded intervals get an infinite error term around zero
+    // (rather than an infinite or NaN center).
+    if (isinf(I.lower) || isinf(I.upper) || isnan(I.lower) || isnan(I.upper))
+    {
+        return (Affine){.center = 0, .err = INFINITY};
+    }
+    return round_out((Affine){.center = (I.lower + I.upper)/2,
+                              .err    = (I.upper - I.lower)/2});
+}
+
+Interval a_to_interval(Affine A)
+{
+    // The radius is a sum of three roundings, and each endpoint is one
+    // more, so both are pushed outwards
+    const float r = radius(A) * (1 + 2*FLT_EPSILON);
+    if (isnan(r) || isnan(A.center)) {
+        return (Interval){.lower = -INFINITY, .upper = INFINITY};
+    }
+    return (Interval){.lower = nextafterf(A.center - r, -INFINITY),
+                      .upper = nextafterf(A.center + r,  INFINITY)};
+}
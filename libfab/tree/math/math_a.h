@@ -0,0 +1,39 @@
+#ifndef MATH_A_H
+#define MATH_A_H
+
+#include "util/affine.h"
+#include "util/interval.h"
+
+/** @file tree/math/math_a.h
+    @brief Functions for doing math on affine forms
+    @details These functions take in input Affine forms A and B
+    and return the resulting Affine form.  Only operations with good
+    linear approximations are included; eval_a falls back to interval
+    arithmetic for everything else.
+
+    Functions that linearize a nonlinear operation also take the interval
+    range of their input (which may be tighter than the affine form's range).
+*/
+
+// Binary functions
+Affine add_a(Affine A, Affine B);
+Affine sub_a(Affine A, Affine B);
+Affine mul_a(Affine A, Affine B);
+
+// Unary functions
+Affine neg_a(Affine A);
+Affine square_a(Affine A);
+Affine recip_a(Affine A, Interval I);
+Affine sqrt_a(Affine A, Interval I);
+
+// Variables
+Affine X_a(Interval X);
+Affine Y_a(Interval Y);
+Affine Z_a(Interval Z);
+
+// Conversions
+Affine constant_a(float f);
+Affine interval_to_a(Interval I);
+Interval a_to_interval(Affine A);
+
+#endif
@@ -0,0 +1,156 @@
+#include <math.h>
+
+#include "tree/math/math_f.h"
+#include "tree/math/math_g.h"
+
+/*  chain
+ *
+ *  Returns a result with value v and derivatives k times those of A.
+ */
+_STATIC_
+Deriv chain(float v, float k, Deriv A)
+{
+    return (Deriv){.v=v, .dx=k*A.dx, .dy=k*A.dy, .dz=k*A.dz};
+}
+
+/*  is_constant_g
+ *
+ *  Returns true if A has no derivatives (e.g. a constant or pruned branch).
+ */
+_STATIC_
+_Bool is_constant_g(Deriv A)
+{
+    return A.dx == 0 && A.dy == 0 && A.dz == 0;
+}
+
+////////////////////////////////////////////////////////////////////////////////
+
+Deriv add_g(Deriv A, Deriv B)
+{
+    return (Deriv){.v  = add_f(A.v, B.v),
+                   .dx = A.dx + B.dx,
+                   .dy = A.dy + B.dy,
+                   .dz = A.dz + B.dz};
+}
+
+Deriv sub_g(Deriv A, Deriv B)
+{
+    return (Deriv){.v  = sub_f(A.v, B.v),
+                   .dx = A.dx - B.dx,
+                   .dy = A.dy - B.dy,
+                   .dz = A.dz - B.dz};
+}
+
+Deriv mul_g(Deriv A, Deriv B)
+{
+    return (Deriv){.v  = mul_f(A.v, B.v),
+                   .dx = A.v*B.dx + B.v*A.dx,
+                   .dy = A.v*B.dy + B.v*A.dy,
+                   .dz = A.v*B.dz + B.v*A.dz};
+}
+
+Deriv div_g(Deriv A, Deriv B)
+{
+    const float d = B.v*B.v;
+    return (Deriv){.v  = div_f(A.v, B.v),
+                   .dx = (B.v*A.dx - A.v*B.dx) / d,
+                   .dy = (B.v*A.dy - A.v*B.dy) / d,
+                   .dz = (B.v*A.dz - A.v*B.dz) / d};
+}
+
+// The derivative of min and max is taken from whichever branch is selected.
+// On ties, a branch with derivatives wins over a constant one (so that a
+// surface where the two meet doesn't get a zero gradient); otherwise B wins,
+// matching min_f and max_f.
+Deriv min_g(Deriv A, Deriv B)
+{
+    if (A.v == B.v)     return is_constant_g(B) ? A : B;
+    return A.v < B.v ? A : B;
+}
+
+Deriv max_g(Deriv A, Deriv B)
+{
+    if (A.v == B.v)     return is_constant_g(B) ? A : B;
+    return A.v > B.v ? A : B;
+}
+
+Deriv pow_g(Deriv A, Deriv B)
+{
+    const float v = pow_f(A.v, B.v);
+
+    // d/dt A^B = B*A^(B-1)*A' + ln(A)*A^B*B'
+    const float ka = B.v * pow(A.v, B.v - 1);
+    const float kb = A.v > 0 ? log(A.v) * v : 0;
+    return (Deriv){.v  = v,
+                   .dx = ka*A.dx + kb*B.dx,
+                   .dy = ka*A.dy + kb*B.dy,
+                   .dz = ka*A.dz + kb*B.dz};
+}
+
+////////////////////////////////////////////////////////////////////////////////
+
+Deriv abs_g(Deriv A)
+{
+    return chain(abs_f(A.v), A.v < 0 ? -1 : 1, A);
+}
+
+Deriv square_g(Deriv A)
+{
+    return chain(square_f(A.v), 2*A.v, A);
+}
+
+Deriv sqrt_g(Deriv A)
+{
+    const float v = sqrt_f(A.v);
+    return chain(v, v > 0 ? 0.5 / v : 0, A);
+}
+
+Deriv sin_g(Deriv A)
+{
+    return chain(sin_f(A.v), cos(A.v), A);
+}
+
+Deriv cos_g(Deriv A)
+{
+    return chain(cos_f(A.v), -sin(A.v), A);
+}
+
+Deriv tan_g(Deriv A)
+{
+    const float c = cos(A.v);
+    return chain(tan_f(A.v), 1 / (c*c), A);
+}
+
+Deriv asin_g(Deriv A)
+{
+    // asin_f clamps its input, so the derivative is zero outside [-1, 1]
+    const float k = (A.v > -1 && A.v < 1) ? 1 / sqrt(1 - A.v*A.v) : 0;
+    return chain(asin_f(A.v), k, A);
+}
+
+Deriv acos_g(Deriv A)
+{
+    const float k = (A.v > -1 && A.v < 1) ? -1 / sqrt(1 - A.v*A.v) : 0;
+    return chain(acos_f(A.v), k, A);
+}
+
+Deriv atan_g(Deriv A)
+{
+    return chain(atan_f(A.v), 1 / (1 + A.v*A.v), A);
+}
+
+Deriv neg_g(Deriv A)
+{
+    return chain(neg_f(A.v), -1, A);
+}
+
+////////////////////////////////////////////////////////////////////////////////
+
+Deriv X_g(float X)
+{ return (Deriv){.v=X, .dx=1}; }
+
+Deriv Y_g(float Y)
+{ return (Deriv){.v=Y, .dy=1}; }
+
+Deriv Z_g(float Z)
+{ return (Deriv){.v=Z, .dz=1}; }
@@ -0,0 +1,41 @@
+#ifndef MATH_G_H
+#define MATH_G_H
+
+#include "util/deriv.h"
+
+/** @file tree/math/math_g.h
+    @brief Functions for doing math on values with derivatives
+    @details These functions take in input Derivs A and B and return
+    the result of their computation along with its partial derivatives
+    (found with the chain rule).  Values match the math_f functions.
+*/
+
+// Binary functions
+Deriv add_g(Deriv A, Deriv B);
+Deriv sub_g(Deriv A, Deriv B);
+Deriv mul_g(Deriv A, Deriv B);
+Deriv div_g(Deriv A, Deriv B);
+
+Deriv min_g(Deriv A, Deriv B);
+Deriv max_g(Deriv A, Deriv B);
+
+Deriv pow_g(Deriv A, Deriv B);
+
+// Unary functions
+Deriv abs_g(Deriv A);
+Deriv square_g(Deriv A);
+Deriv sqrt_g(Deriv A);
+Deriv sin_g(Deriv A);
+Deriv cos_g(Deriv A);
+Deriv tan_g(Deriv A);
+Deriv asin_g(Deriv A);
+Deriv acos_g(Deriv A);
+Deriv atan_g(Deriv A);
+Deriv neg_g(Deriv A);
+
+// Variables
+Deriv X_g(float X);
+Deriv Y_g(float Y);
+Deriv Z_g(float Z);
+
+#endif
@@ -14,12 +14,11 @@ typedef struct Results_
 {
     float    f;
     Interval i;
-    float    r[MIN_VOLUME];
 } Results;
 
 
 /** @brief Fills node results with a constant
-    @details n->results.{f,i,r} are all set equal to the constant
+    @details n->results.{f,i} are both set equal to the constant
     @param n Target node
     @param value Constant to fill
 */
@@ -1,112 +1,300 @@
 #include <stdlib.h>
+#include <stdint.h>
+#include <string.h>
 
 #include "tree/packed.h"
 #include "tree/tree.h"
 
 #include "tree/node/node.h"
 
+/** @struct SlotMap_
+    @brief Pairs a node with its result slot (used while building a tape)
+*/
+typedef struct SlotMap_ {
+    const Node* node;
+    uint32_t slot;
+} SlotMap;
+
+
+_STATIC_
+int compare_slot_maps(const void* a, const void* b)
+{
+    const uintptr_t A = (uintptr_t)((const SlotMap*)a)->node,
+                    B = (uintptr_t)((const SlotMap*)b)->node;
+    return (A > B) - (A < B);
+}
+
+
+_STATIC_
+uint32_t find_slot(const SlotMap* const map, const unsigned count,
+                   const Node* const node)
+{
+    const SlotMap key = {.node=node};
+    const SlotMap* m = bsearch(&key, map, count, sizeof(SlotMap),
+                               compare_slot_maps);
+    return m->slot;
+}
+
+
+/*  fill_slot
+ *
+ *  Sets the f, i, a, and r results of a slot to a constant value.
+ */
+_STATIC_
+void fill_slot(PackedTree* tree, const uint32_t slot, const float value)
+{
+    tree->f[slot] = value;
+    tree->i[slot] = (Interval){.lower=value, .upper=value};
+    tree->a[slot] = (Affine){.center=value};
+    tree->g[slot] = (Deriv){.v=value};
+    float* const r = tree->r + slot*tree->block;
+    for (unsigned q=0; q < tree->block; ++q)    r[q] = value;
+}
+
+
 PackedTree* make_packed(MathTree* tree)
 {
     if (!tree)  return NULL;
 
-    int num_levels = tree->num_levels;
+    const unsigned num_levels = tree->num_levels;
 
     PackedTree* packed = malloc(sizeof(PackedTree));
-
     (*packed) = (PackedTree) {
-        .nodes      = num_levels ?
-                        calloc(num_levels, sizeof(Node**)) : NULL,
+        .offsets    = num_levels ?
+                        calloc(num_levels, sizeof(unsigned)) : NULL,
         .active     = num_levels ?
                         calloc(num_levels, sizeof(unsigned)) : NULL,
         .disabled   = num_levels ?
                         calloc(num_levels, sizeof(ustack*)) : NULL,
         .num_levels = num_levels,
-        .head       = tree->head
+        .block      = MIN_VOLUME,
     };
 
-    // Copy all nodes into the packed tree.
-    for (unsigned level=0; level < tree->num_levels; ++level) {
+    // Count up the clauses in each level
+    unsigned num_clauses = 0;
+    for (unsigned level=0; level < num_levels; ++level) {
+        packed->offsets[level] = num_clauses;
         for (unsigned op=0; op < LAST_OP; ++op) {
             packed->active[level] += tree->active[level][op];
         }
-        packed->nodes[level] = malloc(sizeof(Node*)*packed->active[level]);
-        int index = 0;
+        num_clauses += packed->active[level];
+    }
+
+    packed->num_clauses = num_clauses;
+
+    // Constants take the first slots, followed by one slot per clause
+    // (in the same order as the tape).
+    packed->num_slots = tree->num_constants + num_clauses;
+    SlotMap* map = malloc(sizeof(SlotMap)*packed->num_slots);
+
+    unsigned slot = 0;
+    for (unsigned c=0; c < tree->num_constants; ++c, ++slot) {
+        map[slot] = (SlotMap){.node=tree->constants[c], .slot=slot};
+    }
+    for (unsigned level=0; level < num_levels; ++level) {
+        for (unsigned op=0; op < LAST_OP; ++op) {
+            for (unsigned n=0; n < tree->active[level][op]; ++n, ++slot) {
+                map[slot] = (SlotMap){.node=tree->nodes[level][op][n],
+                                      .slot=slot};
+            }
+        }
+    }
+    qsort(map, packed->num_slots, sizeof(SlotMap), compare_slot_maps);
+
+    // Allocate the result arena
+    const unsigned n = packed->num_slots ? packed->num_slots : 1;
+    packed->f       = malloc(sizeof(float)*n);
+    packed->i       = malloc(sizeof(Interval)*n);
+    packed->a       = malloc(sizeof(Affine)*n);
+    packed->g       = malloc(sizeof(Deriv)*n);
+    packed->r       = malloc(sizeof(float)*packed->block*n);
+    packed->flags   = calloc(n, sizeof(uint8_t));
+
+    for (unsigned c=0; c < tree->num_constants; ++c) {
+        fill_slot(packed, c, tree->constants[c]->results.f);
+    }
+
+    // Compile every node into a clause
+    packed->tape = malloc(sizeof(Clause)*(num_clauses ? num_clauses : 1));
+    slot = tree->num_constants;
+    for (unsigned level=0; level < num_levels; ++level) {
         for (unsigned op=0; op < LAST_OP; ++op) {
-            for (unsigned n=0; n < tree->active[level][op]; ++n) {
-                packed->nodes[level][index++] = tree->nodes[level][op][n];
+            for (unsigned q=0; q < tree->active[level][op]; ++q, ++slot) {
+                const Node* node = tree->nodes[level][op][q];
+                Clause c = {.opcode=node->opcode, .out=slot};
+                if (node->lhs) {
+                    c.lhs = find_slot(map, packed->num_slots, node->lhs);
+                }
+                c.rhs = node->rhs ? find_slot(map, packed->num_slots,
+                                              node->rhs)
+                                  : c.lhs;
+                packed->tape[slot - tree->num_constants] = c;
             }
         }
     }
+
+    packed->head = find_slot(map, packed->num_slots, tree->head);
+    free(map);
+
     return packed;
 }
 
-void free_packed(PackedTree* packed)
+PackedTree* fork_packed(const PackedTree* packed)
 {
-    if (packed == NULL) return;
+    if (!packed)    return NULL;
 
-    for (unsigned level=0; level < packed->num_levels; ++level) {
-        free(packed->nodes[level]);
+    const unsigned num_levels = packed->num_levels;
+    const unsigned num_clauses = packed->num_clauses;
+    const unsigned n = packed->num_slots ? packed->num_slots : 1;
+
+    PackedTree* fork = malloc(sizeof(PackedTree));
+    (*fork) = (PackedTree) {
+        .tape       = malloc(sizeof(Clause)*(num_clauses ? num_clauses : 1)),
+        .offsets    = num_levels ?
+                        malloc(num_levels*sizeof(unsigned)) : NULL,
+        .active     = num_levels ?
+                        malloc(num_levels*sizeof(unsigned)) : NULL,
+        .disabled   = num_levels ?
+                        calloc(num_levels, sizeof(ustack*)) : NULL,
+        .num_levels = num_levels,
+        .num_clauses= num_clauses,
+        .num_slots  = packed->num_slots,
+        .head       = packed->head,
+        .affine     = packed->affine,
+        .block      = packed->block,
+        .f          = malloc(sizeof(float)*n),
+        .i          = malloc(sizeof(Interval)*n),
+        .a          = malloc(sizeof(Affine)*n),
+        .g          = malloc(sizeof(Deriv)*n),
+        .r          = malloc(sizeof(float)*packed->block*n),
+        .flags      = calloc(n, sizeof(uint8_t)),
+    };
+
+    // Clauses within a level are independent, so the original's order
+    // (which pruning may have shuffled) is fine; every clause is active.
+    memcpy(fork->tape, packed->tape, sizeof(Clause)*num_clauses);
+    for (unsigned level=0; level < num_levels; ++level) {
+        fork->offsets[level] = packed->offsets[level];
+        fork->active[level] = (level + 1 < num_levels ?
+                               packed->offsets[level + 1] : num_clauses)
+                              - packed->offsets[level];
     }
 
-    free(packed->nodes);
+    // Constants are only stored in their result slots, so copy every
+    // slot's value (other slots are overwritten on evaluation anyways).
+    for (unsigned s=0; s < packed->num_slots; ++s) {
+        fill_slot(fork, s, packed->f[s]);
+    }
+
+    return fork;
+}
+
+void free_packed(PackedTree* packed)
+{
+    if (packed == NULL) return;
+
+    free(packed->tape);
+    free(packed->offsets);
     free(packed->active);
     free(packed->disabled);
 
+    free(packed->f);
+    free(packed->i);
+    free(packed->a);
+    free(packed->g);
+    free(packed->r);
+    free(packed->flags);
+
     free(packed);
 }
 
+void set_block_size(PackedTree* packed, unsigned block)
+{
+    if (packed == NULL || block == 0 || block == packed->block)  return;
+
+    const unsigned n = packed->num_slots ? packed->num_slots : 1;
+    free(packed->r);
+    packed->block = block;
+    packed->r = malloc(sizeof(float)*block*n);
+
+    // Refill every slot from its float result (this restores constants;
+    // other slots are overwritten on the next evaluation anyways).
+    for (unsigned s=0; s < packed->num_slots; ++s) {
+        fill_slot(packed, s, packed->f[s]);
+    }
+}
+
+void set_affine(PackedTree* packed, _Bool affine)
+{
+    if (packed)     packed->affine = affine;
+}
+
+void set_stats(PackedTree* packed, Stats* stats)
+{
+    if (packed)     packed->stats = stats;
+}
+
 ////////////////////////////////////////////////////////////////////////////////
 
 _STATIC_
-void disable_node(PackedTree* tree, int level, int n)
+void disable_clause(PackedTree* tree, int level, int n)
 {
-    Node* node = tree->nodes[level][n];
+    Clause* const row = tree->tape + tree->offsets[level];
+    const Clause clause = row[n];
 
     // Fill all of the result slots with this value
-    fill_results(node, node->results.i.upper);
+    fill_slot(tree, clause.out, tree->i[clause.out].upper);
 
-    // Figure out where we should swap this node to.
+    // Swap this clause to the back of the active list
     int back = --tree->active[level];
-    Node* swap = tree->nodes[level][back];
-
-    // And execute the swap.
-    tree->nodes[level][n--]  = swap;
-    tree->nodes[level][back] = node;
+    row[n]    = row[back];
+    row[back] = clause;
 
     // Finally, increase the count of disabled nodes
     tree->disabled[level]->count++;
+    STAT(tree, disabled, 1);
 }
 
 
 void disable_nodes_binary(PackedTree* tree)
 {
+    uint8_t* const flags = tree->flags;
+
     for (int level=0; level < tree->num_levels; ++level) {
+        const Clause* const row = tree->tape + tree->offsets[level];
         for (int n=0; n < tree->active[level]; ++n) {
-            tree->nodes[level][n]->flags |= NODE_BOOLEAN;
+            flags[row[n].out] |= NODE_BOOLEAN;
         }
     }
 
     for (int level=tree->num_levels-1; level >= 0; --level) {
+        const Clause* const row = tree->tape + tree->offsets[level];
 
         for (int n=0; n < tree->active[level]; ++n) {
-            Node* node = tree->nodes[level][n];
+            const Clause c = row[n];
+            const Interval i = tree->i[c.out];
 
-            if ((node->flags & NODE_BOOLEAN) &&
-                (node->results.i.lower >= 0 || node->results.i.upper < 0))
+            if ((flags[c.out] & NODE_BOOLEAN) &&
+                (i.lower >= 0 || i.upper < 0))
             {
-                disable_node(tree, level, n--);
-                node->flags = 0;
+                disable_clause(tree, level, n--);
+                flags[c.out] = 0;
+            }
+
+            // Variables don't have children
+            if (c.opcode == OP_X || c.opcode == OP_Y || c.opcode == OP_Z) {
+                continue;
             }
 
             // If a node isn't binary, or it has a non-binary opcode,
             // then mark that children aren't binary.
-            if (!(node->flags & NODE_BOOLEAN) ||
-                    (node->opcode != OP_MIN &&
-                     node->opcode != OP_MAX &&
-                     node->opcode != OP_NEG))
+            if (!(flags[c.out] & NODE_BOOLEAN) ||
+                    (c.opcode != OP_MIN &&
+                     c.opcode != OP_MAX &&
+                     c.opcode != OP_NEG))
             {
-                if (node->lhs)  node->lhs->flags &= ~NODE_BOOLEAN;
-                if (node->rhs)  node->rhs->flags &= ~NODE_BOOLEAN;
+                flags[c.lhs] &= ~NODE_BOOLEAN;
+                flags[c.rhs] &= ~NODE_BOOLEAN;
             }
         }
     }
@@ -116,16 +304,23 @@ void disable_nodes_binary(PackedTree* tree)
 
 void disable_nodes(PackedTree* tree)
 {
+    uint8_t* const flags = tree->flags;
+    const Interval* const I = tree->i;
+
+    STAT(tree, prunes, 1);
+
     // Mark every node as ignored and binary.
     // We'll then go down the tree and mark nodes as uncacheable.
     for (int level=0; level < tree->num_levels; ++level) {
+        const Clause* const row = tree->tape + tree->offsets[level];
         for (int n=0; n < tree->active[level]; ++n) {
-            tree->nodes[level][n]->flags |= NODE_IGNORED;
+            flags[row[n].out] |= NODE_IGNORED;
         }
     }
-    tree->head->flags &= ~NODE_IGNORED;
+    flags[tree->head] &= ~NODE_IGNORED;
 
     for (int level=tree->num_levels-1; level >= 0; --level) {
+        const Clause* const row = tree->tape + tree->offsets[level];
 
         // Save the number of nodes disabled in this pass so that
         // we can reverse the operation later.
@@ -134,46 +329,49 @@ void disable_nodes(PackedTree* tree)
         *(tree->disabled[level]) = (ustack){0, tmp};
 
         for (int n=0; n < tree->active[level]; ++n) {
-            Node* node = tree->nodes[level][n];
+            const Clause c = row[n];
 
             // If this node is marked, swap it to the back of the list
             // and decrement the active nodes count.
-            if (node->flags & NODE_IGNORED) {
-                disable_node(tree, level, n--);
-                node->flags = 0;
+            if (flags[c.out] & NODE_IGNORED) {
+                disable_clause(tree, level, n--);
+                flags[c.out] = 0;
+            }
+
+            // Variables don't have children
+            else if (c.opcode == OP_X || c.opcode == OP_Y ||
+                     c.opcode == OP_Z)
+            {
+                continue;
             }
 
             // If this is a max or min node, then we might need to
             // only keep one branch active (if that branch is definitely
             // larger/smaller than the other branch)
-            else if (node->opcode == OP_MAX) {
-                if (node->lhs->results.i.lower >=
-                        node->rhs->results.i.upper) {
-                    node->lhs->flags &= ~NODE_IGNORED;
-                } else if (node->rhs->results.i.lower >=
-                        node->lhs->results.i.upper) {
-                    node->rhs->flags &= ~NODE_IGNORED;
+            else if (c.opcode == OP_MAX) {
+                if (I[c.lhs].lower >= I[c.rhs].upper) {
+                    flags[c.lhs] &= ~NODE_IGNORED;
+                } else if (I[c.rhs].lower >= I[c.lhs].upper) {
+                    flags[c.rhs] &= ~NODE_IGNORED;
                 } else {
-                    node->lhs->flags &= ~NODE_IGNORED;
-                    node->rhs->flags &= ~NODE_IGNORED;
+                    flags[c.lhs] &= ~NODE_IGNORED;
+                    flags[c.rhs] &= ~NODE_IGNORED;
                 }
-            } else if (node->opcode == OP_MIN) {
-                if (node->lhs->results.i.upper <=
-                        node->rhs->results.i.lower) {
-                    node->lhs->flags &= ~NODE_IGNORED;
-                } else if (node->rhs->results.i.upper <=
-                        node->lhs->results.i.lower) {
-                    node->rhs->flags &= ~NODE_IGNORED;
+            } else if (c.opcode == OP_MIN) {
+                if (I[c.lhs].upper <= I[c.rhs].lower) {
+                    flags[c.lhs] &= ~NODE_IGNORED;
+                } else if (I[c.rhs].upper <= I[c.lhs].lower) {
+                    flags[c.rhs] &= ~NODE_IGNORED;
                 } else {
-                    node->lhs->flags &= ~NODE_IGNORED;
-                    node->rhs->flags &= ~NODE_IGNORED;
+                    flags[c.lhs] &= ~NODE_IGNORED;
+                    flags[c.rhs] &= ~NODE_IGNORED;
                 }
             }
 
             // Other node types need to keep both branches active
             else {
-                if (node->lhs)  node->lhs->flags &= ~NODE_IGNORED;
-                if (node->rhs)  node->rhs->flags &= ~NODE_IGNORED;
+                flags[c.lhs] &= ~NODE_IGNORED;
+                flags[c.rhs] &= ~NODE_IGNORED;
             }
         }
     }
@@ -195,14 +393,12 @@ uint8_t active_axes(const PackedTree* const tree)
     if (!tree->num_levels)  return 0;
 
     uint8_t active = 0;
-    if (tree->num_levels) {
-        for (int a=0; a < tree->active[0]; ++a) {
-            switch (tree->nodes[0][a]->opcode) {
-                case OP_X:  active |= (1 << 2); break;
-                case OP_Y:  active |= (1 << 1); break;
-                case OP_Z:  active |= (1 << 0); break;
-                default: ;
-            }
+    for (int a=0; a < tree->active[0]; ++a) {
+        switch (tree->tape[a].opcode) {
+            case OP_X:  active |= (1 << 2); break;
+            case OP_Y:  active |= (1 << 1); break;
+            case OP_Z:  active |= (1 << 0); break;
+            default: ;
         }
     }
 
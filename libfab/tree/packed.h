@@ -3,7 +3,12 @@
 
 #include <stdint.h>
 
+#include "tree/stats.h"
 #include "tree/tree.h"
+#include "util/affine.h"
+#include "util/deriv.h"
+#include "util/interval.h"
+#include "util/switches.h"
 
 /** @struct ustack_
     @brief A simple FIFO stack of unsigned integers.
@@ -18,54 +23,176 @@ typedef struct ustack_ {
     struct ustack_* next;
 } ustack;
 
+
+/** @struct Clause_
+    @brief A single instruction in a PackedTree's tape.
+    @details Operands and results are indices into the tree's result slots.
+*/
+typedef struct Clause_ {
+    /** @var opcode
+    Instruction operation */
+    Opcode opcode;
+
+    /** @var lhs
+    Slot of the left-hand operand (unused for variables) */
+    uint32_t lhs;
+
+    /** @var rhs
+    Slot of the right-hand operand (equal to lhs for unary operations) */
+    uint32_t rhs;
+
+    /** @var out
+    Slot in which the result is stored */
+    uint32_t out;
+} Clause;
+
+
 /** @struct PackedTree_
-    @brief A structure containing nodes organized by rank
+    @brief A math tree compiled into a flat tape of instructions
+    @details Clauses are stored contiguously, grouped by level (so that every
+    clause comes after the clauses that compute its operands).  The first
+    active[level] clauses of each level are evaluated; pruning swaps clauses
+    past this boundary.
+
+    Every node has a result slot, and results for all slots are stored
+    in contiguous arrays owned by the packed tree.
+
+    A packed tree is also an evaluation context:  the result slots, the
+    clause order, and the pruning stacks all change as it's evaluated, so
+    it must only be used by one thread at a time.  Threads that evaluate
+    the same tree should each have a copy made with fork_packed.
 */
 typedef struct PackedTree_ {
-    /** @var nodes
-    Node pointers, stored in rows indexed by level */
-    struct Node_*** nodes;
+    /** @var tape
+    Array of clauses, grouped by level */
+    Clause* tape;
+
+    /** @var offsets
+    Index in tape of the first clause of each level */
+    unsigned* offsets;
 
     /** @var active
-    Number of active nodes, indexed by level */
+    Number of active clauses, indexed by level */
     unsigned* active;
 
     /** @var disabled
-    Stacks of disabled node counts, indexed by level */
+    Stacks of disabled clause counts, indexed by level */
     ustack**  disabled;
 
     /** @var num_levels
     Number of levels in this tree */
     unsigned num_levels;
 
+    /** @var num_clauses
+    Number of clauses in the tape */
+    unsigned num_clauses;
+
+    /** @var num_slots
+    Number of result slots (one per node, including constants) */
+    unsigned num_slots;
+
     /** @var head
-    Root of this tree */
-    struct Node_* head;
+    Result slot of this tree's root */
+    uint32_t head;
+
+    /** @var f
+    Floating-point results, indexed by slot */
+    float* f;
+
+    /** @var i
+    Interval results, indexed by slot */
+    Interval* i;
+
+    /** @var a
+    Affine results, indexed by slot */
+    Affine* a;
+
+    /** @var g
+    Results with partial derivatives, indexed by slot */
+    Deriv* g;
+
+    /** @var affine
+    If true, eval_bounds uses affine arithmetic (rather than intervals) */
+    _Bool affine;
+
+    /** @var block
+    Block size: regions with fewer voxels than this are evaluated
+    with eval_r rather than subdivided */
+    unsigned block;
+
+    /** @var r
+    Region results, with block values per slot */
+    float* r;
+
+    /** @var flags
+    Flags used while pruning (NODE_IGNORED and NODE_BOOLEAN), indexed by slot */
+    uint8_t* flags;
+
+    /** @var stats
+    Profiling counters (or NULL if counting is disabled) */
+    Stats* stats;
 } PackedTree;
 
 
 /** @brief Converts a MathTree into a PackedTree
     @param tree A well-formed, deduplicated MathTree.
-    @returns A PackedTree with the same nodes.
-    @details Nodes are not copied; they point back to the original MathTree
+    @returns A PackedTree with one clause per node.
+    @details The PackedTree doesn't refer back to the MathTree, which may be
+    modified or freed afterwards.
 */
 PackedTree* make_packed(struct MathTree_* tree);
 
 
+/** @brief Makes a new evaluation context for an existing packed tree
+    @details The new tree has the same clauses, block size, and arithmetic
+    mode as the original, with every clause active and its own result slots
+    and pruning stacks.  This is much cheaper than cloning and re-packing
+    the MathTree, so threads should share one packed tree in this way.
+    Must not be called while the original is being evaluated.
+    @param packed Source tree
+    @returns A new PackedTree (to be freed with free_packed)
+*/
+PackedTree* fork_packed(const PackedTree* packed);
+
+
 /** @brief Frees a packed tree.
-    @details Does not free nodes, since they should be
-    pointers to the same nodes as the original MathTree.
 */
 void free_packed(PackedTree* packed);
 
 
+/** @brief Changes a packed tree's block size
+    @details Reallocates the region result arrays.  Must not be called
+    while any nodes are disabled.
+    @param packed Target tree
+    @param block New block size (in voxels)
+*/
+void set_block_size(PackedTree* packed, unsigned block);
+
+
+/** @brief Selects interval or affine arithmetic for eval_bounds
+    @param packed Target tree
+    @param affine If true, use affine arithmetic
+*/
+void set_affine(PackedTree* packed, _Bool affine);
+
+
+/** @brief Attaches profiling counters to a packed tree
+    @details Counters are added to (not reset).  The structure isn't owned
+    by the tree, and isn't copied by fork_packed.
+    @param packed Target tree
+    @param stats Counters to fill, or NULL to disable counting
+*/
+void set_stats(PackedTree* packed, Stats* stats);
+
+
 /** @brief Travels down the tree, disabling nodes whose values will not matter
     upon further spatial subdivision
 
     @details
-    Nodes are disabled by swapping them to the back of their respective list
+    Nodes are disabled by swapping their clauses to the back of their level
     and decrementing the active count (so that the evaluation loop doesn't
-    touch them at all).
+    touch them at all).  The result slot of a disabled node is filled with
+    its most recent interval result.
 
     A count of nodes disabled in this pass is stored on the top of the
     disabled stack (used by enable_nodes).
@@ -86,8 +213,8 @@ void disable_nodes_binary(PackedTree* tree);
 /** @brief Enables nodes that were disabled on the most recent call to disable_nodes.
 
     @details
-    Nodes are enabled by increasing the value of active[level][op], so that
-    an evaluation continues further down the list.
+    Nodes are enabled by increasing the value of active[level], so that
+    an evaluation continues further down the tape.
 */
 void enable_nodes(PackedTree* tree);
 
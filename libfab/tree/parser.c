@@ -29,6 +29,7 @@
 #include <math.h>
 #include <string.h>
 #include <stdbool.h>
+#include <stdint.h>
 
 #include "tree/tree.h"
 #include "tree/parser.h"
@@ -38,20 +39,25 @@
 
 ////////////////////////////////////////////////////////////////////////////////
 
-/* Linked list of Nodes */
-typedef struct NodeList_
-{
-    Node* node;
-    struct NodeList_* next;
-} NodeList;
-
-
-/* Cache storing multiple lists of NodeLists */
+/* Cache storing every unique node, with a hash table for lookups */
 typedef struct NodeCache_
 {
     int levels;
-    NodeList* (*nodes)[LAST_OP];
-    NodeList* constants;
+
+    /* Cached nodes, in the order that they were added */
+    Node** nodes;
+    unsigned count;
+    unsigned size;
+
+    /* Open-addressed hash table of indices into nodes (plus one,
+       so that zero marks an empty bucket).  Its size is a power of two. */
+    uint32_t* table;
+    unsigned buckets;
+
+    /* Cached X, Y, and Z nodes */
+    Node *X, *Y, *Z;
+
+    _Bool simplify;
 } NodeCache;
 
 
@@ -72,6 +78,37 @@ Node* get_token(const char** input, _Bool* const failed,
                         Node* X, Node* Y, Node* Z,
                         NodeCache* const cache);
 
+/** @brief Makes a node for an operation token with the given arguments
+    @details Simplifies the operation (if enabled) and looks up the
+    result in the node cache.
+    @param c Operation token
+    @param lhs Left-hand argument (cached)
+    @param rhs Right-hand argument (cached, or NULL for unary operations)
+    @param cache Node cache
+    @param failed Flag set if the token isn't a valid operation
+    @returns A cached node
+*/
+_STATIC_
+Node* make_node(const char c, Node* const lhs, Node* const rhs,
+                NodeCache* const cache, _Bool* const failed);
+
+/** @brief Applies algebraic simplifications to an operation
+    @details Drops identity operations (x+0, x*1, x/1, x^1, --x),
+    absorbs negations into addition, subtraction, and multiplication,
+    merges min(x, x) and max(x, x), and collapses nested min/max
+    operations with constant arguments.  Constant subtrees are
+    already folded by the node constructors.
+    @param c Operation token
+    @param lhs Left-hand argument (cached)
+    @param rhs Right-hand argument (cached, or NULL for unary operations)
+    @param cache Node cache
+    @returns A cached node equivalent to the operation, or NULL if
+    no simplification applies
+*/
+_STATIC_
+Node* simplify(const char c, Node* const lhs, Node* const rhs,
+               NodeCache* const cache);
+
 /** @brief Gets a float from the input stream
     @param input Input stream (incremented as we go)
     @param failed Flag (set to True if something goes wrong)
@@ -81,14 +118,15 @@ _STATIC_
 Node* get_float(const char** input, _Bool* const failed);
 
 
-/*  Looks up a node in the cache.  If not found, it is appended to the
- *  appropriate cache slot; if found, the original node is freed and
- *  the cached node pointer is returned.
+/*  Looks up a node in the cache.  If not found, it is added to the
+ *  cache; if found, the original node is freed and the cached node
+ *  pointer is returned.
  *
  *  The input node's children should be deduplicated and cached; we check
  *  by comparing their pointer values.  Nodes are considered equal if they
  *  have the same opcode and same child pointers, or if they are OP_CONST
- *  and have the same values.
+ *  and have the same values.  Lookups are done in a hash table keyed on
+ *  (opcode, lhs, rhs) or on the constant's value.
  */
 _STATIC_
 Node* get_cached_node(NodeCache* const cache, Node* const n);
@@ -110,30 +148,79 @@ void free_node_cache(NodeCache* const c);
 
 MathTree* parse(const char* input)
 {
-    _Bool failed = false;
+    return parse_tree(input, true);
+}
+
+MathTree* parse_tree(const char* input, _Bool simplify)
+{
+    NodeCache* cache = make_builder(simplify);
+
+    // Parse the string, storing nodes in the cache and receiving the head
+    Node* head = builder_parse(cache, input, NULL, NULL, NULL);
 
+    if (!head) {
+        free_builder(cache);
+        return NULL;
+    }
+    return builder_finish(cache, head);
+}
+
+////////////////////////////////////////////////////////////////////////////////
+
+NodeCache* make_builder(_Bool simplify)
+{
     // Create a cache in which nodes will be stored
     NodeCache* cache = malloc(sizeof(NodeCache));
-    *cache = (NodeCache){ .levels=0, .constants=NULL };
+    *cache = (NodeCache){ .levels=0, .simplify=simplify };
 
     // Throw X, Y, and Z nodes into the cache
-    Node* X = get_cached_node(cache, X_n());
-    Node* Y = get_cached_node(cache, Y_n());
-    Node* Z = get_cached_node(cache, Z_n());
+    cache->X = get_cached_node(cache, X_n());
+    cache->Y = get_cached_node(cache, Y_n());
+    cache->Z = get_cached_node(cache, Z_n());
+
+    return cache;
+}
 
-    // Parse the string, storing nodes in the cache and receiving the head
-    Node* head = get_token(&input, &failed, X, Y, Z, cache);
 
-    //  Abort if:
+Node* builder_parse(NodeCache* cache, const char* input,
+                    Node* X, Node* Y, Node* Z)
+{
+    _Bool failed = false;
+    Node* head = get_token(&input, &failed,
+                           X ? X : cache->X,
+                           Y ? Y : cache->Y,
+                           Z ? Z : cache->Z, cache);
+
+    //  Fail if:
     //      The parser failed
     //      The parser didn't return a valid head
     //          (this might be a subset of the above)
     //      The input stream isn't empty
-    if (failed || !head || *input) {
-        free_node_cache(cache);
+    return (failed || !head || *input) ? NULL : head;
+}
+
+
+Node* builder_op(NodeCache* cache, char op, Node* lhs, Node* rhs)
+{
+    if (!lhs)   return NULL;
+
+    // Check the operation's arity before constructing anything
+    if (strchr("+-*/iap", op)) {
+        if (!rhs)   return NULL;
+    } else if (strchr("sctSCTbqrn", op)) {
+        rhs = NULL;
+    } else {
         return NULL;
     }
 
+    _Bool failed = false;
+    Node* out = make_node(op, lhs, rhs, cache, &failed);
+    return failed ? NULL : out;
+}
+
+
+MathTree* builder_finish(NodeCache* cache, Node* head)
+{
     // Pack the cache into a MathTree data structure
     flag_in_tree(head);
     MathTree* T = cache_to_tree(cache);
@@ -144,6 +231,14 @@ MathTree* parse(const char* input)
     return T;
 }
 
+
+void free_builder(NodeCache* cache)
+{
+    free_node_cache(cache);
+}
+
+////////////////////////////////////////////////////////////////////////////////
+
 _STATIC_
 void flag_in_tree(Node* n)
 {
@@ -221,13 +316,32 @@ Node* get_token(const char** const input, _Bool* const failed,
     if (*failed)    c = 0;
 
     switch(c) {
-
         case 'X':
         case 'Y':
         case 'Z':
         case 'f':
-        case 'm':   break;
+        case 'm':   return get_cached_node(cache, out);
+
+        case 0:
+            *failed = true;
+            return get_cached_node(cache, out);
+
+        default:    return make_node(c, lhs, rhs, cache, failed);
+    }
+}
+
+
+_STATIC_
+Node* make_node(const char c, Node* const lhs, Node* const rhs,
+                NodeCache* const cache, _Bool* const failed)
+{
+    if (cache->simplify && lhs) {
+        Node* s = simplify(c, lhs, rhs, cache);
+        if (s)  return s;
+    }
 
+    Node* out = NULL;
+    switch(c) {
         case '+':   out = add_n(lhs, rhs); break;
         case '-':   out = sub_n(lhs, rhs); break;
         case '*':   out = mul_n(lhs, rhs); break;
@@ -255,6 +369,105 @@ Node* get_token(const char** const input, _Bool* const failed,
 }
 
 
+/*  is_constant
+ *
+ *  Checks whether a node is a constant with the given value.
+ */
+_STATIC_
+_Bool is_constant(const Node* const n, const float value)
+{
+    return (n->flags & NODE_CONSTANT) && n->results.f == value;
+}
+
+_STATIC_
+Node* simplify(const char c, Node* const lhs, Node* const rhs,
+               NodeCache* const cache)
+{
+    // Binary operations need both arguments
+    if (strchr("+-*/iap", c) && !rhs)   return NULL;
+
+    switch (c) {
+        case '+':
+            if (is_constant(lhs, 0))    return rhs;
+            if (is_constant(rhs, 0))    return lhs;
+            if (rhs->opcode == OP_NEG) {
+                return get_cached_node(cache, sub_n(lhs, rhs->lhs));
+            }
+            if (lhs->opcode == OP_NEG) {
+                return get_cached_node(cache, sub_n(rhs, lhs->lhs));
+            }
+            break;
+        case '-':
+            if (is_constant(rhs, 0))    return lhs;
+            if (is_constant(lhs, 0)) {
+                Node* s = simplify('n', rhs, NULL, cache);
+                return s ? s : get_cached_node(cache, neg_n(rhs));
+            }
+            if (rhs->opcode == OP_NEG) {
+                return get_cached_node(cache, add_n(lhs, rhs->lhs));
+            }
+            break;
+        case '*':
+            if (is_constant(lhs, 1))    return rhs;
+            if (is_constant(rhs, 1))    return lhs;
+            if (lhs->opcode == OP_NEG && rhs->opcode == OP_NEG) {
+                return get_cached_node(cache, mul_n(lhs->lhs, rhs->lhs));
+            }
+            break;
+        case '/':
+        case 'p':
+            if (is_constant(rhs, 1))    return lhs;
+            break;
+
+        case 'i':
+        case 'a': {
+            if (lhs == rhs)     return lhs;
+
+            // min(c1, min(c2, x)) becomes min(min(c1, c2), x)
+            // (and likewise for max).  Children are ordered so that
+            // the constant is on the left.
+            Node* (*op_n)(Node*, Node*) = (c == 'i') ? min_n : max_n;
+            const Opcode op = (c == 'i') ? OP_MIN : OP_MAX;
+            Node* k = (lhs->flags & NODE_CONSTANT) ? lhs : rhs;
+            Node* n = (k == lhs) ? rhs : lhs;
+            if ((k->flags & NODE_CONSTANT) && n->opcode == op) {
+                Node *nk = NULL, *nx = NULL;
+                if (n->lhs->flags & NODE_CONSTANT) {
+                    nk = n->lhs;
+                    nx = n->rhs;
+                } else if (n->rhs->flags & NODE_CONSTANT) {
+                    nk = n->rhs;
+                    nx = n->lhs;
+                }
+                if (nk) {
+                    Node* folded = get_cached_node(cache, op_n(k, nk));
+                    return get_cached_node(cache, op_n(folded, nx));
+                }
+            }
+            break;
+        }
+
+        case 'n':
+            if (lhs->opcode == OP_NEG)      return lhs->lhs;
+            break;
+        case 'b':
+            if (lhs->opcode == OP_ABS || lhs->opcode == OP_SQUARE) {
+                return lhs;
+            }
+            if (lhs->opcode == OP_NEG) {
+                return get_cached_node(cache, abs_n(lhs->lhs));
+            }
+            break;
+        case 'q':
+            if (lhs->opcode == OP_NEG) {
+                return get_cached_node(cache, square_n(lhs->lhs));
+            }
+            break;
+    }
+    return NULL;
+}
+
+
 _STATIC_
 Node* get_float(const char** const input, _Bool* const failed)
 {
@@ -312,57 +525,97 @@ Node* get_float(const char** const input, _Bool* const failed)
 }
 
 
+/*  hash_node
+ *
+ *  Hashes a node by its value (for constants) or by its opcode and
+ *  child pointers (for everything else).
+ */
+_STATIC_
+uint32_t hash_node(const Node* const n)
+{
+    uint64_t h;
+    if (n->flags & NODE_CONSTANT) {
+        // 0 and -0 compare equal, so they need to hash equally
+        const float f = (n->results.f == 0) ? 0 : n->results.f;
+        uint32_t bits;
+        memcpy(&bits, &f, sizeof(bits));
+        h = bits + 1;
+    } else {
+        h = n->opcode;
+        h = h*0x9e3779b97f4a7c15ull ^ (uintptr_t)n->lhs;
+        h = h*0x9e3779b97f4a7c15ull ^ (uintptr_t)n->rhs;
+    }
+    h ^= h >> 31;
+    h *= 0xbf58476d1ce4e5b9ull;
+    h ^= h >> 29;
+    return h;
+}
+
+
+_STATIC_
+_Bool nodes_equal(const Node* const a, const Node* const b)
+{
+    if ((a->flags & NODE_CONSTANT) || (b->flags & NODE_CONSTANT)) {
+        return (a->flags & NODE_CONSTANT) && (b->flags & NODE_CONSTANT) &&
+               a->results.f == b->results.f;
+    }
+    return a->opcode == b->opcode && a->lhs == b->lhs && a->rhs == b->rhs;
+}
+
+
+/*  grow_table
+ *
+ *  Doubles the number of buckets in the cache's hash table,
+ *  re-inserting every cached node.
+ */
+_STATIC_
+void grow_table(NodeCache* const cache)
+{
+    free(cache->table);
+    cache->buckets = cache->buckets ? cache->buckets*2 : 256;
+    cache->table = calloc(cache->buckets, sizeof(uint32_t));
+
+    const unsigned mask = cache->buckets - 1;
+    for (unsigned i=0; i < cache->count; ++i) {
+        unsigned b = hash_node(cache->nodes[i]) & mask;
+        while (cache->table[b])     b = (b + 1) & mask;
+        cache->table[b] = i + 1;
+    }
+}
+
+
 _STATIC_
 Node* get_cached_node(NodeCache* const cache, Node* const n)
 {
     if (n == NULL)  return NULL;
 
-    // Special case for constants: search through the constants
-    // list for any that match the target node's value.
-    if (n->flags & NODE_CONSTANT) {
-        NodeList** next = &(cache->constants);
-        while (*next) {
-            if ((**next).node->results.f == n->results.f) {
-                // Only free this node if it isn't the same as the match
-                if (n != (**next).node) free(n);
-                return (**next).node;
-            }
-            next = &(**next).next;
+    // Keep the hash table at most half full
+    if (2*(cache->count + 1) > cache->buckets)  grow_table(cache);
+
+    // Probe the hash table for a matching node
+    const unsigned mask = cache->buckets - 1;
+    unsigned b = hash_node(n) & mask;
+    while (cache->table[b]) {
+        Node* const m = cache->nodes[cache->table[b] - 1];
+        if (nodes_equal(m, n)) {
+            // Only free this node if it isn't the same as the match
+            if (n != m)     free(n);
+            return m;
         }
-        // If we didn't find it, then allocate a new node at the
-        // end of the linked list and return it.
-        *next  = malloc(sizeof(NodeList));
-        **next = (NodeList){ .node=n, .next=NULL };
-        return n;
+        b = (b + 1) & mask;
     }
 
-    // Expand the cache if we don't have enough slots
-    if (n->rank >= cache->levels) {
-        cache->nodes = realloc(cache->nodes, (n->rank+1)*sizeof(NodeList*)*LAST_OP);
-        for (int i=cache->levels; i <= n->rank; ++i) {
-            for (int o=0; o < LAST_OP; ++o) {
-                cache->nodes[i][o] = NULL;
-            }
-        }
-        cache->levels = n->rank + 1;
+    // If we didn't find it, then add it to the cache
+    if (cache->count == cache->size) {
+        cache->size = cache->size ? cache->size*2 : 256;
+        cache->nodes = realloc(cache->nodes, cache->size*sizeof(Node*));
     }
+    cache->nodes[cache->count++] = n;
+    cache->table[b] = cache->count;
 
-    // Fly through the linked list, comparing child pointers
-    NodeList** next = &(cache->nodes[n->rank][n->opcode]);
-    while (*next) {
-        // If we've found a match, free the target and return the match
-        if ((**next).node->lhs == n->lhs && (**next).node->rhs == n->rhs) {
-
-            // Only free this node if it isn't the same as the match.
-            if (n != (**next).node) free(n);
-            return (**next).node;
-        }
-        next = &(**next).next;
+    if (!(n->flags & NODE_CONSTANT) && n->rank >= cache->levels) {
+        cache->levels = n->rank + 1;
     }
-    // If we've made it to the end of the list, then extend the list
-    // with the provided node.
-    *next  = malloc(sizeof(NodeList));
-    **next = (NodeList){ .node=n, .next=NULL };
 
     return n;
 }
@@ -371,71 +624,43 @@ Node* get_cached_node(NodeCache* const cache, Node* const n)
 _STATIC_
 MathTree* cache_to_tree(NodeCache* c)
 {
-    // Count the number of constants in the tree
+    // Count the constants and nodes (by level and opcode) in the tree
     unsigned num_constants = 0;
-    NodeList* next = c->constants;
-    NodeList* prev;
-    while (next) {
-        if (next->node->flags & NODE_IN_TREE) {
-            ++num_constants;
-        }
-        next = next->next;
+    unsigned (*counts)[LAST_OP] = calloc(c->levels ? c->levels : 1,
+                                         sizeof(*counts));
+    for (unsigned i=0; i < c->count; ++i) {
+        const Node* n = c->nodes[i];
+        if (!(n->flags & NODE_IN_TREE))     continue;
+        if (n->flags & NODE_CONSTANT)       ++num_constants;
+        else                                ++counts[n->rank][n->opcode];
     }
 
     // Create the tree
     MathTree* const tree = new_tree(c->levels, num_constants);
-
-    // Copy over the constant nodes
-    next = c->constants;
-    num_constants = 0;
-    while (next) {
-        if (next->node->flags & NODE_IN_TREE) {
-            tree->constants[num_constants++] = next->node;
-        } else {
-            free(next->node);
-        }
-        prev = next;
-        next = next->next;
-        free(prev);
-    }
-    c->constants = NULL;
-
     for (int level=0; level < c->levels; level++) {
         for (int op=0; op < LAST_OP; ++op) {
-
-            if (!c->nodes[level][op]) continue;
-
-            // Count the number of nodes in this row
-            unsigned count = 0;
-            next = c->nodes[level][op];
-            while (next) {
-                if (next->node->flags & NODE_IN_TREE) {
-                    ++count;
-                }
-                next = next->next;
+            if (counts[level][op]) {
+                tree->nodes[level][op] = malloc(counts[level][op]*sizeof(Node*));
             }
+        }
+    }
+    free(counts);
 
-            // Allocate space in the tree for these nodes
-            tree->nodes[level][op] = malloc(count*sizeof(Node*));
-
-            // Iterate and copy node pointers over, freeing the
-            // linked list behind us as we go
-            next = c->nodes[level][op];
-            while (next) {
-                if (next->node->flags & NODE_IN_TREE) {
-                    int index = tree->active[level][op]++;
-                    tree->nodes[level][op][index] = next->node;
-                } else {
-                    free(next->node);
-                }
-
-                prev = next;
-                next = next->next;
-                free(prev);
-            }
-            c->nodes[level][op] = NULL;
+    // Copy over nodes (in the order that they were cached), freeing
+    // any nodes that didn't end up in the tree.
+    num_constants = 0;
+    for (unsigned i=0; i < c->count; ++i) {
+        Node* n = c->nodes[i];
+        if (!(n->flags & NODE_IN_TREE)) {
+            free(n);
+        } else if (n->flags & NODE_CONSTANT) {
+            tree->constants[num_constants++] = n;
+        } else {
+            const int index = tree->active[n->rank][n->opcode]++;
+            tree->nodes[n->rank][n->opcode][index] = n;
         }
     }
+    c->count = 0;
 
     return tree;
 }
@@ -444,29 +669,9 @@ MathTree* cache_to_tree(NodeCache* c)
 _STATIC_
 void free_node_cache(NodeCache* const c)
 {
-    // Free the linked list of constants
-    NodeList* next = c->constants;
-    NodeList* prev;
-    while (next) {
-        free(next->node);
-        prev = next;
-        next = next->next;
-        free(prev);
-    }
-
-    // Free the linked lists of nodes
-    for (int level=0; level < c->levels; level++) {
-        for (int op=0; op < LAST_OP; ++op) {
-            next = c->nodes[level][op];
-            while (next) {
-                free(next->node);
-                prev = next;
-                next = next->next;
-                free(prev);
-            }
-        }
-    }
+    for (unsigned i=0; i < c->count; ++i)   free(c->nodes[i]);
 
     free(c->nodes);
+    free(c->table);
     free(c);
 }
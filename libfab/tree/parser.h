@@ -2,6 +2,8 @@
 #define PARSER_H
 
 struct MathTree_;
+struct Node_;
+struct NodeCache_;
 
 /** @brief Parses a prefix-notation math string
     @param input A null-terminated math string
@@ -9,4 +11,53 @@ struct MathTree_;
 */
 struct MathTree_* parse(const char* input);
 
+/** @brief Parses a prefix-notation math string
+    @param input A null-terminated math string
+    @param simplify If true, identity operations are removed while parsing
+    @returns The constructed MathTree, or NULL if failed
+*/
+struct MathTree_* parse_tree(const char* input, _Bool simplify);
+
+/** @brief Creates a builder, which constructs a tree one node at a time
+    @details Nodes are deduplicated (and simplified, if requested) as they
+    are added.  The builder must be passed to builder_finish or free_builder.
+    @param simplify If true, identity operations are removed as nodes are added
+    @returns A new builder, containing X, Y, and Z nodes
+*/
+struct NodeCache_* make_builder(_Bool simplify);
+
+/** @brief Parses a prefix-notation math string into a builder
+    @param builder Target builder
+    @param input A null-terminated math string
+    @param X Node substituted for X (or NULL to use the builder's X node)
+    @param Y Node substituted for Y (or NULL to use the builder's Y node)
+    @param Z Node substituted for Z (or NULL to use the builder's Z node)
+    @returns The parsed expression's node, or NULL if failed
+*/
+struct Node_* builder_parse(struct NodeCache_* builder, const char* input,
+                            struct Node_* X, struct Node_* Y, struct Node_* Z);
+
+/** @brief Adds an operation to a builder
+    @param builder Target builder
+    @param op Operation character (as used in math strings)
+    @param lhs Left-hand argument (from the same builder)
+    @param rhs Right-hand argument (ignored for unary operations)
+    @returns The operation's node, or NULL if failed
+*/
+struct Node_* builder_op(struct NodeCache_* builder, char op,
+                         struct Node_* lhs, struct Node_* rhs);
+
+/** @brief Packs a builder's nodes into a MathTree
+    @details Nodes that aren't used by the head are freed, as is the builder.
+    @param builder Target builder
+    @param head Root of the tree (from the same builder)
+    @returns The constructed MathTree
+*/
+struct MathTree_* builder_finish(struct NodeCache_* builder,
+                                 struct Node_* head);
+
+/** @brief Frees a builder and all of its nodes
+*/
+void free_builder(struct NodeCache_* builder);
+
 #endif
@@ -9,6 +9,33 @@
 #include "tree/render.h"
 
 #include "util/switches.h"
+#include "util/taskpool.h"
+
+/*  TASK_PIXELS
+ *
+ *  Regions with at least this many pixels (in x and y) are handed off to
+ *  the task pool when subdivided by render16_parallel.
+ */
+#define TASK_PIXELS 4096
+
+/*  Target
+ *
+ *  Height-map filled in by render_r: either a 16-bit image (storing
+ *  region.L levels) or a floating-point image (storing Z values times
+ *  scale, with NaN for empty pixels).
+ */
+typedef struct Target_ {
+    void* img;
+    _Bool f;
+    double scale;
+} Target;
+
+/* Data shared by every task in a render16_parallel or renderf_parallel call */
+typedef struct RenderJob_ {
+    PackedTree** trees;
+    Target target;
+    volatile int* halt;
+} RenderJob;
 
 /*  region8
  *
@@ -20,7 +47,29 @@
 _STATIC_
 void region8(PackedTree* tree, Region region, uint8_t** img);
 
-/*  region16
+/*  level
+ *
+ *  Returns the height stored for the top of voxel layer k of a region.
+ */
+_STATIC_
+float level(const Target* t, const Region* region, int k);
+
+/*  below
+ *
+ *  Returns true if a pixel is lower than the given height
+ *  (including empty pixels in floating-point images).
+ */
+_STATIC_
+_Bool below(const Target* t, int row, int col, float h);
+
+/*  raise_pixel
+ *
+ *  Stores a height in a pixel if it's lower than that height.
+ */
+_STATIC_
+void raise_pixel(const Target* t, int row, int col, float h);
+
+/*  region_r
  *
  *  Renders a tree pixel-by-pixel into a given region,
  *  using the eval_r function to find an array of results in
@@ -28,7 +77,24 @@ void region8(PackedTree* tree, Region region, uint8_t** img);
  *
  */
 _STATIC_
-void region16(PackedTree* tree, Region region, uint16_t** img);
+void region_r(PackedTree* tree, Region region, const Target* t);
+
+/*  render_r
+ *
+ *  Recursive body of render16 and renderf_parallel.  If pool is provided,
+ *  one half of each large region that's split along x or y is pushed to the
+ *  pool (so that it can be stolen by another worker thread).
+ */
+_STATIC_
+void render_r(PackedTree* tree, Region region, const Target* t,
+              volatile int* halt, TaskPool* pool, unsigned worker);
+
+/*  render_task
+ *
+ *  Renders a single region from the task pool with the worker's tree.
+ */
+_STATIC_
+void render_task(TaskPool* pool, unsigned worker, void* task, void* data);
 
 ////////////////////////////////////////////////////////////////////////////////
 void render8(PackedTree* tree, Region region,
@@ -38,8 +104,9 @@ void render8(PackedTree* tree, Region region,
     if (*halt)  return;
 
     // Render pixel-by-pixel if we're below a certain size.
-    if (region.voxels > 0 && region.voxels < MIN_VOLUME) {
+    if (region.voxels > 0 && region.voxels < tree->block) {
         region8(tree, region, img);
+        STAT(tree, blocks, 1);
         return;
     }
 
@@ -56,13 +123,16 @@ void render8(PackedTree* tree, Region region,
             }
         }
     }
-    if (cull) return;
+    if (cull) {
+        STAT(tree, culled, 1);
+        return;
+    }
 
     Interval X = {region.X[0], region.X[region.ni]},
              Y = {region.Y[0], region.Y[region.nj]},
              Z = {region.Z[0], region.Z[region.nk]};
 
-    Interval result = eval_i(tree, X, Y, Z);
+    Interval result = eval_bounds(tree, X, Y, Z);
 
     // If we're inside the object, fill with color.
     if (result.upper < 0) {
@@ -154,41 +224,121 @@ void render16(PackedTree* tree, Region region,
               uint16_t** img, volatile int* halt)
 {
     if (tree == NULL)  return;
+    const Target t = { .img=img, .f=false, .scale=1 };
+    render_r(tree, region, &t, halt, NULL, 0);
+}
+
+
+void render16_parallel(PackedTree** trees, unsigned threads, Region region,
+                       uint16_t** img, volatile int* halt, double* busy)
+{
+    if (trees == NULL || threads == 0)  return;
+    for (unsigned t=0; t < threads; ++t)    if (trees[t] == NULL) return;
+
+    RenderJob job = {
+        .trees=trees, .target={ .img=img, .f=false, .scale=1 }, .halt=halt
+    };
+    run_taskpool(threads, sizeof(Region), &region,
+                 render_task, &job, busy);
+}
+
+
+void renderf_parallel(PackedTree** trees, unsigned threads, Region region,
+                      double scale, float** img, volatile int* halt,
+                      double* busy)
+{
+    if (trees == NULL || threads == 0)  return;
+    for (unsigned t=0; t < threads; ++t)    if (trees[t] == NULL) return;
+
+    RenderJob job = {
+        .trees=trees, .target={ .img=img, .f=true, .scale=scale }, .halt=halt
+    };
+    run_taskpool(threads, sizeof(Region), &region,
+                 render_task, &job, busy);
+}
+
 
+_STATIC_
+void render_task(TaskPool* pool, unsigned worker, void* task, void* data)
+{
+    RenderJob* const job = data;
+    render_r(job->trees[worker], *(Region*)task,
+             &job->target, job->halt, pool, worker);
+}
+
+////////////////////////////////////////////////////////////////////////////////
+
+_STATIC_
+float level(const Target* t, const Region* region, int k)
+{
+    if (t->f)   return region->Z[k] * t->scale;
+    else        return region->L[k];
+}
+
+
+_STATIC_
+_Bool below(const Target* t, int row, int col, float h)
+{
+    // Empty pixels in floating-point images are NaN, so that comparison
+    // is written such that it's true for NaN pixels.
+    if (t->f)   return !(((float**)t->img)[row][col] >= h);
+    else        return ((uint16_t**)t->img)[row][col] < h;
+}
+
+
+_STATIC_
+void raise_pixel(const Target* t, int row, int col, float h)
+{
+    if (!below(t, row, col, h))     return;
+
+    if (t->f)   ((float**)t->img)[row][col] = h;
+    else        ((uint16_t**)t->img)[row][col] = h;
+}
+
+////////////////////////////////////////////////////////////////////////////////
+
+_STATIC_
+void render_r(PackedTree* tree, Region region, const Target* t,
+              volatile int* halt, TaskPool* pool, unsigned worker)
+{
     // Special interrupt system, set asynchronously by on high
     if (*halt)  return;
 
     // Render pixel-by-pixel if we're below a certain size.
-    if (region.voxels > 0 && region.voxels < MIN_VOLUME) {
-        region16(tree, region, img);
+    if (region.voxels > 0 && region.voxels < tree->block) {
+        region_r(tree, region, t);
+        STAT(tree, blocks, 1);
         return;
     }
 
     // Pre-emptively halt evaluation if all the points in this
     // region are already light.
-    uint16_t L = region.L[region.nk];
+    const float L = level(t, &region, region.nk);
     bool cull = true;
     for (int row = region.jmin; cull && row < region.jmin + region.nj; ++row) {
         for (int col = region.imin; cull && col < region.imin + region.ni; ++col) {
-            if (L > img[row][col]) {
+            if (below(t, row, col, L)) {
                 cull = false;
                 break;
             }
         }
     }
-    if (cull) return;
+    if (cull) {
+        STAT(tree, culled, 1);
+        return;
+    }
 
     Interval X = {region.X[0], region.X[region.ni]},
              Y = {region.Y[0], region.Y[region.nj]},
              Z = {region.Z[0], region.Z[region.nk]};
 
-    Interval result = eval_i(tree, X, Y, Z);
+    Interval result = eval_bounds(tree, X, Y, Z);
 
     // If we're inside the object, fill with color.
     if (result.upper < 0) {
         for (int row = region.jmin; row < region.jmin + region.nj; ++row) {
             for (int col = region.imin; col < region.imin + region.ni; ++col) {
-                if (L > img[row][col])  img[row][col] = L;
+                raise_pixel(t, row, col, L);
             }
         }
     }
@@ -206,8 +356,25 @@ void render16(PackedTree* tree, Region region,
         Region A, B;
         bisect(region, &A, &B);
 
-        render16(tree, B, img, halt);
-        render16(tree, A, img, halt);
+        // If the halves cover different pixels, then another thread can
+        // safely render one of them; hand it off to the task pool.
+        // (It'll be evaluated from scratch, without this branch's pruning).
+        if (A.ni != region.ni || A.nj != region.nj) {
+            if (pool && region.ni*region.nj >= TASK_PIXELS) {
+                taskpool_push(pool, worker, &A);
+                render_r(tree, B, t, halt, pool, worker);
+            } else {
+                render_r(tree, B, t, halt, pool, worker);
+                render_r(tree, A, t, halt, pool, worker);
+            }
+        }
+
+        // Otherwise, nothing under the upper half may be handed off, since
+        // the lower half (which covers the same pixels) is still to come.
+        else {
+            render_r(tree, B, t, halt, NULL, worker);
+            render_r(tree, A, t, halt, pool, worker);
+        }
     }
 
 #if PRUNE
@@ -219,7 +386,7 @@ void render16(PackedTree* tree, Region region,
 ////////////////////////////////////////////////////////////////////////////////
 
 _STATIC_
-void region16(PackedTree* tree, Region region, uint16_t** img)
+void region_r(PackedTree* tree, Region region, const Target* t)
 {
     float *X = malloc(region.voxels*sizeof(float)),
           *Y = malloc(region.voxels*sizeof(float)),
@@ -237,6 +404,9 @@ void region16(PackedTree* tree, Region region, uint16_t** img)
             }
         }
     }
+
+    // Keep the original region around to look up heights
+    const Region original = region;
     region.X = X;
     region.Y = Y;
     region.Z = Z;
@@ -249,7 +419,7 @@ void region16(PackedTree* tree, Region region, uint16_t** img)
     free(Z);
 
     for (int k = region.nk - 1; k >= 0; --k) {
-        uint16_t L = region.L[k+1];
+        const float L = level(t, &original, k+1);
 
         for (int j = 0; j < region.nj; ++j) {
             int row = j + region.jmin;
@@ -257,9 +427,7 @@ void region16(PackedTree* tree, Region region, uint16_t** img)
             for (int i = 0; i < region.ni; ++i) {
                 int col = i + region.imin;
 
-               if (*(result++) < 0 && img[row][col] < L) {
-                    img[row][col] = L;
-                }
+                if (*(result++) < 0)    raise_pixel(t, row, col, L);
             }
         }
     }
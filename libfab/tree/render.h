@@ -28,4 +28,38 @@ void render16(struct PackedTree_* tree, Region region,
              uint16_t** img, volatile int* halt);
 
 
+/** @brief Renders a tree with a pool of worker threads
+    @details Regions from the recursive subdivision are shared between
+    threads with a work-stealing scheduler, so the load stays balanced
+    even if the detail is concentrated in one part of the image.
+    @param trees Array of packed trees (one per thread, all representing
+    the same expression)
+    @param threads Number of threads
+    @param region Region to render (ni, nj must be image dimensions)
+    @param img Target image to populate
+    @param halt Flag to abort (if *halt becomes true)
+    @param busy Array filled with each thread's busy time (in seconds), or NULL
+*/
+void render16_parallel(struct PackedTree_** trees, unsigned threads,
+                       Region region, uint16_t** img, volatile int* halt,
+                       double* busy);
+
+
+/** @brief Renders a tree into a floating-point height-map
+    @details Works like render16_parallel, but stores the top Z value of
+    each filled pixel (multiplied by scale) rather than a 16-bit level.
+    Pixels must be initialized to NaN (or to a height below the region).
+    @param trees Array of packed trees (one per thread)
+    @param threads Number of threads
+    @param region Region to render (ni, nj must be image dimensions)
+    @param scale Scale factor applied to stored heights (e.g. mm per unit)
+    @param img Target image to populate
+    @param halt Flag to abort (if *halt becomes true)
+    @param busy Array filled with each thread's busy time (in seconds), or NULL
+*/
+void renderf_parallel(struct PackedTree_** trees, unsigned threads,
+                      Region region, double scale, float** img,
+                      volatile int* halt, double* busy);
+
+
 #endif
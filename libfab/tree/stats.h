@@ -0,0 +1,87 @@
+#ifndef TREE_STATS_H
+#define TREE_STATS_H
+
+#include <stdint.h>
+
+#include "tree/node/opcodes.h"
+
+/** @struct Stats_
+    @brief Profiling counters recorded while a PackedTree is evaluated
+    @details Counting is compiled in, but only runs when a Stats structure
+    is attached to a tree with set_stats (so disabled counters cost one
+    branch per call).  Threads should each attach their own structure.
+*/
+typedef struct Stats_ {
+    /** @var interval
+    Number of calls to eval_i */
+    uint64_t interval;
+
+    /** @var affine
+    Number of calls to eval_a */
+    uint64_t affine;
+
+    /** @var point
+    Number of calls to eval_f */
+    uint64_t point;
+
+    /** @var gradient
+    Number of calls to eval_g */
+    uint64_t gradient;
+
+    /** @var array
+    Number of calls to eval_r */
+    uint64_t array;
+
+    /** @var voxels
+    Number of points evaluated by eval_r */
+    uint64_t voxels;
+
+    /** @var prunes
+    Number of calls to disable_nodes */
+    uint64_t prunes;
+
+    /** @var disabled
+    Number of clauses disabled by disable_nodes and disable_nodes_binary */
+    uint64_t disabled;
+
+    /** @var regions
+    Number of regions (or ASDF cells) checked with eval_bounds */
+    uint64_t regions;
+
+    /** @var culled
+    Number of regions skipped because their pixels were already filled */
+    uint64_t culled;
+
+    /** @var filled
+    Number of regions found to be entirely filled */
+    uint64_t filled;
+
+    /** @var empty
+    Number of regions found to be entirely empty */
+    uint64_t empty;
+
+    /** @var blocks
+    Number of regions evaluated voxel-by-voxel with eval_r */
+    uint64_t blocks;
+
+    /** @var cells
+    Number of ASDF cells made by build_asdf */
+    uint64_t cells;
+
+    /** @var cached
+    Number of ASDF samples found in the corner cache (rather than evaluated) */
+    uint64_t cached;
+
+    /** @var opcodes
+    Number of clause evaluations, indexed by opcode (eval_r counts
+    one evaluation per point) */
+    uint64_t opcodes[LAST_OP];
+} Stats;
+
+
+/** @brief Adds n to one of a tree's counters (if counting is enabled)
+*/
+#define STAT(tree, field, n) \
+    do { if ((tree)->stats) (tree)->stats->field += (n); } while (0)
+
+#endif
@@ -0,0 +1,292 @@
+#include <stdlib.h>
+#include <stdbool.h>
+#include <math.h>
+
+#include "tree/trace.h"
+#include "tree/eval.h"
+#include "tree/packed.h"
+
+#include "util/switches.h"
+#include "util/taskpool.h"
+#include "util/vec3f.h"
+
+/*  TASK_PIXELS
+ *
+ *  Regions with at least this many pixels (in x and y) are handed off to
+ *  the task pool when subdivided by trace_shaded_parallel.
+ */
+#define TASK_PIXELS 4096
+
+/* Images and settings shared by every task in a trace */
+typedef struct TraceJob_ {
+    PackedTree** trees;
+    const float* M;
+    uint16_t** depth;
+    uint16_t** shaded;
+    uint8_t (**normals)[3];
+    volatile int* halt;
+} TraceJob;
+
+////////////////////////////////////////////////////////////////////////////////
+// Forward declarations of _STATIC_ functions
+
+/*  trace_r
+ *
+ *  Recursive body of trace_shaded and trace_shaded_parallel.  If pool is
+ *  provided, one half of each large region that's split along x or y is
+ *  pushed to the pool (so that it can be stolen by another worker thread).
+ */
+_STATIC_
+void trace_r(PackedTree* tree, Region region, const TraceJob* job,
+             TaskPool* pool, unsigned worker);
+
+/*  trace_task
+ *
+ *  Traces a single region from the task pool with the worker's tree.
+ */
+_STATIC_
+void trace_task(TaskPool* pool, unsigned worker, void* task, void* data);
+
+/*  trace_leaf
+ *
+ *  Samples every voxel in a small region, raising the depth of each pixel
+ *  to its highest filled voxel (and shading pixels that are raised).
+ */
+_STATIC_
+void trace_leaf(PackedTree* tree, const Region r, const float M[4],
+                uint16_t** depth, uint16_t** shaded, uint8_t (**normals)[3]);
+
+
+/*  shade_pixel
+ *
+ *  Finds the tree's gradient at a point (in the cell frame), then stores
+ *  a shade and colored normal for the given pixel.
+ */
+_STATIC_
+void shade_pixel(PackedTree* tree, const Vec3f p, const float M[4],
+                 const int row, const int col,
+                 uint16_t** shaded, uint8_t (**normals)[3]);
+
+// End of forward declarations
+////////////////////////////////////////////////////////////////////////////////
+
+void trace_shaded(PackedTree* tree, Region region, const float M[4],
+                  uint16_t** depth, uint16_t** shaded,
+                  uint8_t (**normals)[3], volatile int* halt)
+{
+    if (tree == NULL)   return;
+
+    const TraceJob job = {
+        .trees=&tree, .M=M, .depth=depth, .shaded=shaded,
+        .normals=normals, .halt=halt
+    };
+    trace_r(tree, region, &job, NULL, 0);
+}
+
+
+void trace_shaded_parallel(PackedTree** trees, unsigned threads,
+                           Region region, const float M[4],
+                           uint16_t** depth, uint16_t** shaded,
+                           uint8_t (**normals)[3], volatile int* halt,
+                           double* busy)
+{
+    if (trees == NULL || threads == 0)  return;
+    for (unsigned t=0; t < threads; ++t)    if (trees[t] == NULL) return;
+
+    TraceJob job = {
+        .trees=trees, .M=M, .depth=depth, .shaded=shaded,
+        .normals=normals, .halt=halt
+    };
+    run_taskpool(threads, sizeof(Region), &region,
+                 trace_task, &job, busy);
+}
+
+
+_STATIC_
+void trace_task(TaskPool* pool, unsigned worker, void* task, void* data)
+{
+    TraceJob* const job = data;
+    trace_r(job->trees[worker], *(Region*)task, job, pool, worker);
+}
+
+////////////////////////////////////////////////////////////////////////////////
+
+_STATIC_
+void trace_r(PackedTree* tree, Region region, const TraceJob* job,
+             TaskPool* pool, unsigned worker)
+{
+    const float* const M = job->M;
+    uint16_t** const depth = job->depth;
+    uint16_t** const shaded = job->shaded;
+    uint8_t (** const normals)[3] = job->normals;
+
+    if (*job->halt)     return;
+
+    // Sample voxel-by-voxel if we're below a certain size.
+    if (region.voxels > 0 && region.voxels < tree->block) {
+        trace_leaf(tree, region, M, depth, shaded, normals);
+        return;
+    }
+
+    // Pre-emptively halt evaluation if all the points in this
+    // region are already light.
+    const uint16_t L = region.L[region.nk];
+    bool cull = true;
+    for (int row = region.jmin; cull && row < region.jmin + region.nj; ++row) {
+        for (int col = region.imin; cull && col < region.imin + region.ni; ++col) {
+            if (L > depth[row][col])    cull = false;
+        }
+    }
+    if (cull)   return;
+
+    // Find the bounds of this (rotated) box in the cell frame
+    Interval X, Y, Z;
+    deproject_cube((Interval){region.X[0], region.X[region.ni]},
+                   (Interval){region.Y[0], region.Y[region.nj]},
+                   (Interval){region.Z[0], region.Z[region.nk]},
+                   &X, &Y, &Z, M);
+
+    const Interval result = eval_bounds(tree, X, Y, Z);
+
+    // If we're inside the object, then the surface is at the top of this
+    // box (since boxes above it were traced first).
+    if (result.upper < 0) {
+        for (int j = 0; j < region.nj; ++j) {
+            const int row = region.jmin + j;
+            for (int i = 0; i < region.ni; ++i) {
+                const int col = region.imin + i;
+                if (L <= depth[row][col])   continue;
+
+                depth[row][col] = L;
+                shade_pixel(tree, deproject((Vec3f){region.X[i], region.Y[j],
+                                                    region.Z[region.nk]}, M),
+                            M, row, col, shaded, normals);
+            }
+        }
+    }
+
+    // In unambiguous cases, return immediately
+    if (result.upper < 0 || result.lower >= 0)  return;
+
+#if PRUNE
+    disable_nodes(tree);
+    disable_nodes_binary(tree);
+#endif
+
+    // Subdivide and recurse, tracing the upper half first
+    if (region.ni*region.nj*region.nk > 1) {
+        Region A, B;
+        bisect(region, &A, &B);
+
+        // If the halves cover different pixels, then another thread can
+        // safely trace one of them; hand it off to the task pool.
+        // (It'll be evaluated from scratch, without this branch's pruning).
+        if (A.ni != region.ni || A.nj != region.nj) {
+            if (pool && region.ni*region.nj >= TASK_PIXELS) {
+                taskpool_push(pool, worker, &A);
+                trace_r(tree, B, job, pool, worker);
+            } else {
+                trace_r(tree, B, job, pool, worker);
+                trace_r(tree, A, job, pool, worker);
+            }
+        }
+
+        // Otherwise, nothing under the upper half may be handed off, since
+        // the lower half (which covers the same pixels) is still to come.
+        else {
+            trace_r(tree, B, job, NULL, worker);
+            trace_r(tree, A, job, pool, worker);
+        }
+    }
+
+#if PRUNE
+    enable_nodes(tree);
+#endif
+}
+
+////////////////////////////////////////////////////////////////////////////////
+
+_STATIC_
+void trace_leaf(PackedTree* tree, const Region r, const float M[4],
+                uint16_t** depth, uint16_t** shaded, uint8_t (**normals)[3])
+{
+    float *X = malloc(r.voxels*sizeof(float)),
+          *Y = malloc(r.voxels*sizeof(float)),
+          *Z = malloc(r.voxels*sizeof(float));
+
+    // Find every voxel's position in the cell frame, in the same
+    // (top-down) order as region16.
+    int q = 0;
+    for (int k = r.nk - 1; k >= 0; --k) {
+        for (int j = 0; j < r.nj; ++j) {
+            for (int i = 0; i < r.ni; ++i) {
+                const Vec3f p = deproject((Vec3f){r.X[i], r.Y[j], r.Z[k]}, M);
+                X[q] = p.x;
+                Y[q] = p.y;
+                Z[q] = p.z;
+                q++;
+            }
+        }
+    }
+
+    Region flat = r;
+    flat.X = X;
+    flat.Y = Y;
+    flat.Z = Z;
+    const float* const result = eval_r(tree, flat);
+
+    // Find the highest filled voxel in each pixel
+    for (int j = 0; j < r.nj; ++j) {
+        const int row = r.jmin + j;
+        for (int i = 0; i < r.ni; ++i) {
+            const int col = r.imin + i;
+
+            for (int k = r.nk - 1; k >= 0; --k) {
+                const uint16_t L = r.L[k+1];
+                if (L <= depth[row][col])   break;
+
+                q = ((r.nk - 1 - k)*r.nj + j)*r.ni + i;
+                if (result[q] < 0) {
+                    depth[row][col] = L;
+                    shade_pixel(tree, (Vec3f){X[q], Y[q], Z[q]},
+                                M, row, col, shaded, normals);
+                    break;
+                }
+            }
+        }
+    }
+
+    free(X);
+    free(Y);
+    free(Z);
+}
+
+////////////////////////////////////////////////////////////////////////////////
+
+_STATIC_
+void shade_pixel(PackedTree* tree, const Vec3f p, const float M[4],
+                 const int row, const int col,
+                 uint16_t** shaded, uint8_t (**normals)[3])
+{
+    const Deriv d = eval_g(tree, p.x, p.y, p.z);
+
+    // Points with no gradient are treated as facing the viewer
+    Vec3f normal = {0, 0, 1};
+    if (d.dx || d.dy || d.dz) {
+        normal = normalize(project((Vec3f){d.dx, d.dy, d.dz}, M));
+    }
+
+    // If this point has a front-facing normal, shade it.
+    if (normal.z >= 0) {
+        float xy = sqrt(pow(normal.x, 2) + pow(normal.y, 2));
+        float alpha = fabs(atan2(normal.z, xy) - M_PI_2);
+        shaded[row][col] = 65535 * sqrt(1 - alpha / M_PI_2);
+    } else {
+        shaded[row][col] = 0;
+    }
+
+    // And draw colors to show the normal
+    normals[row][col][0] = 255*(normal.x/2+0.5);
+    normals[row][col][1] = 255*(normal.y/2+0.5);
+    normals[row][col][2] = 255*(normal.z/2+0.5);
+}
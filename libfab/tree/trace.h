@@ -0,0 +1,50 @@
+#ifndef TRACE_H
+#define TRACE_H
+
+#include <stdint.h>
+
+#include "util/region.h"
+
+struct PackedTree_;
+
+/** @brief Renders a tree to a height-map image, shaded, and normals image
+    @details Rays are cast down the view's z axis.  Interval bounds on
+    boxes of the rotated region are used to skip empty space and to fill
+    solid space, so only boxes that contain the surface are subdivided
+    and sampled.  Normals come from the tree's gradient (with eval_g) at
+    each pixel's surface point, so no ASDF or mesh is needed.
+    @param tree Target tree
+    @param region Render region in the view frame (ni, nj must be image dimensions)
+    @param M Array of rotation parameters [cos(a), sin(a), cos(b), sin(b)]
+    @param depth Height-map lattice to populate
+    @param shaded Shaded image to populate with shaded render
+    @param normals RGB image to populate with colored normals
+    @param halt Flag to abort (if *halt becomes true)
+*/
+void trace_shaded(struct PackedTree_* tree, Region region, const float M[4],
+                  uint16_t** depth, uint16_t** shaded,
+                  uint8_t (**normals)[3], volatile int* halt);
+
+
+/** @brief Traces a tree with a pool of worker threads
+    @details Works like trace_shaded, but regions from the recursive
+    subdivision are shared between threads with a work-stealing scheduler
+    (as in render16_parallel).
+    @param trees Array of packed trees (one per thread, all representing
+    the same expression)
+    @param threads Number of threads
+    @param region Render region in the view frame (ni, nj must be image dimensions)
+    @param M Array of rotation parameters [cos(a), sin(a), cos(b), sin(b)]
+    @param depth Height-map lattice to populate
+    @param shaded Shaded image to populate with shaded render
+    @param normals RGB image to populate with colored normals
+    @param halt Flag to abort (if *halt becomes true)
+    @param busy Array filled with each thread's busy time (in seconds), or NULL
+*/
+void trace_shaded_parallel(struct PackedTree_** trees, unsigned threads,
+                           Region region, const float M[4],
+                           uint16_t** depth, uint16_t** shaded,
+                           uint8_t (**normals)[3], volatile int* halt,
+                           double* busy);
+
+#endif
@@ -0,0 +1,19 @@
+#ifndef AFFINE_H
+#define AFFINE_H
+
+/*  Affine (struct)
+ *
+ *  Affine form used to hold a range that is correlated with the X, Y, and Z
+ *  input ranges:
+ *      center + dx*ex + dy*ey + dz*ez +/- err
+ *  where ex, ey, and ez are noise symbols in [-1, 1].
+ */
+typedef struct Affine_{
+    float center;
+    float dx;
+    float dy;
+    float dz;
+    float err;
+} Affine;
+
+#endif
@@ -0,0 +1,16 @@
+#ifndef DERIV_H
+#define DERIV_H
+
+/*  Deriv (struct)
+ *
+ *  Value and partial derivatives of a function at a single point,
+ *  used for forward-mode automatic differentiation.
+ */
+typedef struct Deriv_{
+    float v;
+    float dx;
+    float dy;
+    float dz;
+} Deriv;
+
+#endif
@@ -1,7 +1,7 @@
 #ifndef SWITCHES_H
 #define SWITCHES_H
 
-#define MIN_VOLUME  64      // Minimum volume for interval evaluation
+#define MIN_VOLUME  64      // Default minimum volume for interval evaluation
 #define DEDUPLICATE 1       // Remove duplicate nodes when combining MathTrees
 #define PRUNE       1       // Deactivate inactive tree branches
 
@@ -0,0 +1,333 @@
+#include <stdlib.h>
+#include <stdbool.h>
+#include <string.h>
+#include <stdint.h>
+#include <pthread.h>
+#include <time.h>
+
+#include "util/taskpool.h"
+
+/* A growable double-ended queue of fixed-size tasks */
+typedef struct Deque_ {
+    char* tasks;
+    unsigned head;  // Index of the oldest task
+    unsigned count; // Number of tasks stored
+    unsigned size;  // Allocated capacity (in tasks)
+} Deque;
+
+
+struct TaskPool_ {
+    pthread_mutex_t lock;
+    pthread_cond_t  wake;
+
+    unsigned workers;
+    size_t task_size;
+    Deque* deques;
+
+    /* Number of tasks that are either queued or running */
+    unsigned pending;
+
+    /* Number of helper threads still working on this pool
+     * (guarded by helper_lock rather than the pool's lock) */
+    unsigned helpers;
+
+    task_func run;
+    void* data;
+    double* busy;
+};
+
+
+/* Arguments passed to each worker thread */
+typedef struct Worker_ {
+    TaskPool* pool;
+    unsigned index;
+} Worker;
+
+
+/* A thread that's kept between calls to run_taskpool, waiting to be
+ * handed a worker's share of a pool */
+typedef struct Helper_ {
+    pthread_cond_t wake;
+    Worker* worker;         // Assigned worker (NULL while idle)
+    struct Helper_* next;   // Next idle helper
+} Helper;
+
+/* Lock guarding the helper threads (and each pool's helpers count) */
+static pthread_mutex_t helper_lock = PTHREAD_MUTEX_INITIALIZER;
+
+/* Condition variable signalled when a helper finishes its work */
+static pthread_cond_t helper_done = PTHREAD_COND_INITIALIZER;
+
+/* Stack of idle helper threads */
+static Helper* idle_helpers = NULL;
+
+static pthread_once_t helper_once = PTHREAD_ONCE_INIT;
+
+////////////////////////////////////////////////////////////////////////////////
+
+_STATIC_
+double now();
+
+_STATIC_
+_Bool take_task(TaskPool* const pool, const unsigned worker, void* const out);
+
+_STATIC_
+void* run_worker(void* args);
+
+_STATIC_
+void* run_helper(void* args);
+
+_STATIC_
+void start_helper(Worker* const worker);
+
+_STATIC_
+void init_helpers();
+
+_STATIC_
+void lock_helpers();
+
+_STATIC_
+void unlock_helpers();
+
+_STATIC_
+void reset_helpers();
+
+////////////////////////////////////////////////////////////////////////////////
+
+_STATIC_
+double now()
+{
+    struct timespec t;
+    clock_gettime(CLOCK_MONOTONIC, &t);
+    return t.tv_sec + t.tv_nsec * 1e-9;
+}
+
+
+/*  take_task
+ *
+ *  Takes a task from the back of the given worker's deque or (if it's empty)
+ *  the front of another worker's deque, copying it into out.
+ *  Returns false if every deque is empty.  The pool's lock must be held.
+ */
+_STATIC_
+_Bool take_task(TaskPool* const pool, const unsigned worker, void* const out)
+{
+    const size_t s = pool->task_size;
+
+    Deque* d = &pool->deques[worker];
+    if (d->count) {
+        d->count--;
+        memcpy(out, d->tasks + ((d->head + d->count) % d->size)*s, s);
+        return true;
+    }
+
+    for (unsigned i=1; i < pool->workers; ++i) {
+        d = &pool->deques[(worker + i) % pool->workers];
+        if (d->count) {
+            memcpy(out, d->tasks + d->head*s, s);
+            d->head = (d->head + 1) % d->size;
+            d->count--;
+            return true;
+        }
+    }
+
+    return false;
+}
+
+
+_STATIC_
+void* run_worker(void* args)
+{
+    TaskPool* const pool = ((Worker*)args)->pool;
+    const unsigned index = ((Worker*)args)->index;
+
+    void* task = malloc(pool->task_size);
+    double busy = 0;
+
+    pthread_mutex_lock(&pool->lock);
+    while (pool->pending) {
+        if (take_task(pool, index, task)) {
+            pthread_mutex_unlock(&pool->lock);
+
+            const double start = now();
+            pool->run(pool, index, task, pool->data);
+            busy += now() - start;
+
+            pthread_mutex_lock(&pool->lock);
+            if (--pool->pending == 0)   pthread_cond_broadcast(&pool->wake);
+        } else {
+            pthread_cond_wait(&pool->wake, &pool->lock);
+        }
+    }
+    pthread_mutex_unlock(&pool->lock);
+
+    if (pool->busy)     pool->busy[index] = busy;
+    free(task);
+
+    return NULL;
+}
+
+
+/*  run_helper
+ *
+ *  Body of a helper thread: waits to be handed a worker, runs it, then
+ *  puts itself back on the idle stack (forever).
+ */
+_STATIC_
+void* run_helper(void* args)
+{
+    Helper* const helper = (Helper*)args;
+
+    pthread_mutex_lock(&helper_lock);
+    while (true) {
+        while (!helper->worker) {
+            pthread_cond_wait(&helper->wake, &helper_lock);
+        }
+        Worker* const worker = helper->worker;
+        pthread_mutex_unlock(&helper_lock);
+
+        run_worker(worker);
+
+        // Once the count is decremented, the pool (which lives on the
+        // caller's stack) may be gone, so it can't be touched after this.
+        pthread_mutex_lock(&helper_lock);
+        worker->pool->helpers--;
+        helper->worker = NULL;
+        helper->next = idle_helpers;
+        idle_helpers = helper;
+        pthread_cond_broadcast(&helper_done);
+    }
+
+    return NULL;
+}
+
+
+/*  start_helper
+ *
+ *  Hands a worker to an idle helper thread, starting a new helper if
+ *  none are idle.  helper_lock must be held.
+ */
+_STATIC_
+void start_helper(Worker* const worker)
+{
+    Helper* helper = idle_helpers;
+    if (helper) {
+        idle_helpers = helper->next;
+        helper->worker = worker;
+        pthread_cond_signal(&helper->wake);
+        return;
+    }
+
+    helper = malloc(sizeof(Helper));
+    *helper = (Helper){ .worker=worker, .next=NULL };
+    pthread_cond_init(&helper->wake, NULL);
+
+    pthread_attr_t attr;
+    pthread_attr_init(&attr);
+    pthread_attr_setdetachstate(&attr, PTHREAD_CREATE_DETACHED);
+
+    // If the thread can't be started, the pool runs with one fewer worker
+    // (which is safe, since workers only push tasks to their own deques)
+    pthread_t thread;
+    if (pthread_create(&thread, &attr, run_helper, helper)) {
+        worker->pool->helpers--;
+        pthread_cond_destroy(&helper->wake);
+        free(helper);
+    }
+    pthread_attr_destroy(&attr);
+}
+
+/*  Fork handlers: a child process gets none of the helper threads, so
+ *  it starts over with an empty idle stack (leaking the old helpers'
+ *  records) and a fresh lock.
+ */
+_STATIC_
+void lock_helpers()     { pthread_mutex_lock(&helper_lock); }
+
+_STATIC_
+void unlock_helpers()   { pthread_mutex_unlock(&helper_lock); }
+
+_STATIC_
+void reset_helpers()
+{
+    idle_helpers = NULL;
+    pthread_mutex_init(&helper_lock, NULL);
+    pthread_cond_init(&helper_done, NULL);
+}
+
+_STATIC_
+void init_helpers()
+{
+    pthread_atfork(lock_helpers, unlock_helpers, reset_helpers);
+}
+
+////////////////////////////////////////////////////////////////////////////////
+
+void taskpool_push(TaskPool* pool, unsigned worker, const void* task)
+{
+    const size_t s = pool->task_size;
+
+    pthread_mutex_lock(&pool->lock);
+
+    Deque* const d = &pool->deques[worker];
+
+    // Grow the deque if necessary, unwrapping its contents
+    if (d->count == d->size) {
+        const unsigned size = d->size ? d->size * 2 : 16;
+        char* tasks = malloc(size * s);
+        for (unsigned i=0; i < d->count; ++i) {
+            memcpy(tasks + i*s, d->tasks + ((d->head + i) % d->size)*s, s);
+        }
+        free(d->tasks);
+        *d = (Deque){ .tasks=tasks, .head=0, .count=d->count, .size=size };
+    }
+
+    memcpy(d->tasks + ((d->head + d->count) % d->size)*s, task, s);
+    d->count++;
+    pool->pending++;
+
+    pthread_cond_signal(&pool->wake);
+    pthread_mutex_unlock(&pool->lock);
+}
+
+
+void run_taskpool(unsigned workers, size_t task_size, const void* first,
+                  task_func run, void* data, double* busy)
+{
+    if (workers == 0)   workers = 1;
+
+    TaskPool pool = {
+        .workers=workers, .task_size=task_size,
+        .deques=calloc(workers, sizeof(Deque)),
+        .pending=0, .helpers=workers - 1,
+        .run=run, .data=data, .busy=busy,
+    };
+    pthread_mutex_init(&pool.lock, NULL);
+    pthread_cond_init(&pool.wake, NULL);
+
+    taskpool_push(&pool, 0, first);
+
+    Worker* args = malloc(workers * sizeof(Worker));
+    for (unsigned i=0; i < workers; ++i) {
+        args[i] = (Worker){ .pool=&pool, .index=i };
+    }
+
+    // The calling thread is the first worker; the rest are helpers
+    pthread_once(&helper_once, init_helpers);
+    pthread_mutex_lock(&helper_lock);
+    for (unsigned i=1; i < workers; ++i)    start_helper(&args[i]);
+    pthread_mutex_unlock(&helper_lock);
+
+    run_worker(&args[0]);
+
+    pthread_mutex_lock(&helper_lock);
+    while (pool.helpers)    pthread_cond_wait(&helper_done, &helper_lock);
+    pthread_mutex_unlock(&helper_lock);
+
+    for (unsigned i=0; i < workers; ++i)    free(pool.deques[i].tasks);
+    free(pool.deques);
+    free(args);
+
+    pthread_mutex_destroy(&pool.lock);
+    pthread_cond_destroy(&pool.wake);
+}
@@ -0,0 +1,50 @@
+#ifndef TASKPOOL_H
+#define TASKPOOL_H
+
+#include <stddef.h>
+
+/** @struct TaskPool_
+    @brief A pool of worker threads that share tasks by work-stealing
+    @details Each worker has its own deque of tasks.  Workers push and pop
+    tasks at the back of their own deque; when it's empty, they steal from
+    the front of another worker's deque (which holds that worker's oldest,
+    and usually largest, tasks).
+*/
+struct TaskPool_;
+typedef struct TaskPool_ TaskPool;
+
+/** @brief Function that runs a single task
+    @param pool Pool running the task (which may be used to push more tasks)
+    @param worker Index of the worker thread running the task
+    @param task Pointer to the task's data
+    @param data User data passed to run_taskpool
+*/
+typedef void (*task_func)(TaskPool* pool, unsigned worker,
+                          void* task, void* data);
+
+
+/** @brief Runs a set of tasks on a pool of worker threads
+    @details Blocks until every task (including tasks pushed by other tasks)
+    has been run.  The calling thread acts as the first worker; the others
+    are helper threads, which are kept between calls (and started as needed,
+    so concurrent calls each get their own helpers).
+    @param workers Number of worker threads
+    @param task_size Size of each task (in bytes)
+    @param first Initial task (copied into the first worker's deque)
+    @param run Function that runs a task
+    @param data User data passed to run
+    @param busy Array filled with each worker's busy time (in seconds), or NULL
+*/
+void run_taskpool(unsigned workers, size_t task_size, const void* first,
+                  task_func run, void* data, double* busy);
+
+
+/** @brief Adds a task to a worker's deque
+    @details Should only be called from within a task.
+    @param pool Target pool
+    @param worker Index of the worker thread pushing the task
+    @param task Pointer to the task's data (which is copied)
+*/
+void taskpool_push(TaskPool* pool, unsigned worker, const void* task);
+
+#endif
@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+""" Parse benchmark: times libfab's math string parser on the shapes
+    produced by .ko scripts (by default, everything in examples/).
+
+    Usage:  util/bench/parse.py [-n REPEAT] [-s SCALE] [FILE.ko ...]
+"""
+
+import argparse
+import glob
+import os
+import sys
+import time
+
+# Run from anywhere in the source tree (koko.c.libfab looks for libfab
+# relative to the running script, so pretend to be the kokopelli script)
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..'))
+sys.path.insert(0, ROOT)
+sys.argv[0] = os.path.join(ROOT, 'kokopelli')
+
+from koko.c.libfab import libfab
+import koko.batch
+
+
+def scaled(math, scale):
+    """ @brief Builds a larger math string by unioning shifted copies
+        @param math Math string of a shape
+        @param scale Number of copies
+    """
+    if scale <= 1:  return math
+    copies = ['m+Xf%d  ' % i + math for i in range(scale)]
+    out = copies[0]
+    for c in copies[1:]:    out = 'i' + out + c
+    return out
+
+
+def time_parse(math, repeat):
+    """ @brief Parses a math string several times
+        @returns (best time, node count)
+    """
+    best = None
+    for i in range(repeat):
+        start = time.time()
+        ptr = libfab.parse(math)
+        dt = time.time() - start
+        if not ptr:
+            raise ValueError('Failed to parse math string')
+        count = libfab.count_nodes(ptr)
+        libfab.free_tree(ptr)
+        best = dt if best is None else min(best, dt)
+    return best, count
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        description='Times math string parsing for .ko files.')
+    parser.add_argument('files', metavar='FILENAME', nargs='*',
+                        help='Design files (default: examples/*.ko)')
+    parser.add_argument('-n', '--repeat', type=int, default=3,
+                        help='Parses per shape (the best time is kept)')
+    parser.add_argument('-s', '--scale', type=int, default=1,
+                        help='Union this many shifted copies of each shape')
+    args = parser.parse_args(argv)
+
+    files = args.files or sorted(glob.glob(os.path.join(ROOT, 'examples', '*.ko')))
+
+    print '%-24s %10s %8s %10s %8s' % ('file', 'bytes', 'nodes', 'seconds', 'MB/s')
+    total_bytes = total_time = 0
+    for f in files:
+        cad, _ = koko.batch.run_script(open(f).read(), f)
+        size = nodes = 0
+        dt = 0
+        for s in cad.shapes:
+            math = scaled(s.math, args.scale)
+            t, n = time_parse(math, args.repeat)
+            size += len(math)
+            nodes += n
+            dt += t
+        total_bytes += size
+        total_time += dt
+        print '%-24s %10d %8d %10.4f %8.2f' % (
+            os.path.basename(f), size, nodes, dt, size / dt / 1e6 if dt else 0)
+
+    print '%-24s %10d %8s %10.4f %8.2f' % (
+        'total', total_bytes, '', total_time,
+        total_bytes / total_time / 1e6 if total_time else 0)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,263 @@
+#!/usr/bin/env python
+""" Benchmark suite: runs .ko scripts (by default, everything in examples/)
+    through parsing, rendering, ASDF construction, triangulation, contouring,
+    and file I/O, recording times, peak memory, and node / cell counts.
+
+    Each file is benchmarked in a fresh worker process, so that its peak
+    RSS isn't polluted by the files before it.  Results can be written to
+    JSON and compared against a stored baseline; the exit status is 1 if
+    any stage got slower (or used more memory) than the threshold allows.
+
+    Usage:  util/bench/suite.py [-o OUT.json] [-b BASELINE.json] [-t 0.2]
+                                [-r 2,5] [-a 2] [FILE.ko ...]
+
+    Flat designs are contoured from their lowest-resolution render
+    (through a distance transform, as for a 2D mill toolpath); designs
+    that are bounded in 3D are built into ASDFs and triangulated.
+"""
+
+import argparse
+import glob
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+# Run from anywhere in the source tree (koko.c.libfab looks for libfab
+# relative to the running script, so pretend to be the kokopelli script)
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..'))
+sys.path.insert(0, ROOT)
+sys.argv[0] = os.path.join(ROOT, 'kokopelli')
+
+from koko.c.libfab import libfab
+import koko.batch
+
+from koko.fab.asdf import ASDF
+from koko.fab.mesh import Mesh
+
+## @var FORMAT
+# Version number of the JSON results format
+FORMAT = 1
+
+## @var CONTOUR_DIAMETER
+# Tool diameter (in mm) used when contouring flat designs
+CONTOUR_DIAMETER = 0.4
+
+
+class Timer(object):
+    """ @class Timer
+        @brief Context manager that stores a stage's wall time in a dictionary
+    """
+    def __init__(self, stages, name):
+        self.stage = stages.setdefault(name, {'seconds': 0})
+    def __enter__(self):
+        self.start = time.time()
+        return self.stage
+    def __exit__(self, *args):
+        self.stage['seconds'] += time.time() - self.start
+
+
+def bench_file(args):
+    """ @brief Benchmarks a single .ko file
+        @param args (filename, render resolutions, ASDF resolution) tuple
+        @returns Dictionary of results
+    """
+    filename, resolutions, asdf_resolution = args
+    stages = {}
+    tmp = tempfile.mkdtemp(prefix='koko-bench-')
+
+    try:
+        with Timer(stages, 'script'):
+            cad, _ = koko.batch.run_script(open(filename).read(), filename)
+
+        with Timer(stages, 'parse') as s:
+            s['nodes'] = 0
+            for e in cad.shapes:
+                ptr = libfab.parse(e.math)
+                s['nodes'] += libfab.count_nodes(ptr)
+                libfab.free_tree(ptr)
+
+        if all(getattr(cad, b) is not None
+               for b in ['xmin','xmax','ymin','ymax']):
+            for r in resolutions:
+                with Timer(stages, 'render_%g' % r) as s:
+                    imgs = [koko.batch.make_image(cad, e, r, threads=None)
+                            for e in cad.shapes]
+                    s['pixels'] = sum(i.width*i.height for i in imgs)
+                del imgs
+
+        if cad.bounded:
+            with Timer(stages, 'asdf') as s:
+                asdfs = [koko.batch.make_asdf(cad, e, asdf_resolution)
+                         for e in cad.shapes]
+                s['cells'] = sum(a.cell_count for a in asdfs)
+
+            with Timer(stages, 'triangulate') as s:
+                mesh = Mesh.merge([a.triangulate() for a in asdfs])
+                s['triangles'] = mesh.tcount
+
+            stl = os.path.join(tmp, 'out.stl')
+            with Timer(stages, 'stl_save') as s:
+                mesh.save_stl(stl)
+                s['bytes'] = os.path.getsize(stl)
+            with Timer(stages, 'stl_load'):
+                Mesh.load(stl)
+            del mesh
+
+            filenames = [os.path.join(tmp, '%i.asdf' % i)
+                         for i in range(len(asdfs))]
+            with Timer(stages, 'asdf_save') as s:
+                for a, f in zip(asdfs, filenames):   a.save(f)
+                s['bytes'] = sum(os.path.getsize(f) for f in filenames)
+            with Timer(stages, 'asdf_load') as s:
+                s['cells'] = sum(ASDF.load(f).cell_count for f in filenames)
+            del asdfs
+
+        elif cad.zmin is None and cad.zmax is None and resolutions:
+            # Flat designs are contoured (as for a 2D mill toolpath)
+            img = koko.batch.make_image(cad, cad.shape, min(resolutions),
+                                        threads=None)
+            with Timer(stages, 'contour') as s:
+                paths = img.distance().contour(CONTOUR_DIAMETER, 2, 0.5)
+                s['paths'] = len(paths)
+            del img, paths
+
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+    return {
+        'file': os.path.basename(filename),
+        'stages': stages,
+        'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }
+
+
+def run(files, resolutions, asdf_resolution):
+    """ @brief Benchmarks a set of files, each in a fresh worker process
+        @returns Dictionary of results, ready to be saved as JSON
+    """
+    pool = multiprocessing.Pool(1, maxtasksperchild=1)
+    out = {}
+    try:
+        for r in pool.imap(bench_file, [(f, resolutions, asdf_resolution)
+                                        for f in files]):
+            out[r['file']] = r
+            total = sum(s['seconds'] for s in r['stages'].values())
+            print '%-24s %10.3f s %10.1f MB' % (
+                r['file'], total, r['peak_rss_kb'] / 1024.)
+            sys.stdout.flush()
+    finally:
+        pool.close()
+        pool.join()
+
+    return {
+        'format': FORMAT,
+        'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'machine': {'platform': platform.platform(),
+                    'python': platform.python_version(),
+                    'cpus': multiprocessing.cpu_count()},
+        'settings': {'resolutions': resolutions,
+                     'asdf_resolution': asdf_resolution},
+        'files': out,
+    }
+
+
+def compare(results, baseline, threshold, min_seconds):
+    """ @brief Compares results against a baseline
+        @param threshold Allowed fractional increase in time or memory
+        @param min_seconds Time differences below this are ignored (as noise)
+        @returns List of regression strings (empty if everything passed)
+    """
+    if baseline.get('settings') != results['settings']:
+        print 'Warning: baseline settings differ (%s vs %s)' % (
+            baseline.get('settings'), results['settings'])
+
+    regressions = []
+    print '\n%-24s %-14s %10s %10s %8s' % (
+        'file', 'stage', 'baseline', 'current', 'change')
+    for name, r in sorted(results['files'].items()):
+        b = baseline['files'].get(name)
+        if b is None:
+            print '%-24s (not in baseline)' % name
+            continue
+
+        for stage, s in sorted(r['stages'].items()):
+            t = b['stages'].get(stage)
+            if t is None:   continue
+
+            old, new = t['seconds'], s['seconds']
+            change = (new - old) / old if old else 0
+            flag = ''
+            if new > old*(1 + threshold) and new - old > min_seconds:
+                flag = '  REGRESSION'
+                regressions.append('%s %s: %.3f s -> %.3f s' %
+                                   (name, stage, old, new))
+            print '%-24s %-14s %10.3f %10.3f %+7.1f%%%s' % (
+                name, stage, old, new, change*100, flag)
+
+            # Changed counts don't fail the run, but are worth a look
+            for k in sorted(s):
+                if k != 'seconds' and k in t and s[k] != t[k]:
+                    print '%-24s %-14s %s changed: %s -> %s' % (
+                        name, stage, k, t[k], s[k])
+
+        old, new = b['peak_rss_kb'], r['peak_rss_kb']
+        flag = ''
+        if new > old*(1 + threshold):
+            flag = '  REGRESSION'
+            regressions.append('%s peak RSS: %.1f MB -> %.1f MB' %
+                               (name, old/1024., new/1024.))
+        print '%-24s %-14s %9.1fM %9.1fM %+7.1f%%%s' % (
+            name, 'peak_rss', old/1024., new/1024.,
+            (new - old)*100. / old if old else 0, flag)
+
+    return regressions
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        description='Benchmarks .ko files, optionally against a baseline.')
+    parser.add_argument('files', metavar='FILENAME', nargs='*',
+                        help='Design files (default: examples/*.ko)')
+    parser.add_argument('-o', '--output', metavar='JSON',
+                        help='Write results to this file')
+    parser.add_argument('-b', '--baseline', metavar='JSON',
+                        help='Compare results against this file')
+    parser.add_argument('-t', '--threshold', type=float, default=0.2,
+                        help='Allowed fractional slowdown (default 0.2)')
+    parser.add_argument('-m', '--min-seconds', type=float, default=0.05,
+                        help='Ignore slowdowns smaller than this (default 0.05)')
+    parser.add_argument('-r', '--resolutions', default='2,5',
+                        help='Comma-separated render resolutions in pixels/mm')
+    parser.add_argument('-a', '--asdf-resolution', type=float, default=2,
+                        help='ASDF resolution in voxels/mm')
+    args = parser.parse_args(argv)
+
+    files = args.files or sorted(glob.glob(os.path.join(ROOT, 'examples', '*.ko')))
+    resolutions = [float(r) for r in args.resolutions.split(',')]
+
+    results = run(files, resolutions, args.asdf_resolution)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline,
+                              args.threshold, args.min_seconds)
+        if regressions:
+            print '\n%i regression(s):' % len(regressions)
+            for r in regressions:   print '    ' + r
+            return 1
+        print '\nNo regressions.'
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))